@@ -0,0 +1,217 @@
+import os
+import argparse
+import json
+import time
+import platform
+import subprocess
+import statistics
+import tracemalloc
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import fetch_data as fd
+import process_test_data as pt
+import process_hosp_data as hd
+import process_kpi as kpi
+import synthetic_data as sd
+
+## Benchmark settings ##
+
+# synthetic inputs are generated once per scale, under bench_path
+bench_path = 'data/bench/'
+
+# one json record per benchmark & run, appended so commits can be compared
+results_path = 'data/benchmark_results.jsonl'
+
+repeat = 3
+
+## Benchmarks ##
+
+# Each benchmark is (name, setup, func): setup() builds func's inputs and
+# isn't timed; func(*setup()) is. Setups that return () just reset state.
+
+def reset_session():
+    hd.clear_store()
+    return ()
+
+def setup_testing_df():
+    return (pt.create_testing_df(True, as_datetime=True),)
+
+def setup_age_df():
+    return (pt.create_testing_df(False, as_datetime=True),)
+
+def setup_dept_age_grid():
+    return (pt.create_dept_age_grid(pt.create_testing_df(False, as_datetime=True)),)
+
+def run_create_dept_age_df(age_df):
+    return pt.create_dept_age_df(df=age_df)
+
+def run_create_rea_df():
+    return hd.create_rea_df('reg')
+
+def run_create_kpi_df():
+    return kpi.create_kpi_df()
+
+benchmarks = [('create_testing_df', reset_session, lambda: pt.create_testing_df(False)),
+              ('create_rolling_cols', setup_testing_df, pt.create_rolling_cols),
+              ('create_dept_age_df', setup_age_df, run_create_dept_age_df),
+              ('calc_older_incid', setup_dept_age_grid, pt.calc_older_incid),
+              ('create_rea_df', reset_session, run_create_rea_df),
+              ('create_kpi_df', reset_session, run_create_kpi_df)]
+
+## Helper functions ##
+
+def get_commit():
+    '''Current commit, with a '+dirty' suffix for uncommitted changes.'''
+
+    def git(*args):
+        return subprocess.run(['git'] + list(args), capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    if git('status', '--porcelain', '--untracked-files=no'):
+        commit += '+dirty'
+    return commit
+
+
+@contextmanager
+def synthetic_inputs(n_depts, n_days, seed=0):
+    '''Runs the pipeline against synthetic inputs: remote csvs are served
+    from local files and the working dir is switched to the bench dir, so
+    pkls are read & outputs written there instead of data/.'''
+
+    path = Path(bench_path).joinpath('{}x{}_seed{}'.format(n_depts, n_days, seed)).resolve()
+    sources_json = path.joinpath('sources.json')
+    if sources_json.exists():
+        with open(sources_json) as f:
+            local_sources = json.load(f)
+    else:
+        print("Generating synthetic inputs in {}...".format(path))
+        local_sources = sd.generate(path, n_depts, n_days, seed)
+        with open(sources_json, 'w') as f:
+            json.dump(local_sources, f, indent=1)
+
+    prev_sources = dict(fd.local_sources)
+    prev_cwd = os.getcwd()
+    fd.local_sources.update(local_sources)
+    os.chdir(path)
+    hd.clear_store()
+    try:
+        yield path
+    finally:
+        os.chdir(prev_cwd)
+        fd.local_sources.clear()
+        fd.local_sources.update(prev_sources)
+        hd.clear_store()
+
+
+def count_rows(result):
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return len(result)
+    return None
+
+
+def run_benchmark(setup, func, repeat=repeat):
+    '''Times func(*setup()) `repeat` times, then runs it once more
+    under tracemalloc for its peak memory (kept separate: tracing
+    slows allocations down).'''
+
+    times = []
+    for i in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+        del result
+
+    args = setup()
+    tracemalloc.start()
+    result = func(*args)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'min_s': round(min(times), 4),
+            'median_s': round(statistics.median(times), 4),
+            'peak_mb': round(peak / 1024**2, 1),
+            'rows': count_rows(result)}
+
+
+def run_benchmarks(n_depts=101, n_days=300, repeat=repeat, only=None, seed=0, save=True):
+    '''Runs every benchmark (or those named in `only`) on synthetic
+    inputs, prints a summary, and appends the results to results_path.
+
+    Returns:
+        list of result dicts'''
+
+    run = {'commit': get_commit(),
+           'date': datetime.now().isoformat(timespec='seconds'),
+           'n_depts': n_depts,
+           'n_days': n_days,
+           'seed': seed,
+           'python': platform.python_version(),
+           'pandas': pd.__version__,
+           'numpy': np.__version__}
+
+    results = []
+    with synthetic_inputs(n_depts, n_days, seed):
+        for name, setup, func in benchmarks:
+            if only and name not in only:
+                continue
+            result = dict(run, benchmark=name, **run_benchmark(setup, func, repeat))
+            print("{benchmark:<22} {min_s:>9.3f} s {median_s:>9.3f} s {peak_mb:>9.1f} MB  {rows} rows".format(**result))
+            results.append(result)
+
+    if save:
+        Path(results_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(results_path, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+        print("Results appended to {}".format(results_path))
+
+    return results
+
+
+def load_results(path=results_path):
+    return pd.read_json(path, lines=True)
+
+
+def compare_results(path=results_path, metric='min_s', n_depts=None, n_days=None):
+    '''Table of `metric` by benchmark & commit (latest run of each commit),
+    at one scale (the most recent one by default).'''
+
+    results = load_results(path)
+    latest = results.iloc[-1]
+    n_depts = latest['n_depts'] if n_depts is None else n_depts
+    n_days = latest['n_days'] if n_days is None else n_days
+
+    results = results.loc[(results['n_depts']==n_depts) & (results['n_days']==n_days)]
+    table = results.drop_duplicates(['commit', 'benchmark'], keep='last')\
+        .pivot(index='benchmark', columns='commit', values=metric)
+    commits = results.drop_duplicates('commit', keep='last').sort_values('date')['commit']
+    table = table[commits]
+
+    print("{} - {} depts x {} days".format(metric, n_depts, n_days))
+    print(table.to_string())
+    return table
+
+
+if __name__=='__main__':
+    # `python benchmark.py [--depts 101] [--days 300] [--repeat 3] [name ...]`
+    # `python benchmark.py --compare [min_s|median_s|peak_mb]`
+    parser = argparse.ArgumentParser(description="Times the pipeline's steps on synthetic inputs.")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default: all)")
+    parser.add_argument('--depts', type=int, default=101)
+    parser.add_argument('--days', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=repeat)
+    parser.add_argument('--compare', nargs='?', const='min_s', choices=['min_s', 'median_s', 'peak_mb'],
+                        help="show saved results by commit instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(metric=args.compare)
+    else:
+        run_benchmarks(args.depts, args.days, args.repeat, only=args.names or None)
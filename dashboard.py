@@ -0,0 +1,269 @@
+import json
+import base64
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import process_geo_data as gd
+import kpi_rules as kr
+
+## Single-page dashboard ##
+
+# Writes the whole covid_dataviz dashboard as two files instead of ~20
+# self-contained plotly html files:
+#   dashboard_data.json - dept & region geometry (once) + kpi columns
+#   dashboard.html      - one page that builds every figure client-side
+#
+# kpi values are stored as dense (date x dept) blocks of little-endian
+# Float32 (NaN = missing), base64 encoded. Alert levels are Int8 codes
+# into 'levels' (-1 = missing). Dates, depts & regions are stored once.
+# France métropolitaine & region values come from the rollup cube
+# (process_kpi.build_kpi_cube), as (date) & (date x region) blocks.
+
+output_path = "../covid_dataviz/"
+data_fname = 'dashboard_data.json'
+page_fname = 'dashboard.html'
+
+value_cols = ['incid_tous', 'incid_70+', 'rea%', 'rea%_dep']
+
+# cube rates plotted for France métropolitaine & by region
+rollup_cols = ['incid_tous', 'incid_70+', 'rea%']
+
+source = kr.source
+
+
+def encode_array(values, dtype):
+    '''base64 of a numpy array's raw (little-endian) bytes.'''
+
+    values = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<'))
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+
+def encode_rollup(cube, level, areas, days):
+    '''Cube rates of `areas` at `level`, as dense (date x area) Float32 blocks.'''
+
+    rows = cube.loc[level].reset_index()
+    rows = rows.loc[rows['area'].isin(areas)]
+    day_codes = pd.Index(days).get_indexer(rows['jour'])
+    area_codes = pd.Categorical(rows['area'], categories=areas).codes
+    known = day_codes >= 0
+
+    rollup = {}
+    for col in rollup_cols:
+        grid = np.full((len(days), len(areas)), np.nan, dtype='float32')
+        grid[day_codes[known], area_codes[known]] = rows[col].to_numpy(dtype='float32')[known]
+        rollup[col] = encode_array(grid, 'float32')
+
+    return rollup
+
+
+def make_dashboard_data(kpi_df, cube):
+    '''Compact, columnar version of kpi_df, its rollups (the indexed kpi
+    cube) + map geometry, for dashboard.html.'''
+
+    days = np.sort(kpi_df['jour'].unique())
+    depts = kpi_df.drop_duplicates('libelle_dep').sort_values(['reg', 'libelle_dep'])
+    dep_names = depts['libelle_dep'].tolist()
+
+    day_codes = np.searchsorted(days, kpi_df['jour'])
+    dep_codes = pd.Categorical(kpi_df['libelle_dep'], categories=dep_names).codes
+    shape = (len(days), len(dep_names))
+
+    kpi = {}
+    for col in value_cols:
+        grid = np.full(shape, np.nan, dtype='float32')
+        grid[day_codes, dep_codes] = kpi_df[col].to_numpy(dtype='float32')
+        kpi[col] = encode_array(grid, 'float32')
+
+    levels = kr.levels
+    level_codes = np.full(shape, -1, dtype='int8')
+    level_codes[day_codes, dep_codes] = pd.Categorical(kpi_df['niveau_global'], categories=levels).codes
+    kpi['niveau_global'] = encode_array(level_codes, 'int8')
+
+    # dom_tom per dept (first known value)
+    dom_tom = kpi_df.dropna(subset=['dom_tom']).groupby('libelle_dep')['dom_tom'].first()
+    dom_tom = dom_tom.reindex(dep_names).astype('str') == 'True'
+
+    regions = kpi_df.drop_duplicates('reg').set_index('reg')['libelle_reg'].sort_index().rename(index=str)
+
+    data = {'days': days.tolist(),
+            'depts': {'name': dep_names,
+                      'reg': depts['reg'].astype('int').tolist(),
+                      'dom_tom': dom_tom.tolist()},
+            'regions': regions.to_dict(),
+            'levels': levels,
+            'colors': [kr.colors[level] for level in levels],
+            # alert thresholds by indicator, drawn on the region plots
+            'thresholds': kr.thresholds,
+            'kpi': kpi,
+            # columns in the order of 'regions'
+            'rollups': {'metro': encode_rollup(cube, 'fr', ['metro'], days),
+                        'reg': encode_rollup(cube, 'reg', regions.index.tolist(), days)},
+            'geo': {'fr_dept': gd.get_fr_dept(),
+                    'fr_region': gd.get_fr_region()},
+            'source': source}
+
+    return data
+
+
+def write_dashboard(kpi_df, cube, path=output_path):
+    '''Writes dashboard_data.json & dashboard.html to path. cube is the
+    indexed kpi cube (process_kpi.load_kpi_cube).
+
+    Returns:
+        paths of the two files'''
+
+    data = make_dashboard_data(kpi_df, cube)
+
+    data_file = Path(path).joinpath(data_fname)
+    with open(data_file, 'w') as f:
+        json.dump(data, f, separators=(',', ':'), ensure_ascii=False)
+
+    page_file = Path(path).joinpath(page_fname)
+    with open(page_file, 'w') as f:
+        f.write(dashboard_html.replace('__DATA_FILE__', data_fname))
+
+    print("Dashboard saved to {} & {}".format(page_file, data_file))
+    return page_file, data_file
+
+
+dashboard_html = '''<!DOCTYPE html>
+<html lang="fr">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Covid-19 indicators - France</title>
+<script src="https://cdn.plot.ly/plotly-latest.min.js"></script>
+<style>
+  body { font-family: sans-serif; margin: 0 auto; max-width: 1100px; padding: 0 1em; }
+  .fig { width: 100%; min-height: 500px; }
+</style>
+</head>
+<body>
+<h1>Covid-19 indicators - France</h1>
+<div id="alerts" class="fig"></div>
+<div id="trends" class="fig"></div>
+<div id="rea_pct_region" class="fig"></div>
+<div id="rea_pct_dept" class="fig"></div>
+<div id="kpi_incid_tous_by_reg" class="fig"></div>
+<div id="kpi_incid_70_by_reg" class="fig"></div>
+<div id="kpi_rea_by_reg" class="fig"></div>
+<h2>By department</h2>
+<select id="reg_select"></select>
+<div id="kpi_reg" class="fig" style="min-height: 900px"></div>
+<script>
+function decode(b64, ArrayType) {
+  const bytes = Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+  return new ArrayType(bytes.buffer);
+}
+
+fetch('__DATA_FILE__').then(r => r.json()).then(data => {
+  const days = data.days, depts = data.depts, nDep = depts.name.length;
+  const kpi = {};
+  for (const col of ['incid_tous', 'incid_70+', 'rea%', 'rea%_dep']) {
+    kpi[col] = decode(data.kpi[col], Float32Array);
+  }
+  const levels = decode(data.kpi['niveau_global'], Int8Array);
+  const rollups = {metro: {}, reg: {}};
+  for (const col of ['incid_tous', 'incid_70+', 'rea%']) {
+    rollups.metro[col] = decode(data.rollups.metro[col], Float32Array);
+    rollups.reg[col] = decode(data.rollups.reg[col], Float32Array);
+  }
+  const at = (arr, d, j) => arr[d * nDep + j];
+  const valid = v => !Number.isNaN(v);
+  const orNull = v => valid(v) ? v : null;
+  const source = {x: 1, y: 0, xref: 'paper', yref: 'paper', xanchor: 'right', showarrow: false,
+                  text: "Source: <a href='" + data.source + "'>Santé Publique France</a>"};
+  const geoLayout = {fitbounds: 'locations', visible: false, projection: {type: 'mercator'}};
+
+  // latest day with a value in arr
+  function latestDay(arr) {
+    for (let d = days.length - 1; d >= 0; d--) {
+      for (let j = 0; j < nDep; j++) { if (valid(at(arr, d, j))) return d; }
+    }
+    return days.length - 1;
+  }
+
+  // alert levels map, one trace per level (metro only)
+  let dAlert = days.length - 1;
+  search: for (; dAlert >= 0; dAlert--) {
+    for (let j = 0; j < nDep; j++) { if (at(levels, dAlert, j) >= 0) break search; }
+  }
+  const alertTraces = data.levels.map((level, code) => {
+    const idx = [...Array(nDep).keys()].filter(j => !depts.dom_tom[j] && at(levels, dAlert, j) === code);
+    return {type: 'choropleth', geojson: data.geo.fr_dept, featureidkey: 'properties.nom',
+            name: level, showlegend: true, showscale: false,
+            locations: idx.map(j => depts.name[j]), z: idx.map(() => 1),
+            colorscale: [[0, data.colors[code]], [1, data.colors[code]]],
+            hovertext: idx.map(j => depts.name[j] + ' (' + data.regions[depts.reg[j]] + ')<br>' +
+                               'incid_tous: ' + Math.round(at(kpi['incid_tous'], dAlert, j)) + '<br>' +
+                               'incid_70+: ' + Math.round(at(kpi['incid_70+'], dAlert, j)) + '<br>' +
+                               'rea%: ' + Math.round(at(kpi['rea%'], dAlert, j)) + '%'),
+            hoverinfo: 'text'};
+  });
+  Plotly.newPlot('alerts', alertTraces,
+                 {title: "<b>Niveaux d'alerte - " + days[dAlert] + '</b>', geo: geoLayout,
+                  annotations: [source], margin: {r: 0, l: 0, b: 20}});
+
+  // France métropolitaine, all depts combined
+  Plotly.newPlot('trends', ['incid_tous', 'incid_70+', 'rea%'].map(col =>
+                   ({type: 'bar', name: col, x: days,
+                     y: days.map((_, d) => orNull(Math.round(rollups.metro[col][d])))})),
+                 {title: '<b>Covid-19 indicator trends - France</b><br>(metropolitan France, all depts combined)'});
+
+  // rea% maps
+  const dRea = latestDay(kpi['rea%']);
+  const regCodes = Object.keys(data.regions);
+  const regRea = regCodes.map(reg => at(kpi['rea%'], dRea, depts.reg.indexOf(Number(reg))));
+  const reaScale = {colorscale: 'Reds', zmin: 0, zmax: 100,
+                    colorbar: {ticksuffix: '%', len: 0.6}};
+  Plotly.newPlot('rea_pct_region', [Object.assign({type: 'choropleth', geojson: data.geo.fr_region,
+                   featureidkey: 'properties.code', locations: regCodes, z: regRea,
+                   text: regCodes.map(reg => data.regions[reg])}, reaScale)],
+                 {title: '<b>rea% - ' + days[dRea] + '</b>', geo: geoLayout, annotations: [source]});
+  Plotly.newPlot('rea_pct_dept', [Object.assign({type: 'choropleth', geojson: data.geo.fr_dept,
+                   featureidkey: 'properties.nom', locations: depts.name,
+                   z: depts.name.map((_, j) => at(kpi['rea%_dep'], dRea, j))}, reaScale)],
+                 {title: '<b>rea%_dep - ' + days[dRea] + '</b>', geo: geoLayout, annotations: [source]});
+
+  // regions, all depts combined. No icu numbers for DOM (region codes < 10)
+  const nReg = regCodes.length;
+  const thresholds = data.thresholds;
+  const hlines = col => thresholds[col].map(y => ({type: 'line', xref: 'paper', x0: 0, x1: 1, y0: y, y1: y,
+                                                   line: {dash: 'dash', color: 'darkred'}}));
+  [['incid_tous', 'kpi_incid_tous_by_reg'], ['incid_70+', 'kpi_incid_70_by_reg'], ['rea%', 'kpi_rea_by_reg']]
+    .forEach(([col, div]) => {
+      const traces = regCodes
+        .map((reg, r) => ({type: 'scatter', mode: 'lines', name: data.regions[reg],
+                           x: days, y: days.map((_, d) => orNull(rollups.reg[col][d * nReg + r]))}))
+        .filter((trace, r) => Number(regCodes[r]) >= 10 && trace.y.some(v => v !== null));
+      Plotly.newPlot(div, traces, {title: '<b>' + col + '</b><br>(Use legend to hide/show regions)',
+                                   shapes: hlines(col)});
+    });
+
+  // depts of one region, one row per indicator
+  const select = document.getElementById('reg_select');
+  regCodes.forEach(reg => select.add(new Option(data.regions[reg], reg)));
+  function plotRegion(reg) {
+    const idx = [...Array(nDep).keys()].filter(j => String(depts.reg[j]) === reg);
+    const rows = [['rea%_dep', 'y'], ['incid_70+', 'y2'], ['incid_tous', 'y3']];
+    const traces = [];
+    rows.forEach(([col, yaxis], r) => idx.forEach((j, k) => traces.push({
+      type: 'scatter', mode: 'lines', x: days, yaxis: yaxis, name: depts.name[j],
+      legendgroup: depts.name[j], showlegend: r === 0,
+      y: days.map((_, d) => { const v = at(kpi[col], d, j); return valid(v) ? v : null; })})));
+    Plotly.react('kpi_reg', traces, {
+      title: 'Covid indicators - ' + data.regions[reg], height: 900,
+      grid: {rows: 3, columns: 1, roworder: 'top to bottom'},
+      yaxis: {title: '% occupied'}, yaxis2: {title: 'cases per 100k pop.'}, yaxis3: {title: 'cases per 100k pop.'},
+      annotations: rows.map(([col], r) => ({text: col, showarrow: false, xref: 'paper', yref: 'paper',
+                                            x: 0.5, y: 1 - r / 3, yanchor: 'bottom'}))});
+  }
+  select.onchange = () => plotRegion(select.value);
+  plotRegion(select.value);
+});
+</script>
+</body>
+</html>
+'''
@@ -0,0 +1,350 @@
+import io
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+import numpy as np
+import pandas as pd
+
+import instrument as ins
+
+## Download cache ##
+
+# Every remote source (data.gouv.fr csvs, INSEE zips & xls, geojson) goes through
+# fetch(). Raw bytes are stored once per content hash under cache_dir/blobs,
+# and index.json maps each url to its blob plus the ETag / Last-Modified
+# validators returned by the server.
+
+cache_dir = 'data/cache/'
+max_cache_bytes = 2 * 1024**3  # 2 GB, least recently used entries go first
+
+# offline mode: only serve cached bytes, never touch the network
+offline_mode = os.environ.get('COVID_OFFLINE', '0') == '1'
+
+index_fname = 'index.json'
+
+# url -> local file to serve instead (e.g. synthetic data for benchmarks)
+local_sources = {}
+
+# network errors, timeouts & 5xx responses are retried, waiting
+# retry_backoff x 1, 2, 4... seconds between attempts
+retries = 2
+retry_backoff = 1.
+
+# bounded parallelism of fetch_all
+fetch_jobs = 4
+
+# index.json is read & rewritten by every fetch: one thread at a time
+_index_lock = threading.Lock()
+
+# url -> cached file fetched by fetch_all, served by fetch() for the rest of
+# the session without another request. Only paths: the bytes stay on disk
+_prefetched = {}
+
+# downloads are written to the cache in chunks of blob_chunk bytes
+blob_chunk = 1024**2
+
+
+def _index_path(cache_dir):
+    return Path(cache_dir).joinpath(index_fname)
+
+
+def _blob_path(cache_dir, digest):
+    return Path(cache_dir).joinpath('blobs', digest[:2], digest)
+
+
+def load_index(cache_dir=cache_dir):
+    index_path = _index_path(cache_dir)
+    if not index_path.exists():
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def save_index(index, cache_dir=cache_dir):
+    index_path = _index_path(cache_dir)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, index_path)
+
+
+def _write_blob_stream(source, cache_dir):
+    '''Copies a binary file object into the cache, chunk by chunk, and
+    stores it under its sha256. Identical payloads served from different
+    urls (or unchanged re-downloads) share one file.
+
+    Returns:
+        (sha256, size in bytes)'''
+
+    tmp_path = Path(cache_dir).joinpath('blobs', '{}.{}.tmp'.format(os.getpid(), threading.get_ident()))
+    tmp_path.parent.mkdir(parents=True, exist_ok=True)
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in iter(lambda: source.read(blob_chunk), b''):
+                h.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        digest = h.hexdigest()
+        blob_path = _blob_path(cache_dir, digest)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, blob_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    return digest, size
+
+
+def _write_blob(content, cache_dir):
+    '''Stores bytes under their sha256, see _write_blob_stream.'''
+
+    digest, size = _write_blob_stream(io.BytesIO(content), cache_dir)
+    return digest
+
+
+def evict(index, cache_dir=cache_dir, max_bytes=max_cache_bytes, keep=()):
+    '''Drops least recently used entries until the blobs fit in max_bytes.
+    A blob is only deleted once no remaining url points to it. Urls in
+    `keep` (e.g. the one just fetched) are never dropped.'''
+
+    def total_size(entries):
+        blobs = {e['sha256']: e['size'] for e in entries.values()}
+        return sum(blobs.values())
+
+    by_age = sorted((url for url in index if url not in keep), key=lambda url: index[url]['last_used'])
+    while by_age and total_size(index) > max_bytes:
+        url = by_age.pop(0)
+        digest = index.pop(url)['sha256']
+        if digest not in {e['sha256'] for e in index.values()}:
+            blob_path = _blob_path(cache_dir, digest)
+            if blob_path.exists():
+                blob_path.unlink()
+
+    return index
+
+
+def _download(url, headers, cache_dir, timeout=120, retries=retries):
+    '''urlopen with retries, streaming the response into the cache.
+    Returns (sha256, size, response headers).
+    HTTP errors other than 5xx (incl. 304 Not Modified) are raised at once.'''
+
+    for attempt in range(retries + 1):
+        try:
+            with urlopen(Request(url, headers=headers), timeout=timeout) as response:
+                digest, size = _write_blob_stream(response, cache_dir)
+                return digest, size, response.headers
+        except HTTPError as e:
+            if e.code < 500 or attempt == retries:
+                raise
+        except OSError:  # URLError, timeouts, dropped connections
+            if attempt == retries:
+                raise
+        time.sleep(retry_backoff * 2**attempt)
+
+
+@ins.instrumented('fd.fetch')
+def fetch_path(url, cache_dir=cache_dir, offline=None, max_bytes=max_cache_bytes, timeout=120, retries=retries):
+    '''Returns the path of a local file holding the bytes behind url,
+    going through the on-disk cache. Downloads are streamed to disk,
+    so a large source is never held in memory.
+
+    A cached entry is revalidated with If-None-Match / If-Modified-Since,
+    so an unchanged source costs one 304 round-trip instead of a download.
+    In offline mode (or when the server can't be reached) cached bytes are
+    served as-is; a url that was never cached raises FileNotFoundError.
+    Local files are returned as is. Safe to call from several threads.'''
+
+    if url in _prefetched and _prefetched[url].exists():
+        return _prefetched[url]
+
+    if offline is None:
+        offline = offline_mode
+
+    url = local_sources.get(url, url)
+
+    # local files bypass the cache
+    if not url.startswith(('http://', 'https://')):
+        return Path(url)
+
+    with _index_lock:
+        entry = load_index(cache_dir).get(url)
+
+    if entry is not None and not _blob_path(cache_dir, entry['sha256']).exists():
+        entry = None  # blob removed by hand
+
+    if offline:
+        if entry is None:
+            raise FileNotFoundError("Offline mode: {} is not cached".format(url))
+    else:
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            digest, size, response_headers = _download(url, headers, cache_dir, timeout, retries)
+            entry = {'sha256': digest,
+                     'size': size,
+                     'etag': response_headers.get('ETag'),
+                     'last_modified': response_headers.get('Last-Modified')}
+        except HTTPError as e:
+            if e.code != 304 or entry is None:
+                raise
+        except OSError:
+            # server unreachable: fall back to the last good copy
+            if entry is None:
+                raise
+            print("Could not reach {}, using cached copy".format(url))
+
+    # re-read: other threads may have updated the index meanwhile
+    with _index_lock:
+        index = load_index(cache_dir)
+        entry['last_used'] = time.time()
+        index[url] = entry
+        index = evict(index, cache_dir, max_bytes, keep=[url])
+        save_index(index, cache_dir)
+
+    return _blob_path(cache_dir, entry['sha256'])
+
+
+def fetch(url, cache_dir=cache_dir, offline=None, max_bytes=max_cache_bytes, timeout=120, retries=retries):
+    '''Returns the raw bytes behind url, see fetch_path. For small
+    sources: large ones are better parsed from fetch_path / open_source.'''
+
+    with open(fetch_path(url, cache_dir, offline, max_bytes, timeout, retries), 'rb') as f:
+        return f.read()
+
+
+def fetch_all(urls, max_workers=None, cache_dir=cache_dir, timeout=120, retries=retries):
+    '''Fetches every url concurrently, at most max_workers (default
+    fetch_jobs) at a time, so the wait is about that of the slowest source
+    instead of the sum of all of them.
+
+    Sources are only written to the cache on disk, never held in memory.
+    For the rest of the session, fetch() calls (and so read_csv,
+    open_source...) read those files without another request, until
+    clear_prefetched(). Failures are retried, then reported together
+    in one RuntimeError.
+
+    Returns:
+        dict of url -> local path'''
+
+    urls = list(dict.fromkeys(urls))  # unique, in order
+    with ThreadPoolExecutor(max_workers=max_workers or fetch_jobs) as pool:
+        futures = {url: pool.submit(fetch_path, url, cache_dir=cache_dir, timeout=timeout, retries=retries)
+                   for url in urls}
+
+    paths = {}
+    errors = []
+    for url, future in futures.items():
+        try:
+            paths[url] = future.result()
+        except Exception as e:
+            errors.append("{}: {!r}".format(url, e))
+    _prefetched.update(paths)
+
+    if errors:
+        raise RuntimeError("{} source(s) could not be fetched:\n{}".format(len(errors), "\n".join(errors)))
+
+    return paths
+
+
+def clear_prefetched():
+    '''Forgets the sources fetched by fetch_all: the next fetch() of
+    each one revalidates it with the server again.'''
+
+    _prefetched.clear()
+
+
+def open_source(url):
+    '''Binary file object over a source, for parsers that read it in chunks.
+    Local files and cached downloads alike are read from disk as they're
+    parsed, so memory use is bounded by the parser's chunk size.'''
+
+    return open(fetch_path(url), 'rb')
+
+
+def read_csv(url, **kwargs):
+    '''Drop-in for pd.read_csv(url, ...) that reads through the cache.'''
+
+    with ins.stage('fd.read_csv', url=url) as s:
+        df = pd.read_csv(fetch_path(url), **kwargs)
+        s.rows = len(df)
+    return df
+
+
+def read_excel(url, **kwargs):
+    '''Drop-in for pd.read_excel(url, ...) that reads through the cache.'''
+
+    with ins.stage('fd.read_excel', url=url) as s:
+        df = pd.read_excel(fetch_path(url), **kwargs)
+        s.rows = len(df)
+    return df
+
+
+## Dates ##
+
+# Date formats seen in the sources' 'jour' column, tried in order:
+# the hospital feed had a few days in dd/mm/yyyy (e.g. June 27-29, 2020).
+# Dates are parsed once, on ingest, into datetime64 for sorting, grouping
+# & rolling windows, and only formatted back to ISO strings for output.
+day_formats = ['%Y-%m-%d', '%d/%m/%Y']
+
+
+def parse_days(values, formats=day_formats):
+    '''Parses date strings (in any of `formats`) to datetime64[ns].
+    Each distinct string is parsed once, so a categorical or a column of
+    repeated dates costs about as much as its unique values. Values that
+    are already datetimes are returned as is.
+
+    Raises:
+        ValueError if a date matches none of the formats'''
+
+    values = pd.Series(values) if not isinstance(values, (pd.Series, pd.Index)) else values
+    if pd.api.types.is_datetime64_dtype(values.dtype):
+        return values.to_numpy(dtype='datetime64[ns]')
+
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype='object')
+    days = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+    for fmt in formats:
+        missing = days.isna()
+        if not missing.any():
+            break
+        days[missing] = pd.to_datetime(uniques[missing], format=fmt, errors='coerce')
+
+    if days.isna().any():
+        raise ValueError("Unrecognized date(s): {}".format(list(uniques[days.isna()][:5])))
+
+    # NaN values (code -1) stay NaT
+    days = np.append(days.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT', 'ns'))
+    return days[codes]
+
+
+def format_days(days):
+    '''datetime64 values as 'YYYY-MM-DD' strings (NaT -> NaN), for output.'''
+
+    codes, uniques = pd.factorize(np.asarray(days, dtype='datetime64[ns]'))
+    strings = np.append(pd.DatetimeIndex(uniques).strftime('%Y-%m-%d').to_numpy(dtype='object'), np.nan)
+    return strings[codes]
+
+
+def clear_cache(cache_dir=cache_dir):
+    '''Removes every cached entry & blob.'''
+
+    clear_prefetched()
+    with _index_lock:
+        index = evict(load_index(cache_dir), cache_dir, max_bytes=0)
+        save_index(index, cache_dir)
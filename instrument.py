@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import platform
+import threading
+from functools import wraps
+from datetime import datetime
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+## Run instrumentation ##
+
+# Stages of a run (downloads, parsing, kpi build steps, figures...) record
+# wall time, CPU time, peak RSS & row counts. Off by default: a disabled
+# stage is one flag check. Enable with COVID_INSTRUMENT=1 or enable();
+# worker processes inherit the setting through the environment.
+
+env_var = 'COVID_INSTRUMENT'
+enabled = os.environ.get(env_var, '0') == '1'
+
+report_path = 'data/run_report.json'
+
+records = []
+_local = threading.local()  # stack of open stages, per thread
+_t0 = time.time()  # run start (epoch, so stages from worker processes line up)
+
+
+def enable():
+    global enabled
+    enabled = True
+    os.environ[env_var] = '1'
+
+
+def disable():
+    global enabled
+    enabled = False
+    os.environ[env_var] = '0'
+
+
+def peak_rss_mb():
+    '''Peak resident memory of this process so far, in MB.'''
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return round(peak / (1024**2 if sys.platform == 'darwin' else 1024), 1)
+
+
+def count_rows(result):
+    '''Row count of a df / series, or of each one in a tuple or dict.'''
+
+    if hasattr(result, 'index') and hasattr(result, 'shape'):
+        return len(result)
+    if isinstance(result, (tuple, list)):
+        rows = [count_rows(r) for r in result]
+        return rows if any(r is not None for r in rows) else None
+    if isinstance(result, dict):
+        rows = {k: count_rows(v) for k, v in result.items()}
+        rows = {k: r for k, r in rows.items() if r is not None}
+        return rows or None
+    return None
+
+
+class Stage:
+    '''Handle yielded by stage(), to attach a row count from inside the block.'''
+
+    __slots__ = ['rows']
+
+    def __init__(self):
+        self.rows = None
+
+
+_null_stage = Stage()
+
+
+@contextmanager
+def stage(name, rows=None, **info):
+    '''Records one stage of the run:
+
+        with stage('kpi.merge') as s:
+            df = ...
+            s.rows = len(df)
+
+    Extra keyword args (e.g. url=...) are kept in the record.'''
+
+    if not enabled:
+        yield _null_stage
+        return
+
+    handle = Stage()
+    handle.rows = rows
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    stack = _local.stack
+    parent = stack[-1] if stack else None
+    stack.append(name)
+
+    error = None
+    start_ts = time.time()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    rss_start = peak_rss_mb()
+    try:
+        yield handle
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        stack.pop()
+        rss_end = peak_rss_mb()
+        records.append({'name': name,
+                        'parent': parent,
+                        'depth': len(stack),
+                        'pid': os.getpid(),
+                        'start_ts': round(start_ts, 4),
+                        'wall_s': round(time.perf_counter() - start, 4),
+                        'cpu_s': round(time.process_time() - cpu_start, 4),
+                        'peak_rss_mb': rss_end,
+                        'rss_growth_mb': None if rss_end is None else round(rss_end - rss_start, 1),
+                        'rows': handle.rows,
+                        'error': error,
+                        **info})
+
+
+def instrumented(name=None):
+    '''Decorator version of stage(), named after the function by default.
+    The row count is taken from the return value.'''
+
+    def decorator(func):
+        stage_name = name or '{}.{}'.format(func.__module__, func.__name__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with stage(stage_name) as s:
+                result = func(*args, **kwargs)
+                s.rows = count_rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def collect_since(mark):
+    '''Removes & returns the records added since len(records) was `mark`,
+    so a worker process can send its stages back to the parent.'''
+
+    new_records = records[mark:]
+    del records[mark:]
+    return new_records
+
+
+def summarize(stage_records=None):
+    '''Console summary: stages aggregated by name, in order of first start,
+    indented by nesting depth.'''
+
+    stage_records = records if stage_records is None else stage_records
+    summary = {}
+    for record in sorted(stage_records, key=lambda r: (r['start_ts'], r['depth'])):
+        row = summary.setdefault(record['name'], dict(depth=record['depth'], calls=0, wall_s=0., cpu_s=0.,
+                                                       peak_rss_mb=None, rows=None, errors=0))
+        row['calls'] += 1
+        row['wall_s'] += record['wall_s']
+        row['cpu_s'] += record['cpu_s']
+        if record['peak_rss_mb'] is not None:
+            row['peak_rss_mb'] = max(row['peak_rss_mb'] or 0, record['peak_rss_mb'])
+        if isinstance(record['rows'], int):
+            row['rows'] = (row['rows'] or 0) + record['rows']
+        elif record['rows'] is not None and row['rows'] is None:
+            row['rows'] = record['rows']
+        row['errors'] += record['error'] is not None
+
+    lines = ["{:<50} {:>5} {:>9} {:>9} {:>9}  {}".format('stage', 'calls', 'wall s', 'cpu s', 'rss MB', 'rows')]
+    for name, row in summary.items():
+        label = '  ' * row['depth'] + name + (' (failed)' if row['errors'] else '')
+        lines.append("{:<50} {:>5} {:>9.3f} {:>9.3f} {:>9}  {}".format(
+            label[:50], row['calls'], row['wall_s'], row['cpu_s'],
+            '-' if row['peak_rss_mb'] is None else row['peak_rss_mb'],
+            '' if row['rows'] is None else row['rows']))
+
+    return "\n".join(lines)
+
+
+def report(path=report_path, verbose=True):
+    '''Writes the run's stages to a json report & prints a summary.
+    Does nothing when instrumentation is off.'''
+
+    if not enabled or not records:
+        return None
+
+    run = {'created': datetime.now().isoformat(timespec='seconds'),
+           'argv': sys.argv,
+           'pid': os.getpid(),
+           'python': platform.python_version(),
+           'total_wall_s': round(time.time() - _t0, 4),
+           'peak_rss_mb': peak_rss_mb(),
+           'stages': [dict(record, start_s=round(record['start_ts'] - _t0, 4))
+                      for record in sorted(records, key=lambda r: (r['start_ts'], r['depth']))]}
+
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=1)
+
+    if verbose:
+        print(summarize())
+        print("Run report saved to {}".format(path))
+
+    return path
@@ -0,0 +1,46 @@
+## Alert levels & indicator thresholds ##
+
+# Shared by the kpi build & plotly figures (process_kpi) and the
+# single-page dashboard (dashboard.py). Plain data: importing this
+# doesn't need plotly.
+
+source = 'https://www.data.gouv.fr/fr/datasets/donnees-relatives-aux-resultats-des-tests-virologiques-covid-19/'
+
+levels = ['OK',
+          'Vigilance',
+          'Alerte',
+          'Alerte renforcée',
+          'Alerte maximale',
+          'État urgence sanitaire',
+          'Couvre-feu']
+
+# indicators needed for an alert level: any null -> no level
+cols = ['incid_tous', 'incid_70+', 'rea%']
+
+# Ordered rules, first match wins. Each rule is a level and the
+# (column, operator, threshold) conditions that must all be true.
+# Rows matching no rule get default.
+rules = [
+    ("État urgence sanitaire", [('incid_tous', '>', 250.), ('incid_70+', '>', 100.), ('rea%', '>', 60.)]),
+    ("Alerte maximale",        [('incid_tous', '>', 150.), ('incid_70+', '>', 100.), ('rea%', '>', 60.)]),
+    ("Alerte maximale",        [('incid_tous', '>', 250.), ('incid_70+', '>', 100.), ('rea%', '>', 30.)]),
+    ("Alerte renforcée",       [('incid_tous', '>', 150.), ('incid_70+', '>', 50.)]),
+    ("Alerte",                 [('incid_tous', '>', 50.)]),
+    ("OK",                     [('incid_tous', '<=', 50.), ('incid_70+', '<=', 50.), ('rea%', '<=', 30.)]),
+]
+default = 'Vigilance'
+
+# map color of each level
+colors = {'OK': 'rgb(255,245,240)',
+          'Vigilance': 'rgb(252,187,161)',
+          'Alerte': 'rgb(251,106,74)',
+          'Alerte renforcée': 'rgb(203,24,29)',
+          'Alerte maximale': 'rgb(103,0,13)',
+          'État urgence sanitaire': 'rgb(37,37,37)',
+          'Couvre-feu': 'rgb(102, 101, 101)'}
+
+# every threshold the rules compare an indicator to, ascending:
+# drawn as lines on the indicator's plots
+thresholds = {col: sorted({thresh for level, conditions in rules for rule_col, op, thresh in conditions
+                           if rule_col == col})
+              for col in cols}
@@ -0,0 +1,344 @@
+import json
+import argparse
+import time
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs, urlencode
+from urllib.request import urlopen
+from urllib.error import HTTPError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+import fetch_data as fd
+import process_region_data as rd
+import process_test_data as pt
+
+## KPI query service ##
+
+# A long-lived process that loads the saved kpi & dept-age dfs (outputs of
+# pipeline.py) once, indexes their rows by (dept, date) & (region, date),
+# and answers date-range & latest-value queries as JSON. The files are
+# checked at most every reload_check_s, and a df is only reloaded when
+# its file changed. Start it with `python kpi_service.py`, then from a
+# notebook:
+#
+#     import kpi_service as ks
+#     ks.get_kpi(dep='Paris', start='2020-10-01')
+#     ks.get_latest(reg=93)
+#     ks.get_dept_age(dep='13', cols=['pos_100k_rolling'])
+
+host = '127.0.0.1'
+port = 8765
+service_url = 'http://{}:{}'.format(host, port)
+
+reload_check_s = 1.
+
+# dataset -> saved df
+datasets = {'kpi': 'data/latest_kpi.parquet',
+            'dept_age': pt.dept_age_path}
+
+# within a (dept, date), rows are sorted by these too
+row_cols = {'kpi': [],
+            'dept_age': ['age_range']}
+
+# what a latest query looks for, unless a col is given
+latest_cols = {'kpi': 'niveau_global',
+               'dept_age': 'pos_100k_rolling'}
+
+
+def read_kpi_df(path):
+    import process_kpi as kpi  # plotting deps only needed here
+    return kpi.read_kpi(path=path)
+
+def read_dept_age_df(path):
+    return pd.read_parquet(path)
+
+readers = {'kpi': read_kpi_df,
+           'dept_age': read_dept_age_df}
+
+## Index ##
+
+def to_day(value):
+    '''A query date (e.g. '2020-10-01') as datetime64[ns].'''
+
+    try:
+        return pd.Timestamp(value).to_datetime64().astype('datetime64[ns]')
+    except ValueError:
+        raise ValueError("Invalid date: {!r}".format(value))
+
+
+class TableIndex:
+    '''A df's rows sorted by key, then date: each key's rows, and any date
+    range of them, are a slice found by binary search.'''
+
+    def __init__(self, df, key_col, sort_cols=[]):
+        df = df.loc[df[key_col].notna()]
+        self.df = df.sort_values([key_col, 'jour'] + sort_cols, kind='stable').reset_index(drop=True)
+        self.days = fd.parse_days(self.df['jour'])
+
+        keys = self.df[key_col].to_numpy()
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype='int64')
+        ends = np.r_[starts[1:], len(keys)]
+        self.slices = dict(zip(keys[starts].tolist(), zip(starts.tolist(), ends.tolist())))
+
+    def rows(self, key, start=None, end=None):
+        '''Rows of a key, from start to end (inclusive) if given.'''
+
+        first, last = self.slices[key]
+        days = self.days[first:last]
+        lo = first if start is None else first + np.searchsorted(days, to_day(start), 'left')
+        hi = last if end is None else first + np.searchsorted(days, to_day(end), 'right')
+        return self.df.iloc[lo:hi]
+
+    def latest(self, key, col=None):
+        '''Rows of a key's latest date (with a value in col, if given).'''
+
+        first, last = self.slices[key]
+        if col is None:
+            has_value = np.ones(last - first, dtype='bool')
+        else:
+            has_value = self.df[col].iloc[first:last].notna().to_numpy()
+        if not has_value.any():
+            return self.df.iloc[0:0]
+        day = self.days[first + np.flatnonzero(has_value)[-1]]
+        return self.rows(key, day, day)
+
+
+def file_version(path):
+    '''(latest mtime, total size, files) of a file or dir, None if missing.'''
+
+    path = Path(path)
+    if not path.exists():
+        return None
+    files = [p for p in path.rglob('*') if p.is_file()] if path.is_dir() else [path]
+    stats = [p.stat() for p in files]
+    return (max((s.st_mtime_ns for s in stats), default=0), sum(s.st_size for s in stats), len(stats))
+
+
+class KpiStore:
+    '''Indexed datasets, reloaded when their file changes. Queries can be
+    made in-process, or over HTTP through serve(). Thread-safe.'''
+
+    def __init__(self, datasets=datasets):
+        self.datasets = dict(datasets)
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.indexes = {}   # dataset -> {'dep': TableIndex, 'reg': TableIndex}
+        self.info = {}
+        self.last_check = None
+        self.geo = None
+
+    def load(self, name, path):
+        start = time.perf_counter()
+        df = readers[name](path)
+        if 'reg' not in df.columns:
+            geo = self.get_geo()
+            df = df.merge(geo[['libelle_dep', 'reg']], how='left')
+        indexes = {'dep': TableIndex(df, 'libelle_dep', row_cols[name]),
+                   'reg': TableIndex(df, 'reg', ['libelle_dep'] + row_cols[name])}
+        info = {'path': path, 'rows': len(df), 'columns': list(df.columns),
+                'loaded': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'load_s': round(time.perf_counter() - start, 3)}
+        return indexes, info
+
+    def refresh(self, force=False):
+        '''Reloads the datasets whose file changed since they were loaded.
+        A dataset that fails to load (e.g. while it's being rewritten)
+        keeps its previous version until the next check.'''
+
+        now = time.monotonic()
+        if not force and self.last_check is not None and now - self.last_check < reload_check_s:
+            return
+        with self.lock:
+            self.last_check = now
+            for name, path in self.datasets.items():
+                version = file_version(path)
+                if version == self.versions.get(name):
+                    continue
+                if version is None:
+                    self.indexes.pop(name, None)
+                    self.info.pop(name, None)
+                else:
+                    try:
+                        self.indexes[name], self.info[name] = self.load(name, path)
+                    except Exception as e:
+                        print("Could not load {} ({!r}), keeping the previous version".format(path, e))
+                        continue
+                    print("Loaded {} ({} rows)".format(path, self.info[name]['rows']))
+                self.versions[name] = version
+
+    def get_geo(self):
+        if self.geo is None:
+            self.geo = rd.load_geo_index()
+        return self.geo
+
+    def get_index(self, dataset, dep=None, reg=None):
+        '''(index, key) for a dept (name or code) or a region (code or name).'''
+
+        self.refresh()
+        if dataset not in self.datasets:
+            raise KeyError("Unknown dataset {!r}. Datasets: {}".format(dataset, ", ".join(self.datasets)))
+        if dataset not in self.indexes:
+            raise KeyError("{} isn't built yet: run `python pipeline.py {}_df`".format(self.datasets[dataset], dataset))
+        if (dep is None) == (reg is None):
+            raise ValueError("Give either a dep or a reg")
+
+        indexes = self.indexes[dataset]
+        if dep is not None:
+            index, key = indexes['dep'], dep
+            if key not in index.slices:
+                names = dict(zip(self.get_geo()['dep'], self.get_geo()['libelle_dep']))
+                key = names.get(str(dep), dep)
+        else:
+            index, key = indexes['reg'], reg
+            if str(reg).isdigit():
+                key = int(reg)
+            else:
+                codes = dict(zip(self.get_geo()['libelle_reg'], self.get_geo()['reg']))
+                key = codes.get(reg, reg)
+        if key not in index.slices:
+            raise KeyError("No {} rows for {!r}".format(dataset, dep if dep is not None else reg))
+
+        return index, key
+
+    def select(self, df, dataset, cols):
+        if cols is None:
+            return df
+        if isinstance(cols, str):
+            cols = cols.split(',')
+        missing = [col for col in cols if col not in df.columns]
+        if missing:
+            raise ValueError("Unknown column(s): {}".format(", ".join(missing)))
+        id_cols = [col for col in ['libelle_dep', 'jour'] + row_cols[dataset] if col not in cols]
+        return df[id_cols + list(cols)]
+
+    def query(self, dataset='kpi', dep=None, reg=None, start=None, end=None, cols=None):
+        '''Rows of a dept or a region, from start to end (inclusive) if given.'''
+
+        index, key = self.get_index(dataset, dep, reg)
+        return self.select(index.rows(key, start, end), dataset, cols)
+
+    def latest(self, dataset='kpi', dep=None, reg=None, col=None, cols=None):
+        '''Rows of the latest date with a value in col (by default
+        latest_cols[dataset]) for a dept or a region.'''
+
+        index, key = self.get_index(dataset, dep, reg)
+        col = latest_cols[dataset] if col is None else col
+        if col not in index.df.columns:
+            raise ValueError("Unknown column: {}".format(col))
+        return self.select(index.latest(key, col), dataset, cols)
+
+    def status(self):
+        self.refresh()
+        return {name: self.info.get(name, 'not built') for name in self.datasets}
+
+## HTTP API ##
+
+# GET /<dataset>?dep=...|reg=...[&start=YYYY-MM-DD][&end=YYYY-MM-DD][&cols=a,b]
+# GET /<dataset>/latest?dep=...|reg=...[&col=...][&cols=a,b]
+# GET /status
+# Rows come back as {"columns": [...], "data": [[...], ...]}; errors as
+# {"error": ...}, with a 404 for unknown datasets, depts & regions.
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    store = None
+    verbose = False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+
+        try:
+            if parts == ['status']:
+                body = json.dumps(self.store.status())
+            elif len(parts) == 1:
+                body = self.store.query(parts[0], **params).to_json(orient='split', index=False)
+            elif len(parts) == 2 and parts[1] == 'latest':
+                body = self.store.latest(parts[0], **params).to_json(orient='split', index=False)
+            else:
+                raise KeyError("Unknown path {}".format(url.path))
+        except KeyError as e:
+            return self.send(404, json.dumps({'error': e.args[0] if e.args else repr(e)}))
+        except (ValueError, TypeError) as e:
+            return self.send(400, json.dumps({'error': str(e)}))
+
+        self.send(200, body)
+
+    def send(self, code, body):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+def serve(host=host, port=port, store=None, verbose=False):
+    '''Serves a KpiStore over HTTP until interrupted.'''
+
+    store = KpiStore() if store is None else store
+    store.refresh(force=True)
+    handler = type('Handler', (ServiceHandler,), {'store': store, 'verbose': verbose})
+    server = ThreadingHTTPServer((host, port), handler)
+    print("Serving kpis on http://{}:{}/ (Ctrl-C to stop)".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+## Client ##
+
+def request(path, url=service_url, timeout=10, **params):
+    '''GETs url/path with the non-None params. Errors returned by the
+    service are raised as KeyError (404) or ValueError.'''
+
+    params = {k: ','.join(v) if isinstance(v, (list, tuple)) else v for k, v in params.items() if v is not None}
+    try:
+        with urlopen('{}/{}?{}'.format(url, path, urlencode(params)), timeout=timeout) as response:
+            return json.load(response)
+    except HTTPError as e:
+        message = json.load(e).get('error', e.reason)
+        raise (KeyError if e.code == 404 else ValueError)(message)
+
+def to_df(data):
+    return pd.DataFrame(data['data'], columns=data['columns'])
+
+def get_kpi(dep=None, reg=None, start=None, end=None, cols=None, url=service_url):
+    '''Kpi rows of a dept (name or code) or a region (code or name),
+    from start to end ('YYYY-MM-DD', inclusive) if given.'''
+
+    return to_df(request('kpi', url, dep=dep, reg=reg, start=start, end=end, cols=cols))
+
+def get_dept_age(dep=None, reg=None, start=None, end=None, cols=None, url=service_url):
+    '''Dept-age rows of a dept or a region, as get_kpi.'''
+
+    return to_df(request('dept_age', url, dep=dep, reg=reg, start=start, end=end, cols=cols))
+
+def get_latest(dep=None, reg=None, col=None, cols=None, dataset='kpi', url=service_url):
+    '''Rows of the latest date with a value in col (niveau_global for kpis)
+    for a dept or a region.'''
+
+    return to_df(request('{}/latest'.format(dataset), url, dep=dep, reg=reg, col=col, cols=cols))
+
+def get_status(url=service_url):
+    return request('status', url)
+
+
+if __name__ == '__main__':
+    # `python kpi_service.py [--host 127.0.0.1] [--port 8765] [--verbose]`
+    parser = argparse.ArgumentParser(description="Serves the kpi dataset over HTTP.")
+    parser.add_argument('--host', default=host)
+    parser.add_argument('--port', type=int, default=port)
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, verbose=args.verbose)
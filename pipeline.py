@@ -0,0 +1,401 @@
+import os
+import argparse
+import json
+import fnmatch
+import hashlib
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import fetch_data as fd
+import instrument as ins
+import process_region_data as rd
+import process_test_data as pt
+import process_hosp_data as hd
+import process_geo_data as gd
+import process_kpi as kpi
+import dashboard as db
+
+## Stage runner ##
+
+# The kpi build as a graph of stages. Each stage declares the stages it
+# depends on, the sources it reads (urls or local files) and the files it
+# writes. A stage is only rebuilt when it is stale: an output is missing or
+# was changed since its build, or its key changed. The key hashes the
+# stage's spec, the code, its sources' bytes and its dependencies' output
+# files, so a kpi df rebuilt with identical values doesn't re-render any
+# figure. Keys & output hashes are kept in state_path. `python process_kpi.py`
+# runs these stages too, so both entry points share one state.
+
+state_path = 'data/pipeline_state.json'
+
+# any edit to these files makes every stage stale
+code_files = kpi.code_files + ['pipeline.py']
+
+code_path = Path(__file__).resolve().parent
+
+# in_pool stages (figures) run in worker processes, the others in this one.
+# kwargs are also passed to func, but aren't part of the key: they change
+# how a stage is built (e.g. incrementally), not what it builds
+Stage = namedtuple('Stage', ['name', 'func', 'args', 'deps', 'sources', 'outputs', 'in_pool', 'kwargs'],
+                   defaults=[None])
+
+# regions with a kpi_<reg>.html page
+reglist = [11, 24, 27, 28, 32, 44, 52, 53, 75, 76, 84, 93, 94]
+
+## Stage functions ##
+
+def build_reg_ref():
+    '''Region lookup pkls, built if missing. Their inputs (some of them
+    local files, absent once the pkls exist) aren't re-checked on every
+    run: `python process_region_data.py` rebuilds the pkls if they changed.'''
+
+    rd.load_reg_ref_df()
+    rd.load_pop_age_df()
+
+
+def build_kpi(update=False):
+    if update:
+        kpi.update_kpi_df()
+    else:
+        kpi.create_kpi_df()
+
+
+def build_geometry():
+    '''Compact map geometry, prepared if missing (see gd.get_geojson).'''
+
+    for name in gd.geo_sources:
+        gd.get_geojson(name)
+
+
+def build_dept_age():
+    pt.save_dept_age_df(pt.create_dept_age_df())
+
+
+def build_cube():
+    kpi.create_kpi_cube(load_kpi_df())
+
+
+# kpi df read back by figure stages, once per process & saved version
+_kpi_df = {}
+
+def load_kpi_df():
+    '''The saved kpi df (parquet), in the row order create_kpi_df returns.'''
+
+    path = Path('data/latest_kpi.parquet')
+    key = max(p.stat().st_mtime_ns for p in path.rglob('*'))
+    if key not in _kpi_df:
+        _kpi_df.clear()
+        kpi_df = kpi.read_kpi()
+        _kpi_df[key] = kpi_df.sort_values(['libelle_dep', 'jour']).reset_index(drop=True)
+    return _kpi_df[key]
+
+# kpi cube read back by figure stages, once per process & saved version
+_kpi_cube = {}
+
+def load_kpi_cube():
+    '''The saved dept/region/France rollups, indexed by (level, area, jour).'''
+
+    key = Path(kpi.cube_path).stat().st_mtime_ns
+    if key not in _kpi_cube:
+        _kpi_cube.clear()
+        _kpi_cube[key] = kpi.load_kpi_cube()
+    return _kpi_cube[key]
+
+# what each figure stage reads, by the name of the stage writing it
+inputs = {'kpi_df': load_kpi_df,
+          'kpi_cube': load_kpi_cube}
+
+# figure specs: kpi df or cube -> (plotting function, args)
+
+def overview_spec(kpi_df, metric='niveau_global'):
+    latest_df = kpi.get_latest(metric, kpi_df)
+    return kpi.make_overview_map, (metric, latest_df.name, latest_df.query("dom_tom=='False'"))
+
+def alert_history_spec(kpi_df, metric='niveau_global'):
+    return kpi.make_alert_animation, (kpi_df[['libelle_dep', 'jour', 'dom_tom', metric]],)
+
+def trends_spec(cube):
+    return kpi.plot_kpi_trends, (kpi.create_kpi_summary(cube),)
+
+def rea_dc_spec(cube):
+    new_ad = kpi.get_new_admissions().dropna()
+    return kpi.plot_rea_dc, (kpi.create_kpi_summary(cube), hd.hosp_colormap, new_ad)
+
+def reg_kpi_spec(cube, metric):
+    return kpi.plot_reg_kpi, (metric, cube)
+
+def reg_dept_spec(kpi_df, reg):
+    reg_name, reg_df = kpi.make_reg_plot_data(kpi_df.loc[kpi_df['reg']==reg], regs=[reg])[reg]
+    return kpi.make_reg_dept_fig, (reg, reg_df, reg_name, kpi_df['jour'].min(), kpi_df['jour'].max())
+
+def rea_map_spec(kpi_df, map_col):
+    latest_rea = kpi.get_latest('rea%', kpi_df)
+    return kpi.map_rea, (map_col, latest_rea.name, latest_rea.copy())
+
+def render_figure(fname, spec, input_name, *spec_args):
+    func, args = spec(inputs[input_name](), *spec_args)
+    kpi.build_and_save(fname, func, args)
+
+def write_dashboard():
+    db.write_dashboard(load_kpi_df(), load_kpi_cube(), kpi.output_path)
+
+
+def get_stages(update=False):
+    '''Every stage, dependencies first. Built on each call, so that
+    figure outputs follow the current kpi.output_path. update=True builds
+    the kpi df incrementally (kpi.update_kpi_df), when it's stale: both
+    give the same df, so it's not part of the stage's key.
+
+    Returns:
+        dict of stage name -> Stage'''
+
+    kpi_files = ['data/latest_kpi.{}'.format(fmt) for fmt in kpi.save_fmts]
+    stages = [Stage('reg_ref', build_reg_ref, (), [], [], [rd.reg_ref_pkl, rd.pop_age_pkl], False),
+              Stage('kpi_df', build_kpi, (), ['reg_ref'], [pt.url, hd.hosp_url], kpi_files, False, {'update': update}),
+              Stage('dept_age_df', build_dept_age, (), ['reg_ref'], [pt.url], [pt.dept_age_path], False),
+              Stage('kpi_cube', build_cube, (), ['kpi_df'], [hd.hosp_url], [kpi.cube_path], False),
+              Stage('geometry', build_geometry, (), [], [],
+                    [str(gd.prepared_path(name)) for name in gd.geo_sources], False)]
+
+    def figure(fname, spec, *spec_args, sources=[], input_name='kpi_df', deps=[]):
+        return Stage(fname, render_figure, (fname, spec, input_name) + spec_args, [input_name] + deps, sources,
+                     [kpi.output_path + fname], True)
+
+    # maps also depend on the geometry they draw
+    stages += [figure('alerts.html', overview_spec, deps=['geometry']),
+               figure('alerts_history.html', alert_history_spec, deps=['geometry']),
+               figure('kpi_fr_trends.html', trends_spec, input_name='kpi_cube'),
+               figure('kpi_rea_dc_trends.html', rea_dc_spec, sources=[hd.new_patients_url], input_name='kpi_cube')]
+    stages += [figure('kpi_{}_by_reg.html'.format(fname_metric), reg_kpi_spec, metric, input_name='kpi_cube')
+               for metric, fname_metric in [('incid_tous', 'incid_tous'), ('incid_70+', 'incid_70'), ('rea%', 'rea')]]
+    stages += [figure('kpi_{}.html'.format(reg), reg_dept_spec, reg) for reg in reglist]
+    stages += [figure('rea_pct_region.html', rea_map_spec, 'rea%', deps=['geometry']),
+               figure('rea_pct_dept.html', rea_map_spec, 'rea%_dep', deps=['geometry'])]
+    stages += [Stage('dashboard', write_dashboard, (), ['kpi_df', 'kpi_cube'], [],
+                     [kpi.output_path + db.page_fname, kpi.output_path + db.data_fname], True)]
+
+    return {stage.name: stage for stage in stages}
+
+## Helper functions ##
+
+def load_state(path=state_path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_state(state, path=state_path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def get_code_version(files=code_files):
+    h = hashlib.sha256()
+    for fname in files:
+        with open(code_path.joinpath(fname), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def hash_path(path):
+    '''sha256 of a file, or of every file under a dir (e.g. a parquet
+    dataset). None if it doesn't exist. Only subdir names & file contents
+    count: parquet part files get random names on every write.'''
+
+    path = Path(path)
+    if not path.exists():
+        return None
+    if not path.is_dir():
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(fd.blob_chunk), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    files = sorted((str(p.parent.relative_to(path)), hash_path(p)) for p in path.rglob('*') if p.is_file())
+    return hashlib.sha256(repr(files).encode()).hexdigest()
+
+def hash_outputs(stage):
+    return {path: hash_path(path) for path in stage.outputs}
+
+def describe(arg):
+    return arg.__name__ if callable(arg) else repr(arg)
+
+def get_key(stage, state, source_hashes, code_version):
+    '''sha256 of what a stage's outputs depend on.'''
+
+    h = hashlib.sha256()
+    h.update(repr((stage.name, describe(stage.func), [describe(arg) for arg in stage.args], code_version)).encode())
+    for dep in stage.deps:
+        h.update(repr((dep, sorted(state[dep]['outputs'].items()))).encode())
+    for src in stage.sources:
+        h.update(repr((src, source_hashes[src])).encode())
+
+    return h.hexdigest()
+
+def is_stale(stage, key, state):
+    entry = state.get(stage.name)
+    return entry is None or entry['key'] != key or entry['outputs'] != hash_outputs(stage)
+
+def select_stages(targets, stages):
+    '''Target stages (names or glob patterns, e.g. 'kpi_*.html') and every
+    stage they depend on, in dependency order.'''
+
+    selected = set()
+    for target in targets:
+        matches = fnmatch.filter(stages, target)
+        if not matches:
+            raise ValueError("No stage matches {!r}. Stages: {}".format(target, ", ".join(stages)))
+        selected.update(matches)
+
+    needed = set()
+    def add(name):
+        if name not in needed:
+            needed.add(name)
+            for dep in stages[name].deps:
+                add(dep)
+    for name in selected:
+        add(name)
+
+    return [name for name in stages if name in needed], selected
+
+def run_stage(stage):
+    '''Runs one stage. Returns its instrumentation records (sent back by
+    worker processes).'''
+
+    mark = len(ins.records)
+    with ins.stage('pipeline.stage', stage=stage.name):
+        stage.func(*stage.args, **(stage.kwargs or {}))
+    return ins.collect_since(mark)
+
+## Entry point ##
+
+def run(targets=None, jobs=None, force=False, state_path=state_path, update=False):
+    '''Brings the target stages (all by default) up to date, rebuilding
+    only the stale ones. Stages whose dependencies are done run
+    concurrently: figures in up to `jobs` worker processes (default
+    kpi.get_render_jobs(); jobs=1 runs everything serially, in this process).
+
+    force=True rebuilds the targets even if they're up to date (their
+    dependencies are only rebuilt if stale). update=True builds the kpi df
+    incrementally, when it's stale. A failed stage doesn't stop
+    the others, but its dependents are skipped; failures are raised
+    together at the end.
+
+    Returns:
+        dict of stage name -> 'built', 'up to date', 'failed' or 'skipped' '''
+
+    jobs = kpi.get_render_jobs() if jobs is None else jobs
+    stages = get_stages(update)
+    names, selected = select_stages(targets or list(stages), stages)
+
+    # sources are downloaded concurrently, once, into the cache: stages read those files
+    sources = list(dict.fromkeys(src for name in names for src in stages[name].sources))
+    with ins.stage('pipeline.fetch_all'):
+        fd.fetch_all([src for src in sources if src.startswith(('http://', 'https://'))])
+        source_hashes = {src: hash_path(fd.fetch_path(src)) for src in sources}
+
+    code_version = get_code_version()
+    state = load_state(state_path)
+    status = {}
+    errors = []
+    pending = list(names)
+    running = {}
+    pool = None
+
+    def finish(name, key, error):
+        if error is None:
+            outputs = hash_outputs(stages[name])
+            missing = [path for path, digest in outputs.items() if digest is None]
+            if missing:
+                error = FileNotFoundError("not written: {}".format(", ".join(missing)))
+        if error is None:
+            state[name] = {'key': key, 'outputs': outputs}
+            status[name] = 'built'
+            print("Built {}".format(name))
+        else:
+            state.pop(name, None)
+            status[name] = 'failed'
+            errors.append("{}: {!r}".format(name, error))
+            print("Failed {}: {!r}".format(name, error))
+        save_state(state, state_path)
+
+    try:
+        while pending or running:
+            # start every stage whose dependencies are done
+            for name in list(pending):
+                stage = stages[name]
+                if any(dep not in status for dep in stage.deps):
+                    continue
+                pending.remove(name)
+
+                if any(status[dep] in ('failed', 'skipped') for dep in stage.deps):
+                    status[name] = 'skipped'
+                    continue
+
+                key = get_key(stage, state, source_hashes, code_version)
+                if not (force and name in selected) and not is_stale(stage, key, state):
+                    status[name] = 'up to date'
+                    print("Up to date: {}".format(name))
+                    continue
+
+                if stage.in_pool and jobs != 1:
+                    if pool is None:
+                        pool = ProcessPoolExecutor(max_workers=jobs)
+                    running[pool.submit(run_stage, stage)] = (name, key)
+                else:
+                    try:
+                        ins.records.extend(run_stage(stage))
+                        finish(name, key, None)
+                    except Exception as e:
+                        finish(name, key, e)
+                    break  # its dependents may be ready now
+
+            else:
+                if running:
+                    done, not_done = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name, key = running.pop(future)
+                        try:
+                            ins.records.extend(future.result())
+                            finish(name, key, None)
+                        except Exception as e:
+                            finish(name, key, e)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    skipped = [name for name in names if status[name] == 'skipped']
+    if errors:
+        raise RuntimeError("{} stage(s) failed{}:\n{}".format(
+            len(errors), ", skipped {}".format(", ".join(skipped)) if skipped else "", "\n".join(errors)))
+
+    return status
+
+
+if __name__ == '__main__':
+    # `python pipeline.py [stage ...] [--jobs N] [--force] [--update] [--profile]`
+    # e.g. `python pipeline.py rea_pct_dept.html --jobs 4`, `python pipeline.py 'kpi_*.html'`
+    # `python pipeline.py --list` shows every stage & what it depends on
+    parser = argparse.ArgumentParser(description="Brings the kpi build's stages up to date.")
+    parser.add_argument('stages', nargs='*', help="stage names or glob patterns (default: all)")
+    parser.add_argument('--jobs', type=int, help="worker processes for figures (default: RENDER_JOBS or one per CPU)")
+    parser.add_argument('--force', action='store_true', help="rebuild the targets even if up to date")
+    parser.add_argument('--update', action='store_true', help="build the kpi df incrementally")
+    parser.add_argument('--profile', action='store_true', help="record time & memory per stage")
+    parser.add_argument('--list', action='store_true', help="show every stage & what it depends on")
+    args = parser.parse_args()
+
+    if args.profile:
+        ins.enable()
+
+    if args.list:
+        for stage in get_stages().values():
+            print("{:<28} <- {}".format(stage.name, ", ".join(stage.deps + stage.sources) or '-'))
+    else:
+        run(args.stages or None, args.jobs, args.force, update=args.update)
+        print("****** DONE! ******\n")
+        ins.report()
@@ -0,0 +1,251 @@
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+import fetch_data as fd
+import instrument as ins
+
+## Data sources ##
+
+# Geojson for FR depts and regions
+
+dept_geos = 'https://static.data.gouv.fr/resources/carte-des-departements-2-1/20191202-212236/contour-des-departements.geojson'
+#region_geos = 'https://france-geojson.gregoiredavid.fr/repo/regions.geojson'
+region_geos='https://raw.githubusercontent.com/gregoiredavid/france-geojson/master/regions-version-simplifiee.geojson'
+
+geo_sources = {'fr_dept': dept_geos,
+               'fr_region': region_geos}
+
+# Compact copies are kept here, so maps work offline
+# once they've been drawn once.
+geo_path = 'data/geo/'
+
+# Geometry preparation settings. Tolerance is in degrees (0.005 ~ 500 m,
+# invisible on a country-wide map); coordinates are snapped to a
+# quantization x quantization grid over the collection's bounding box.
+simplify_tolerance = 0.005
+quantization = 10000
+keep_props = ['nom', 'code']
+
+# tolerance chosen by the last prepare_geometry call, kept next to the
+# compact files: read_prepared accepts files built with it
+settings_fname = 'settings.json'
+
+## Helper functions ##
+
+def simplify_line(points, tolerance=simplify_tolerance):
+    '''Douglas-Peucker simplification of an (n x 2) array of points.
+    The first & last points are always kept, so rings stay closed.'''
+
+    points = np.asarray(points, dtype='float64')
+    if len(points) < 3 or tolerance <= 0:
+        return points
+
+    keep = np.zeros(len(points), dtype='bool')
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = points[start], points[end]
+        inner = points[start+1:end]
+        ab = b - a
+        norm = np.hypot(*ab)
+        if norm == 0:   # closed ring: distance to the start point
+            dist = np.hypot(*(inner - a).T)
+        else:           # distance to the segment's line
+            dist = np.abs(ab[0] * (inner[:, 1] - a[1]) - ab[1] * (inner[:, 0] - a[0])) / norm
+        i = np.argmax(dist)
+        if dist[i] > tolerance:
+            mid = start + 1 + i
+            keep[mid] = True
+            stack += [(start, mid), (mid, end)]
+
+    return points[keep]
+
+
+def get_polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+def get_bbox(geojson):
+    coords = np.concatenate([np.asarray(ring, dtype='float64')
+                             for feature in geojson['features']
+                             for polygon in get_polygons(feature['geometry'])
+                             for ring in polygon])
+    return coords.min(axis=0), coords.max(axis=0)
+
+
+def compact_geojson(geojson, tolerance=simplify_tolerance, quantization=quantization, keep_props=keep_props):
+    '''Makes a geojson lighter for choropleths:
+      - coordinates snapped to a quantization grid (consecutive duplicates removed),
+        written with just enough decimals for that grid
+      - rings simplified with Douglas-Peucker at `tolerance` degrees;
+        islands & holes that collapse are dropped
+      - feature properties other than keep_props dropped'''
+
+    lo, hi = get_bbox(geojson)
+    step = (hi - lo) / (quantization - 1)
+    decimals = int(np.ceil(-np.log10(step.min()))) + 1
+
+    def prepare_ring(ring):
+        snapped = lo + np.round((np.asarray(ring, dtype='float64') - lo) / step) * step
+        is_new = np.r_[True, (np.diff(snapped, axis=0) != 0).any(axis=1)]
+        ring = simplify_line(snapped[is_new], tolerance)
+        return ring.round(decimals).tolist() if len(ring) >= 4 else None
+
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        polygons = []
+        for polygon in get_polygons(geometry):
+            rings = [prepare_ring(ring) for ring in polygon]
+            if rings[0] is not None:  # exterior ring survived
+                polygons.append([ring for ring in rings if ring is not None])
+        if not polygons:              # never drop a whole feature
+            polygons = get_polygons(geometry)
+
+        if geometry['type'] == 'Polygon':
+            geometry['coordinates'] = polygons[0]
+        else:
+            geometry['coordinates'] = polygons
+
+        feature['properties'] = {k: v for k, v in feature['properties'].items() if k in keep_props}
+
+    return geojson
+
+
+def prepared_path(name, filepath=geo_path):
+    '''Where the compact geojson `name` is saved.'''
+
+    return Path(filepath).joinpath('{}.json'.format(name))
+
+
+@ins.instrumented()
+def build_geojson(name, filepath=geo_path, tolerance=simplify_tolerance):
+    '''Downloads a geojson, compacts it and saves it as data/geo/<name>.json'''
+
+    geojson = json.loads(fd.fetch(geo_sources[name]))
+    geojson = compact_geojson(geojson, tolerance)
+    geojson['prepared_with'] = dict(tolerance=tolerance, quantization=quantization)
+
+    geo_file = prepared_path(name, filepath)
+    geo_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(geo_file, 'w') as f:
+        json.dump(geojson, f, separators=(',', ':'))
+
+    return geojson
+
+
+# loaded geojson, so each file is read at most once per session
+_geojson = {}
+
+def get_tolerance(filepath=geo_path):
+    '''Simplification tolerance in use: the one saved by the last
+    prepare_geometry call in `filepath`, else simplify_tolerance.'''
+
+    settings_file = Path(filepath).joinpath(settings_fname)
+    if not settings_file.exists():
+        return simplify_tolerance
+    with open(settings_file) as f:
+        return json.load(f)['tolerance']
+
+
+def prepare_geometry(tolerance=simplify_tolerance, filepath=geo_path):
+    '''Offline step: (re)builds every compact geojson used by the maps.
+    The tolerance is saved along with them, so later sessions keep
+    using these files instead of rebuilding them at the default.'''
+
+    for name in geo_sources:
+        _geojson[name] = build_geojson(name, filepath, tolerance)
+        print("Saved {}{}.json".format(filepath, name))
+
+    with open(Path(filepath).joinpath(settings_fname), 'w') as f:
+        json.dump(dict(tolerance=tolerance), f)
+
+
+def read_prepared(name, filepath=geo_path, tolerance=None):
+    '''The compact geojson saved on disk, or None if it's missing or
+    was prepared with other settings than `tolerance` (by default, the
+    one in use, see get_tolerance) & quantization.'''
+
+    if tolerance is None:
+        tolerance = get_tolerance(filepath)
+    settings = dict(tolerance=tolerance, quantization=quantization)
+    geo_file = prepared_path(name, filepath)
+    if not geo_file.exists():
+        return None
+    with open(geo_file) as f:
+        geojson = json.load(f)
+    if geojson.get('prepared_with') != settings:
+        return None
+    return geojson
+
+
+def get_geojson(name, filepath=geo_path):
+    '''Returns the compact geojson for 'fr_dept' or 'fr_region'.
+    Loaded on first use: from disk if available (and prepared with the
+    current settings), else built from the source.'''
+
+    if name not in _geojson:
+        geojson = read_prepared(name, filepath)
+        if geojson is None:
+            geojson = build_geojson(name, filepath, get_tolerance(filepath))
+        _geojson[name] = geojson
+
+    return _geojson[name]
+
+
+def get_fr_dept():
+    return get_geojson('fr_dept')
+
+
+def get_fr_region():
+    return get_geojson('fr_region')
+
+
+## Benchmark ##
+
+def benchmark_geometry(name='fr_dept', tolerances=[0, 0.001, 0.005, 0.01]):
+    '''Compares the raw geojson with compact versions at several tolerances:
+    geojson size, size of a choropleth's html, and time to build & serialize
+    that figure (a proxy for the browser's parse & render cost).'''
+
+    import plotly.express as px
+    import plotly.io as pio
+
+    raw = fd.fetch(geo_sources[name])
+    featureidkey = 'properties.nom' if name == 'fr_dept' else 'properties.code'
+    key = featureidkey.split('.')[1]
+
+    results = []
+    for tolerance in [None] + tolerances:
+        geojson = json.loads(raw)
+        if tolerance is not None:
+            geojson = compact_geojson(geojson, tolerance)
+        locations = [feature['properties'][key] for feature in geojson['features']]
+
+        start = time.perf_counter()
+        fig = px.choropleth(geojson=geojson, locations=locations, featureidkey=featureidkey,
+                            color=list(range(len(locations))), projection='mercator')
+        html = pio.to_html(fig, include_plotlyjs='cdn')
+        elapsed = time.perf_counter() - start
+
+        results.append({'tolerance': 'raw' if tolerance is None else tolerance,
+                        'geojson_kb': round(len(json.dumps(geojson, separators=(',', ':'))) / 1024),
+                        'html_kb': round(len(html) / 1024),
+                        'build_s': round(elapsed, 3)})
+
+    for row in results:
+        print(row)
+    return results
+
+
+if __name__=='__main__':
+    prepare_geometry()
+    for name in geo_sources:
+        benchmark_geometry(name)
@@ -1,4 +1,8 @@
+import numpy as np
 import pandas as pd
+import fetch_data as fd
+import instrument as ins
+import process_region_data as rd
 
 
 ## Data sources ##
@@ -37,26 +41,35 @@ hosp_colormap={"hosp": "blue",
             "dc": "black"
            }
 
-def get_hosp_data(url=hosp_url):
-    #Gets French hospital case counts
-    #for covid-19, by day & department.
-    #Used to plot disease progression.
+@ins.instrumented()
+def read_hosp_csv(url=hosp_url, start=None):
+    '''Hospital csv with jour parsed to datetime64 (a few days were
+    in dd/mm/yyyy, see fd.day_formats), for the kpi build. Only the
+    rows from `start` on are kept, if given.'''
 
-    df = pd.read_csv(url, sep = ";")
+    df = fd.read_csv(url, sep = ";")
     df = df.drop(df.loc[df['sexe']==0].index).reindex()  # remove sexe==0 as it's sum of M+F cases
     df['sexe'].replace({1:"m", 2:"f"}, inplace=True) # use more intuitive values too\
 
-    # fix dates with wrong format
-    replace_dict = {'27/06/2020': '2020-06-27',
-                '28/06/2020': '2020-06-28',
-                '29/06/2020': '2020-06-29'}
+    df['jour'] = fd.parse_days(df['jour'])
+    if start is not None:
+        df = df.loc[df['jour'].to_numpy() >= np.datetime64(start)]
+
+    return df
+
+def get_hosp_data(url=hosp_url):
+    #Gets French hospital case counts
+    #for covid-19, by day & department.
+    #Used to plot disease progression.
+    #jour is a 'YYYY-MM-DD' str
 
-    df['jour'] = df['jour'].replace(replace_dict)
+    df = read_hosp_csv(url)
+    df['jour'] = fd.format_days(df['jour'])
 
     return df
 
 def get_hosp_metadata(url=hosp_meta_url):
-    hosp_meta_df = pd.read_csv(url, sep = ";")
+    hosp_meta_df = fd.read_csv(url, sep = ";")
 
     return hosp_meta_df
 
@@ -73,8 +86,8 @@ def get_hosp_metadata(url=hosp_meta_url):
     print(df.tail())'''
 
 
-def display_data_description(df=get_hosp_metadata()):
-    meta_df = get_hosp_metadata(df)
+def display_data_description(url=hosp_meta_url):
+    meta_df = get_hosp_metadata(url)
     print("\n\n=== Column descriptions (meta_df): ===")
     return meta_df
 
@@ -110,13 +123,44 @@ def get_pop_data(csv=pop_csv):
 
     return pop_df
 
-def create_main_df():
-    hosp_df = get_hosp_data()
-    #reg_only_df = get_region_data()
-    reg_ref_df = pd.read_pickle('data/reg_ref_df.pkl')[['reg', 'libelle_reg', 'dep', 'libelle_dep']]
+## Session store ##
+
+# Cleaned hospital df & region lookup, kept in memory so that every
+# create_rea_df call in a session shares one copy (one per `start` date
+# for incremental builds). Call clear_store() to force a fresh download
+# (e.g. in a long-running notebook).
+
+_store = {}
+
+def clear_store():
+    _store.clear()
+
+def get_reg_ref_df():
+    if 'reg_ref_df' not in _store:
+        _store['reg_ref_df'] = rd.load_reg_ref_df()
+    return _store['reg_ref_df']
+
+def get_main_df(start=None):
+    if ('main_df', start) not in _store:
+        _store[('main_df', start)] = create_main_df(start)
+    return _store[('main_df', start)]
+
+@ins.instrumented()
+def create_main_df(start=None):
+    '''Hospital data with each row's dep_id & reg_id (see rd.load_geo_index).
+    Depts missing from the index (and rows without a date) are dropped,
+    as are rows before `start`, if given.
+    Names are left out: add them with rd.attach_geo() when needed.'''
+
+    hosp_df = read_hosp_csv(start=start)
+    geo = rd.load_geo_index()
+
+    dep_ids = rd.get_dep_ids(hosp_df['dep'], geo=geo)
+    known = (dep_ids >= 0) & hosp_df['jour'].notna().to_numpy()
+    df = hosp_df.loc[known].reset_index(drop=True)
+    df.insert(0, 'dep_id', dep_ids[known].astype('int16'))
+    df.insert(1, 'reg_id', geo['reg_id'].to_numpy()[df['dep_id'].to_numpy()])
 
-    #df = reg_only_df.merge(hosp_df)
-    df = reg_ref_df.merge(hosp_df)
     return df
 
 # Nov 3: NOT WORKING!!
@@ -131,28 +175,66 @@ def create_main_df():
     #reg_ref_df = reg_only_df.merge(icu_df, how='left').merge(pop_df, how='left')
     #return reg_ref_df
 
-def create_rea_df(level):
-    '''Get ICU beds for regions'''
+@ins.instrumented()
+def create_rea_dfs(start=None):
+    '''ICU patients vs ICU beds, by dept & by region. Both levels come
+    from a single groupby over the (memoized) hospital df: the region
+    totals are summed from the dept totals. Beds are looked up by
+    position in the geography index, and each region's row is repeated
+    for every dept of the region.
+
+    Returns:
+        dict with 'reg' and 'dep' dfs of rea & ICU_beds, indexed by
+        dep_id & jour (the 'reg' df also has the reg_id), from `start` on'''
+
+    if ('rea_dfs', start) in _store:
+        return _store[('rea_dfs', start)]
+
+    geo = rd.load_geo_index()
+    hosp_df = get_main_df(start)
+    icu_beds = geo['ICU_beds'].to_numpy(dtype='float64')
+    geo_reg_ids = geo['reg_id'].to_numpy()
+
+    dep_rea = hosp_df.groupby(['dep_id', 'jour'])['rea'].sum()
+
+    # by dept
+    dep_df = dep_rea.to_frame()
+    dep_df['ICU_beds'] = icu_beds[dep_rea.index.get_level_values('dep_id')]
+
+    # by region
+    reg_beds = np.bincount(geo_reg_ids, weights=np.nan_to_num(icu_beds))
+    reg_rea = dep_rea.groupby([geo_reg_ids[dep_rea.index.get_level_values('dep_id')],
+                               dep_rea.index.get_level_values('jour')]).sum()
+    reg_ids = reg_rea.index.get_level_values(0).to_numpy()
+
+    # one row per dept of the region: depts sorted by region, so each
+    # region's depts are a slice starting at reg_start
+    deps_by_reg = np.argsort(geo_reg_ids, kind='stable')
+    n_deps = np.bincount(geo_reg_ids)
+    reg_start = np.cumsum(n_deps) - n_deps
+    rows = np.repeat(np.arange(len(reg_rea)), n_deps[reg_ids])
+    nth_dep = np.arange(len(rows)) - np.repeat(np.cumsum(n_deps[reg_ids]) - n_deps[reg_ids], n_deps[reg_ids])
+    dep_ids = deps_by_reg[reg_start[reg_ids[rows]] + nth_dep]
+
+    reg_df = pd.DataFrame({'reg_id': reg_ids[rows],
+                           'rea': reg_rea.to_numpy()[rows],
+                           'ICU_beds': reg_beds[reg_ids[rows]]},
+                          index=pd.MultiIndex.from_arrays([dep_ids.astype('int16'),
+                                                           reg_rea.index.get_level_values(1)[rows]],
+                                                          names=['dep_id', 'jour']))
 
-    #reg_ref_df = create_region_df() 
-    reg_ref_df = pd.read_pickle('data/reg_ref_df.pkl')
-    hosp_df = create_main_df()
+    _store[('rea_dfs', start)] = {'reg': reg_df, 'dep': dep_df}
+    return _store[('rea_dfs', start)]
 
-    if level=='reg':
-        icu_beds = reg_ref_df.groupby('libelle_reg')['ICU_beds'].sum().reset_index()
-        rea_df = hosp_df.groupby(['reg','libelle_reg', 'jour'])['rea'].sum().reset_index()
-        rea_df = rea_df.merge(icu_beds)\
-            .merge(reg_ref_df[['reg','libelle_reg', 'libelle_dep']])\
-            .set_index(['libelle_dep', 'jour'])
-        rea_df['reg'] = rea_df['reg'].astype('int')
+def create_rea_df(level, start=None):
+    '''Get ICU beds for regions ('reg') or depts ('dep'), indexed by dep_id & jour,
+    for the days from `start` on (all by default).
+    Add names with rd.attach_geo(rea_df.reset_index()).'''
 
-    elif level=='dep':
-        icu_beds = reg_ref_df.groupby('libelle_dep')['ICU_beds'].max().reset_index()
-        rea_df = hosp_df.groupby(['libelle_reg', 'libelle_dep', 'jour'])['rea'].sum().reset_index()
-        rea_df = rea_df.merge(icu_beds).set_index(['libelle_dep', 'jour'])
-        #rea_df['rea%'] = pt.to_percent(rea_df['rea'], rea_df['ICU_beds'])
+    rea_df = create_rea_dfs(start)[level]
+    #rea_df['rea%'] = pt.to_percent(rea_df['rea'], rea_df['ICU_beds'])
 
-    return rea_df
+    return rea_df.copy() # callers add columns; keep the stored df clean
 
 
 if __name__=='__main__':
@@ -160,7 +242,7 @@ if __name__=='__main__':
     ## put it all together ##
 
     df = create_main_df()
-    reg_ref_df = create_region_df()
+    reg_ref_df = rd.load_reg_ref_df()
     #meta_df = display_data_description()
 
     print('\n\nMAIN DATAFRAME:\n')
@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from datetime import datetime
@@ -16,25 +23,28 @@ pio.templates.default = "plotly_white"
 
 # library for mapping
 import plotly.express as px
-from urllib.request import urlopen
-import json
 
 # hide annoying repeated deprec warnings (statsmodel issue)
 import warnings
 warnings.simplefilter('once', category=UserWarning)
 
 # load regional 'lookup' df
-#import process_region_data as rd
+import process_region_data as rd
 
+import fetch_data as fd
+import instrument as ins
+import dashboard as db
+import process_geo_data as gd
 import process_test_data as pt
 import process_hosp_data as hd
+import kpi_rules as kr
 
 #curfew_cities = ['Paris', 'Rouen', 'Marseille', 'Lyon', 'Montpellier', 'Saint-Etienne', 'Montpellier']
 #metro_df_wide.reset_index('class_age')[curfew_cities]
 
 ### Main data source urls ###
 
-source = 'https://www.data.gouv.fr/fr/datasets/donnees-relatives-aux-resultats-des-tests-virologiques-covid-19/'
+source = kr.source
 url = "https://www.data.gouv.fr/fr/datasets/r/406c6a23-e283-4300-9484-54e78c8ae675"
 meta_url = "https://www.data.gouv.fr/fr/datasets/r/39aaad1c-9aac-4be8-96b2-6d001f892b34"
 
@@ -46,10 +56,10 @@ rea_metro_src = 'https://www.data.gouv.fr/en/datasets/indicateurs-de-lactivite-e
 
 
 ### Geojson for FR depts and regions ###
+# loaded lazily by the map functions, see process_geo_data
 
-dept_geos = 'https://static.data.gouv.fr/resources/carte-des-departements-2-1/20191202-212236/contour-des-departements.geojson'
-#region_geos = 'https://france-geojson.gregoiredavid.fr/repo/regions.geojson'
-region_geos='https://raw.githubusercontent.com/gregoiredavid/france-geojson/master/regions-version-simplifiee.geojson'
+dept_geos = gd.dept_geos
+region_geos = gd.region_geos
 commune_geos = 'https://public.opendatasoft.com/explore/dataset/geoflar-communes-2013/download/?format=geojson&timezone=Europe/Berlin&lang=en'
 
 #epci_communes = 'https://www.data.gouv.fr/fr/datasets/contours-des-epci-2015/'
@@ -59,13 +69,6 @@ villes = 'https://public.opendatasoft.com/explore/dataset/code-insee-postaux-geo
 curfew_cities = "data/fr_curf_cities.pkl"
 
 
-with urlopen(dept_geos) as response:
-    fr_dept = json.load(response)
-
-with urlopen(region_geos) as response:
-    fr_region = json.load(response)
-
-
 ### Global variables
 
 # Get lookup info locally
@@ -77,7 +80,7 @@ path = 'data/'
 boilerplate_fr = dict(main_subtitle="Faire glisser le curseur pour l'infobulle",
                    legend_subtitle="Cliquer pour <br>masquer ou afficher")
 
-# reg_ref_df = pd.read_pickle(path + 'reg_ref_df.pkl')
+# reg_ref_df = rd.load_reg_ref_df()
 
 
 ### Helper functions ###
@@ -85,8 +88,16 @@ boilerplate_fr = dict(main_subtitle="Faire glisser le curseur pour l'infobulle",
 # create df for latest data only
 
 def get_latest(col, df):
-    latest_date = df['jour'].loc[df[col].notna()].max()
-    latest_df = df.query('jour==@latest_date').drop('jour', axis=1)
+    # dates are compared as datetimes, once per distinct day
+    day_codes, uniques = pd.factorize(df['jour'])
+    with_data = np.unique(day_codes[df[col].notna().to_numpy() & (day_codes >= 0)])
+    if not len(with_data):
+        latest_df = df.iloc[:0].drop('jour', axis=1)
+        latest_df.name = np.nan
+        return latest_df
+    latest_code = with_data[np.argmax(fd.parse_days(uniques)[with_data])]
+    latest_date = uniques[latest_code]
+    latest_df = df.loc[day_codes == latest_code].drop('jour', axis=1)
 
     ## no longer relevant - DELETE?
     #if latest_date > '2020-10-14': # when curfews started
@@ -163,7 +174,57 @@ def assign_overall_alert(row):
      #   status = row['incid_tous_alerte']
 
 
-def save_df(df, fmt):
+### Alert level rules ###
+
+# levels, rules & thresholds are defined in kpi_rules, shared with the dashboard
+alert_levels = kr.levels
+
+# columns of the saved kpi df
+kpi_cols = ['reg', 'libelle_reg', 'libelle_dep', 'jour', 'dom_tom',
+            'incid_tous', 'incid_70+', 'rea%', 'rea%_dep', 'niveau_global']
+
+# indicators needed for an alert level: any null -> no level
+alert_cols = kr.cols
+
+alert_rules = kr.rules
+default_alert = kr.default
+
+rule_ops = {'>': np.greater,
+            '>=': np.greater_equal,
+            '<': np.less,
+            '<=': np.less_equal}
+
+
+def assign_alert_levels(df, rules=alert_rules, default=default_alert,
+                        required_cols=alert_cols, levels=alert_levels):
+    '''Vectorized version of assign_overall_alert: evaluates the ordered
+    rules over whole columns and returns an ordered Categorical.'''
+
+    values = {col: df[col].to_numpy(dtype='float64') for col in required_cols}
+    masks = [np.logical_and.reduce([rule_ops[op](values[col], thresh) for col, op, thresh in conditions])
+             for level, conditions in rules]
+    codes = [levels.index(level) for level, conditions in rules]
+
+    level_codes = np.select(masks, codes, default=levels.index(default))
+
+    # no level at all when an indicator is missing
+    is_null = np.logical_or.reduce([np.isnan(v) for v in values.values()])
+    level_codes[is_null] = -1
+
+    alert = pd.Categorical.from_codes(level_codes, categories=levels, ordered=True)
+    return alert
+
+
+# formats written by create_kpi_df: csv for humans, parquet for everything else
+save_fmts = ['csv', 'parquet']
+
+@ins.instrumented()
+def save_df(df, fmt, partition_by='reg'):
+    '''Saves the kpi df as data/latest_kpi.<fmt>. 'parquet' writes a
+    compressed dataset partitioned by `partition_by` ('reg' or 'jour'),
+    'feather' a single compressed file. Unlike pkl, both can be read
+    back with any pandas version, and only the needed columns/rows.'''
+
     latest_date = df['jour'].loc[df['niveau_global'].notnull()].max()
     latest_date = latest_date.replace("-","_")
     fname = 'latest_kpi.{}'.format(fmt)
@@ -175,83 +236,389 @@ def save_df(df, fmt):
     elif fmt=='csv':
         df.to_csv(path, index=False)
         print('Saved to {}'.format(path))
+    elif fmt=='parquet':
+        # partitions are appended to, so clear the previous dataset first
+        shutil.rmtree(path, ignore_errors=True)
+        df.to_parquet(path, index=False, compression='zstd', partition_cols=[partition_by])
+        print('Saved to {}'.format(path))
+    elif fmt=='feather':
+        df.reset_index(drop=True).to_feather(path, compression='zstd')
+        print('Saved to {}'.format(path))
+    else:
+        print("Unrecognized format. Enter 'csv', 'pkl', 'parquet' or 'feather'")
+
+
+def read_kpi(columns=None, filters=None, fmt='parquet', path=None):
+    '''Reads a saved kpi df (by default data/latest_kpi.<fmt>). Only `columns`
+    are loaded, and with parquet, `filters` are pushed down to skip
+    partitions & row groups, e.g.
+        read_kpi(['libelle_dep', 'niveau_global'], filters=[('jour', '==', '2020-12-01')])
+        read_kpi(filters=[('reg', '==', 84)])'''
+
+    if path is None:
+        path = 'data/latest_kpi.{}'.format(fmt)
+
+    if fmt=='parquet':
+        df = pd.read_parquet(path, columns=columns, filters=filters)
+        # partition column comes back last & as a category
+        if 'reg' in df.columns:
+            df['reg'] = df['reg'].astype('int')
+        if 'jour' in df.columns and df['jour'].dtype.name == 'category':
+            df['jour'] = df['jour'].astype('str')
+        if columns is None:
+            df = df[[col for col in kpi_cols if col in df.columns]]
+    elif fmt=='feather':
+        df = pd.read_feather(path, columns=columns)
+    elif fmt=='pkl':
+        df = pd.read_pickle(path)
+        if columns is not None:
+            df = df[columns]
     else:
-        print("Unrecognized format. Enter 'csv' or 'pkl'")
+        print("Unrecognized format. Enter 'parquet', 'feather' or 'pkl'")
+        return None
+
+    if 'niveau_global' in df.columns:
+        df['niveau_global'] = pd.Categorical(df['niveau_global'], categories=alert_levels, ordered=True)
+
+    return df
+
+
+def lookback_start(since, n=7):
+    '''First source date needed to compute the kpis from `since` on.
+    Age-based rolling metrics are rolled twice (rolling mean by age,
+    then the 70+ rolling sum), hence 2 x (n-1) days of lookback.'''
+
+    start = pd.to_datetime(since) - pd.Timedelta(days=2 * (n-1))
+    return start
+
+
+def get_rea_seed(prev_df, since, geo=None):
+    '''Last rea% of each dept (by dep_id) before `since` in a previous kpi
+    df, NaN if none. It's already forward filled, so it's what a full
+    build would carry over into the days of an incremental one.'''
 
+    geo = rd.load_geo_index() if geo is None else geo
 
+    prev_rea = prev_df.loc[(prev_df['jour'] < since) & prev_df['rea%'].notna()]
+    last_rea = prev_rea.sort_values('jour').groupby('libelle_dep')['rea%'].last()
+    dep_ids = rd.get_dep_ids(last_rea.index, key='libelle_dep', geo=geo)
+    known = dep_ids >= 0
+
+    rea_seed = np.full(len(geo), np.nan)
+    rea_seed[dep_ids[known]] = last_rea.to_numpy()[known]
+
+    return rea_seed
+
+
+@ins.instrumented()
+def build_kpi_df(since=None, rea_seed=None):
+    '''Computes the kpi df. If `since` (a 'YYYY-MM-DD' date) is given,
+    sources are only read from the dates needed for the rows from
+    `since` on, and only those rows are returned. rea% is then forward
+    filled from rea_seed (see get_rea_seed), if given, as in a full build:
+    without it, a rea% gap can only be filled from lookback_start on.'''
+
+    start = None if since is None else lookback_start(since)
+
+    # create covid testing dfs - testing csv is parsed only once,
+    # and rows before `start` are skipped as it's read
+    with ins.stage('kpi.testing'):
+        df, age_df = pt.create_testing_dfs(start)
+
+    with ins.stage('kpi.rolling') as s:
+        df = pt.create_rolling_cols(df)
+        s.rows = len(df)
+
+    # Get incidence rate for 70+, as a (day x dept) array
+    with ins.stage('kpi.incid_70'):
+        dept_age_grid = pt.create_dept_age_grid(age_df)
+        del age_df
+        older_incid = pt.calc_older_incid_grid(dept_age_grid)
+        age_days = np.asarray(dept_age_grid['days'])
+        del dept_age_grid
+
+    # Get ICU % saturation by region
+    with ins.stage('kpi.rea'):
+        rea_df = hd.create_rea_df('reg', start)
+        rea_df['rea%'] = pt.to_percent(rea_df['rea'], rea_df['ICU_beds'])
+        rea_pct = rea_df['rea%'].reset_index()
+
+        # to help clarify curfew decisions,
+        # include ICU % saturation by department as well
+        dep_rea_df = hd.create_rea_df('dep', start)
+        dep_rea_df['rea%_dep'] = pt.to_percent(dep_rea_df['rea'], dep_rea_df['ICU_beds'])
+        dep_rea_pct = dep_rea_df['rea%_dep'].reset_index()
+
+    # add to testing df: each kpi is scattered into a (day x dept) grid
+    # at its (jour, dep_id) cells. As with the former outer merges, a kpi
+    # row is any cell that has a row in one of the sources.
+    with ins.stage('kpi.merge') as s:
+        geo = rd.load_geo_index()
+
+        has_incid70 = ~(np.isnan(older_incid['Under 70']) & np.isnan(older_incid['70+']))
+        incid_days, incid_deps = np.nonzero(has_incid70)
+
+        # (jour, dep_id, kpi col, values) of each source
+        sources = [(df['jour'].to_numpy(), df['dep_id'].to_numpy(), 'incid_tous', df['rolling_pos_100k'].to_numpy()),
+                   (rea_pct['jour'].to_numpy(), rea_pct['dep_id'].to_numpy(), 'rea%', rea_pct['rea%'].to_numpy()),
+                   (dep_rea_pct['jour'].to_numpy(), dep_rea_pct['dep_id'].to_numpy(), 'rea%_dep', dep_rea_pct['rea%_dep'].to_numpy()),
+                   (age_days[incid_days], incid_deps, 'incid_70+', older_incid['70+'][incid_days, incid_deps])]
+
+        days = np.unique(np.concatenate([jour for jour, dep_ids, col, values in sources]))
+        shape = (len(days), len(geo))
+        present = {}
+        kpi_grid = {}
+        for jour, dep_ids, col, values in sources:
+            codes = (np.searchsorted(days, jour), dep_ids)
+            present[col] = np.zeros(shape, dtype='bool')
+            present[col][codes] = True
+            kpi_grid[col] = np.full(shape, np.nan)
+            kpi_grid[col][codes] = values
+
+        # backfill rea% - for cases like Oct 15 missing data from rea only
+        # doing this before creating 'niveau global' ensures
+        # all 3 kpi are used for the alert label
+        if rea_seed is None:
+            kpi_grid['rea%'] = pd.DataFrame(kpi_grid['rea%']).ffill().to_numpy()
+        else:
+            # seed row before the first day, dropped once filled
+            seeded = np.vstack([rea_seed, kpi_grid['rea%']])
+            kpi_grid['rea%'] = pd.DataFrame(seeded).ffill().to_numpy()[1:]
+
+        # rows sorted by dept name, then day
+        dep_order = np.argsort(geo['libelle_dep'].to_numpy(), kind='stable')
+        is_row = np.logical_or.reduce(list(present.values()))
+        if since is not None:
+            is_row &= (days >= pd.to_datetime(since).to_datetime64())[:, None]
+        dep_pos, day_idx = np.nonzero(is_row[:, dep_order].T)
+        dep_ids = dep_order[dep_pos]
+
+        # days are datetime64 up to here, 'YYYY-MM-DD' in the output
+        kpi_df = pd.DataFrame({'dep_id': dep_ids, 'jour': fd.format_days(days)[day_idx]})
+        # dom_tom comes with the testing data, as before
+        dom_tom = geo['dom_tom'].astype('str').to_numpy(dtype='object')[dep_ids]
+        kpi_df['dom_tom'] = np.where(present['incid_tous'][day_idx, dep_ids], dom_tom, np.nan)
+        for col in ['incid_tous', 'incid_70+', 'rea%', 'rea%_dep']:
+            kpi_df[col] = kpi_grid[col][day_idx, dep_ids]
+
+        # names only now, for output
+        kpi_df = rd.attach_geo(kpi_df, ['reg', 'libelle_reg', 'libelle_dep'], geo=geo)
+        kpi_df = kpi_df[kpi_cols[:-1]]
+        s.rows = len(kpi_df)
+
+    # create new cols for alert labels
+    #kpi_df = assign_alert_level(kpi_df)
+    with ins.stage('kpi.alerts', rows=len(kpi_df)):
+        kpi_df['niveau_global'] = assign_alert_levels(kpi_df)
+
+    return kpi_df
+
+
+@ins.instrumented()
 def create_kpi_df(rea_level='reg'):
     '''Adds "incid_70" and "rea%"" to main df, creates alert str columns for
     all 3 indicators, as well as a "niveau_global" column. The returned
     df is used by all indicator maps.'''
 
-    # create covid testing df
-    df = pt.create_testing_df()
-    df = pt.create_rolling_cols(df)
-    df['reg'] = df['reg'].astype('int')
+    kpi_df = build_kpi_df()
 
-    # Get incidence rate for 70+
-    older_incid = pt.calc_older_incid()
-    incid70 = older_incid['70+'].reset_index()
+    for fmt in save_fmts:
+        save_df(kpi_df, fmt)
 
-    # Get ICU % saturation by region
-    rea_df = hd.create_rea_df('reg')
-    rea_df['rea%'] = pt.to_percent(rea_df['rea'], rea_df['ICU_beds'])
-    rea_pct = rea_df[['reg', 'libelle_reg','rea%']].reset_index()
-
-    # to help clarify curfew decisions,
-    # include ICU % saturation by department as well
-    dep_rea_df = hd.create_rea_df('dep')
-    dep_rea_df['rea%_dep'] = pt.to_percent(dep_rea_df['rea'], dep_rea_df['ICU_beds'])
-    dep_rea_pct = dep_rea_df['rea%_dep'].reset_index()
-
-    # add to testing df
-    kpi_list = [rea_pct, dep_rea_pct, incid70]
-    for kpi in kpi_list:
-        df = df.merge(kpi, how='outer')
-
-    # backfill rea% - for cases like Oct 15 missing data from rea only
-    # doing this before creating 'niveau global' ensures
-    # all 3 kpi are used for the alert label
-    df['rea%'].fillna(method='pad', inplace=True)
-
-    # streamline df - TODO: test keeping these after all
-    keep_cols = ['reg','libelle_reg','libelle_dep','jour', 'dom_tom', 'rolling_pos_100k',
-                '70+', 'rea%', 'rea%_dep']
-
-    kpi_df = df[keep_cols]
-    kpi_df.columns = ['reg','libelle_reg','libelle_dep', 'jour','dom_tom', 'incid_tous', 'incid_70+',
-                        'rea%', 'rea%_dep']
-    kpi_df = kpi_df.set_index(['reg','libelle_reg','libelle_dep', 'jour'], drop=True)
+    return kpi_df
 
-    # create new cols for alert labels
-    #kpi_df = assign_alert_level(kpi_df)
-    kpi_df['niveau_global'] = kpi_df.apply(assign_overall_alert, axis=1)
-    kpi_df['niveau_global'] = pd.Categorical(kpi_df['niveau_global'],
-                                             categories=['OK',
-                                                         'Vigilance',
-                                                         'Alerte',
-                                                         'Alerte renforcée',
-                                                         'Alerte maximale',
-                                                         'État urgence sanitaire',
-                                                         'Couvre-feu'],
-                                            ordered=True)
 
+@ins.instrumented()
+def update_kpi_df(fmt='parquet'):
+    '''Incremental version of create_kpi_df: loads the previous kpi df
+    and only recomputes the days after its last complete day (i.e. with
+    a niveau_global). Falls back to a full build if there's no previous df.'''
+
+    try:
+        prev_df = read_kpi(fmt=fmt)
+    except FileNotFoundError:
+        return create_kpi_df()
+
+    # latest days may be partial (e.g. rea% but no incidence yet),
+    # so everything after the last complete day is recomputed
+    last_complete = prev_df['jour'].loc[prev_df['niveau_global'].notnull()].max()
+    since = (pd.to_datetime(last_complete) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+
+    new_df = build_kpi_df(since, rea_seed=get_rea_seed(prev_df, since))
+    if new_df.empty:
+        print("No new data since {}".format(last_complete))
+        return prev_df
 
-    kpi_df = kpi_df.sort_values(['libelle_dep', 'jour']).reset_index()
+    print("Adding {} new day(s) of kpis".format(new_df['jour'].nunique()))
+    kpi_df = pd.concat([prev_df.loc[prev_df['jour'] < since], new_df], ignore_index=True)
+    kpi_df = kpi_df.sort_values(['libelle_dep', 'jour']).reset_index(drop=True)
 
-    for fmt in ['csv','pkl']:
+    for fmt in save_fmts:
         save_df(kpi_df, fmt)
 
     return kpi_df
 
-## Redundant??
-def get_geojson(dept_geos, region_geos):
+### Geographic rollups ###
+
+# Every indicator, by dept, region & France (all, metro & DOM-TOM), computed
+# once from the kpi df. A rate is rolled up as a ratio of sums: each dept's
+# value is weighted by its denominator, so a region's incidence is its
+# depts' 7-day positives per 100k of their total population, and its rea%
+# their ICU patients over their ICU beds. Depts without a value (or
+# denominator) on a day are left out of that day's totals.
+
+cube_path = 'data/kpi_cube.parquet'
+
+# cube rate -> (dept value col, dept denominator, scale)
+cube_rates = {'incid_tous': ('incid_tous', 'population', 100000),
+              'incid_70+': ('incid_70+', 'population_70+', 100000),
+              'rea%': ('rea%_dep', 'ICU_beds', 100)}
+
+# cube count -> rate it's the numerator of: 7-day positives
+cube_counts = {'pos_7d': 'incid_tous'}
+
+# + ICU patients, summed from the hospital data's counts
+cube_cols = ['level', 'area', 'libelle', 'jour'] + list(cube_rates) + list(cube_counts) + ['rea']
+
+
+def get_cube_weights(geo=None):
+    '''Dept denominators of the cube rates, by dep_id.'''
+
+    geo = rd.load_geo_index() if geo is None else geo
+
+    pop_age_df = rd.load_pop_age_df()
+    pop_dep_ids = rd.get_dep_ids(pop_age_df.index.get_level_values('dep'), geo=geo)
+    known = pop_dep_ids >= 0
+    pop_70 = np.full(len(geo), np.nan)
+    pop_70[pop_dep_ids[known]] = pop_age_df[pt.older_ages].sum(axis=1).to_numpy()[known]
+
+    return {'population': geo['population'].to_numpy(dtype='float64'),
+            'population_70+': pop_70,
+            'ICU_beds': geo['ICU_beds'].to_numpy(dtype='float64')}
+
+
+@ins.instrumented()
+def build_kpi_cube(kpi_df):
+    '''Rolls the dept rows of the kpi df up to regions & France.
+
+    Rates are ratios of sums: e.g. a region's incid_tous is its depts'
+    7-day positives per 100k of their population, not the mean of the
+    dept rates. A dept without a denominator only counts at dept level.
+
+    Returns:
+        long df of cube_cols: one row per level, area & day with a value.
+        area is the dept code, the region code, or 'fr', 'metro' & 'dom_tom'.'''
+
+    geo = rd.load_geo_index()
+    weights = get_cube_weights(geo)
+
+    dep_ids = rd.get_dep_ids(kpi_df['libelle_dep'], key='libelle_dep', geo=geo)
+    rows = np.flatnonzero(dep_ids >= 0)
+    dep_ids = dep_ids[rows]
+    day_codes, days = pd.factorize(kpi_df['jour'].to_numpy()[rows], sort=True)
+
+    # dept values & numerators (value x denominator)
+    values = {}
+    numerators = {}
+    for col, (dep_col, weight, scale) in cube_rates.items():
+        values[col] = kpi_df[dep_col].to_numpy(dtype='float64')[rows]
+        numerators[col] = values[col] * weights[weight][dep_ids] / scale
+
+    # ICU patients by dept & day, as reported, of the depts with ICU beds (as for rea%)
+    rea_df = hd.create_rea_df('dep')
+    rea_dep_ids = rea_df.index.get_level_values('dep_id').to_numpy()
+    rea_day_codes = pd.Index(fd.parse_days(days)).get_indexer(rea_df.index.get_level_values('jour'))
+    rea_known = (rea_day_codes >= 0) & (weights['ICU_beds'][rea_dep_ids] > 0)
+    rea_dep_ids, rea_day_codes = rea_dep_ids[rea_known], rea_day_codes[rea_known]
+    rea_counts = rea_df['rea'].to_numpy(dtype='float64')[rea_known]
+
+    regs = geo.drop_duplicates('reg_id').sort_values('reg_id')
+    # (level, area of each dept (by dep_id), area codes, area names)
+    groupings = [('dep', np.arange(len(geo)), geo['dep'].to_numpy(), geo['libelle_dep'].to_numpy()),
+                 ('reg', geo['reg_id'].to_numpy(), regs['reg'].astype('str').to_numpy(), regs['libelle_reg'].to_numpy()),
+                 ('fr', np.zeros(len(geo), dtype='int64'), np.array(['fr']), np.array(['France'])),
+                 ('fr', geo['dom_tom'].to_numpy().astype('int64'),
+                  np.array(['metro', 'dom_tom']), np.array(['France métropolitaine', 'DOM-TOM']))]
+
+    level_dfs = []
+    for level, dep_areas, areas, names in groupings:
+        row_areas = dep_areas[dep_ids]
+        shape = (len(areas), len(days))
+        cube = {}
+        for col, (dep_col, weight, scale) in cube_rates.items():
+            weight_values = weights[weight][dep_ids]
+            valid = ~np.isnan(values[col]) & (weight_values > 0)
+            codes = (row_areas[valid], day_codes[valid])
+
+            num = np.zeros(shape)
+            den = np.zeros(shape)
+            np.add.at(num, codes, numerators[col][valid])
+            np.add.at(den, codes, weight_values[valid])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cube[col] = np.where(den > 0, num * scale / den, np.nan)
+            if level == 'dep':
+                # a dept's own value, even without a denominator
+                has_value = ~np.isnan(values[col])
+                cube[col] = np.full(shape, np.nan)
+                cube[col][row_areas[has_value], day_codes[has_value]] = values[col][has_value]
+            for count, rate in cube_counts.items():
+                if rate == col:
+                    cube[count] = np.where(den > 0, num, np.nan)
+
+        # on the days the area has a rea% & reported counts
+        rea_codes = (dep_areas[rea_dep_ids], rea_day_codes)
+        rea = np.zeros(shape)
+        np.add.at(rea, rea_codes, rea_counts)
+        reported = np.zeros(shape, dtype='bool')
+        reported[rea_codes] = True
+        cube['rea'] = np.where(np.isnan(cube['rea%']) | ~reported, np.nan, rea)
+
+        present = np.logical_or.reduce([~np.isnan(cube[col]) for col in cube_rates])
+        area_idx, day_idx = np.nonzero(present)
+        level_df = pd.DataFrame({'level': level,
+                                 'area': areas[area_idx],
+                                 'libelle': names[area_idx],
+                                 'jour': fd.format_days(days[day_idx])})
+        for col in cube_rates:
+            level_df[col] = cube[col][area_idx, day_idx].round(2)
+        for count in list(cube_counts) + ['rea']:
+            level_df[count] = cube[count][area_idx, day_idx].round(0)
+        level_dfs.append(level_df)
+
+    return pd.concat(level_dfs, ignore_index=True)[cube_cols]
+
+
+def index_kpi_cube(cube):
+    '''Cube indexed by (level, area, jour), e.g.
+        cube.loc[('fr', 'metro')]             # France métropolitaine, by day
+        cube.loc['reg']                       # every region, by day
+        cube.loc[('dep', '13'), 'rea%']'''
+
+    return cube.set_index(['level', 'area', 'jour']).sort_index()
+
+
+@ins.instrumented()
+def create_kpi_cube(kpi_df=None, path=cube_path):
+    '''Builds the rollup cube from the kpi df (by default the saved
+    one), saves it to `path` & returns it indexed.'''
+
+    if kpi_df is None:
+        kpi_df = read_kpi()
+    cube = build_kpi_cube(kpi_df)
+    cube.to_parquet(path, index=False, compression='zstd')
+    print('Saved to {}'.format(path))
+
+    return index_kpi_cube(cube)
+
+
+def load_kpi_cube(path=cube_path):
+    return index_kpi_cube(pd.read_parquet(path))
 
-    with urlopen(dept_geos) as response:
-        fr_dept = json.load(response)
+## Redundant??
+def get_geojson():
 
-    with urlopen(region_geos) as response:
-        fr_region = json.load(response)
+    fr_dept = gd.get_fr_dept()
+    fr_region = gd.get_fr_region()
 
     return fr_dept, fr_region
 
@@ -271,13 +638,7 @@ def make_overview_colormap(kpi_df):
 ### Map functions ###
 
 # for mapping alerts
-colormap = {'OK': 'rgb(255,245,240)',
- 'Vigilance': 'rgb(252,187,161)',
- 'Alerte': 'rgb(251,106,74)',
- 'Alerte renforcée': 'rgb(203,24,29)',
- 'Alerte maximale': 'rgb(103,0,13)',
- 'État urgence sanitaire': 'rgb(37,37,37)',
- 'Couvre-feu': 'rgb(102, 101, 101)'}
+colormap = kr.colors
 
 label_trans = {#'rea%': '% occup. réa (rég)',
                #'rea%_dep': '% occup. réa (dép)',
@@ -333,7 +694,7 @@ def make_overview_map(map_col, date, latest_df, source=source, colormap=colormap
     plot_df['hovername'] = plot_df['libelle_dep'] + " (" + plot_df['libelle_reg'] + ")"
     plot_df['rea%'] = plot_df['rea%'].divide(100)
 
-    fig = px.choropleth(plot_df, geojson=fr_dept, color=map_col,
+    fig = px.choropleth(plot_df, geojson=gd.get_fr_dept(), color=map_col,
                     locations="libelle_dep", featureidkey="properties.nom",
                     #animation_frame="variable", animation_group='libelle_dep',
                     hover_name='hovername',  hover_data={
@@ -383,6 +744,101 @@ def make_overview_map(map_col, date, latest_df, source=source, colormap=colormap
 
     return fig
 
+def make_alert_grid(kpi_df, map_col='niveau_global', levels=alert_levels):
+    '''Pivots alert levels into a (day x metro dept) grid of level codes,
+    in one vectorized step. -1 = no level. Days without any level are dropped.
+
+    Returns:
+        days, dept names, int8 grid'''
+
+    # metro depts only, like make_overview_map
+    dom_tom = kpi_df.dropna(subset=['dom_tom']).groupby('libelle_dep')['dom_tom'].first()
+    dep_names = sorted(dom_tom.index[dom_tom.astype('str') != 'True'])
+    df = kpi_df.loc[kpi_df['libelle_dep'].isin(dep_names)]
+
+    days = np.sort(df['jour'].unique())
+    day_codes = np.searchsorted(days, df['jour'])
+    dep_codes = pd.Categorical(df['libelle_dep'], categories=dep_names).codes
+
+    grid = np.full((len(days), len(dep_names)), -1, dtype='int8')
+    grid[day_codes, dep_codes] = pd.Categorical(df[map_col], categories=levels).codes
+
+    has_level = (grid >= 0).any(axis=1)
+    return days[has_level], dep_names, grid[has_level]
+
+
+def make_alert_animation(kpi_df, source=source, colormap=colormap):
+    '''Plots alert levels for every day, with a time slider.
+
+    The geometry & dept names are in the figure once: each frame only
+    carries that day's level codes (null = no level), so the html grows
+    by a few hundred bytes per day.'''
+
+    days, dep_names, grid = make_alert_grid(kpi_df, levels=list(colormap))
+    n = len(colormap)
+
+    # discrete colorscale: code i sits in the middle of the i-th band
+    colorscale = []
+    for i, color in enumerate(colormap.values()):
+        colorscale += [[i / n, color], [(i + 1) / n, color]]
+
+    def frame_z(codes):
+        return [int(code) if code >= 0 else None for code in codes]
+
+    title = "<b>Niveaux d'alerte - {}</b><br>(Faire glisser le curseur pour changer de date)"
+    source_str = "Source: <a href='{}' color='blue'>Santé Publique France</a>".format(source) # for annotation
+
+    fig = go.Figure(go.Choropleth(geojson=gd.get_fr_dept(),
+                                  locations=dep_names,
+                                  featureidkey='properties.nom',
+                                  z=frame_z(grid[-1]),
+                                  zmin=-0.5, zmax=n - 0.5,
+                                  colorscale=colorscale,
+                                  colorbar=dict(title='Niveaux',
+                                                tickvals=list(range(n)),
+                                                ticktext=list(colormap),
+                                                len=.6, y=.5),
+                                  marker_line_color='white',
+                                  marker_line_width=0.5,
+                                  hovertemplate='%{location}<extra></extra>'))
+
+    fig.frames = [go.Frame(name=day,
+                           data=[go.Choropleth(z=frame_z(codes))],
+                           traces=[0],
+                           layout=dict(title_text=title.format(day)))
+                  for day, codes in zip(days, grid)]
+
+    # step labels are hidden (one per day would overlap): the date shows above the slider
+    play_args = dict(frame=dict(duration=100, redraw=True), transition=dict(duration=0), mode='immediate')
+    steps = [dict(method='animate', label=day, args=[[day], play_args]) for day in days]
+
+    fig.update_geos(fitbounds="locations", visible=False, projection_type='mercator')
+
+    fig.update_layout(margin=dict(r=0, t=60, l=0, b=20),
+                      title=dict(text=title.format(days[-1]), y=.97, x=0.10,
+                                 xanchor='left', yanchor='top'),
+                      sliders=[dict(steps=steps,
+                                    active=len(steps) - 1,
+                                    currentvalue=dict(prefix='Date: '),
+                                    font=dict(color='rgba(0,0,0,0)'),
+                                    ticklen=0, minorticklen=0,
+                                    pad=dict(t=10))],
+                      updatemenus=[dict(type='buttons',
+                                        direction='left',
+                                        x=0, y=0, xanchor='right', yanchor='top',
+                                        pad=dict(t=30, r=10),
+                                        buttons=[dict(label='▶', method='animate',
+                                                      args=[None, dict(play_args, fromcurrent=True)]),
+                                                 dict(label='❚❚', method='animate',
+                                                      args=[[None], dict(play_args, frame=dict(duration=0, redraw=False))])])],
+                      annotations=[dict(x=1, y=0,
+                                        text=source_str, showarrow=False,
+                                        xref='paper', yref='paper',
+                                        xanchor='right', yanchor='auto')])
+
+    return fig
+
+
 def make_value_map(map_col, date, latest_df, source=source):
     '''Plots a continuous-scale choropleth for Covid alert indicators in France.'''
 
@@ -393,7 +849,7 @@ def make_value_map(map_col, date, latest_df, source=source):
     source_str = "Source: <a href='{}' color='blue'>Santé Public France</a>".format(source) # for annotation
     #alert_col = '{}_alerte'.format(map_col) # for hover text
 
-    fig = px.choropleth(latest_df, geojson=fr_dept, color=map_col,
+    fig = px.choropleth(latest_df, geojson=gd.get_fr_dept(), color=map_col,
                     locations="libelle_dep", featureidkey="properties.nom",
                     #animation_frame="variable", animation_group='libelle_dep',
                     hover_name='libelle_dep',  hover_data={#alert_col: True,
@@ -429,13 +885,13 @@ def map_rea(map_col, date, latest_df, source=hd.source, labels=boilerplate_fr):
         title = '<b> - {}</b>'.format(date)
         color_range = [0,100]
         feat_id = 'properties.nom'
-        geo = fr_dept
+        geo = gd.get_fr_dept()
         loc = 'libelle_dep'
         hovername = 'libelle_dep'
     elif map_col=='rea%':
         color_range = [0,100]
         feat_id = 'properties.code'
-        geo = fr_region
+        geo = gd.get_fr_region()
         loc = 'reg'
         hovername = 'libelle_reg'
     else:
@@ -486,10 +942,12 @@ def map_rea(map_col, date, latest_df, source=hd.source, labels=boilerplate_fr):
 ### For first page of covid_dataviz ###
 
 
-def create_kpi_summary(df):
+def create_kpi_summary(cube):
+    '''Daily indicators for metropolitan France, read from the rollup cube.'''
+
     val_cols = ['incid_tous', 'incid_70+', 'rea%']
-    q = "dom_tom=='False'" # still missing rea values for domtom
-    kpi_fr_df = df.query(q).groupby('jour')[val_cols].mean().round(0)
+    # metro only: still missing rea values for domtom
+    kpi_fr_df = cube.loc[('fr', 'metro')][val_cols].round(0)
 
     return kpi_fr_df
 
@@ -505,7 +963,7 @@ def plot_kpi_trends(kpi_fr_df):
     #hline_annot = [{'text':'30% ICU occupancy','y':'30', 'x':'2020-07-02',
                     #'textangle':0,'ay':-10}]
 
-    fig = kpi_fr_df.iplot(title="<b>Covid-19 indicator trends - France</b><br>(daily avg of all depts)",
+    fig = kpi_fr_df.iplot(title="<b>Covid-19 indicator trends - France</b><br>(metropolitan France, all depts combined)",
                           kind='bar',
                           #hline=rea_hlines,
                           #annotations=hline_annot,
@@ -535,15 +993,21 @@ def plot_kpi_trends(kpi_fr_df):
 
 # get NEW reanimations
 
+@ins.instrumented()
 def get_new_admissions(geo='fr', url=hd.new_patients_url):
     '''Creates dataframe of *new* ICU patients & patient deaths in hospital.
     Used on covid_dataviz home page, as a companion plot to kpi_trends .'''
 
-    new_admissions = pd.read_csv(url, sep=';', dtype=dict(dep='str'))
+    new_admissions = fd.read_csv(url, sep=';', dtype=dict(dep='str'))
+    new_admissions['jour'] = fd.parse_days(new_admissions['jour'])
+    # dates go back to 'YYYY-MM-DD' once grouped, to join with the kpi df
     if geo=='fr':
         new_admissions = new_admissions.groupby('jour').sum().rolling(7).mean().round(0) # rolling 7d avg, no decimals
+        new_admissions.index = pd.Index(fd.format_days(new_admissions.index), name='jour')
     elif geo=='dep':
         new_admissions = new_admissions.groupby(['dep', 'jour']).sum().rolling(7).mean().round(0) # rolling 7d avg, no decimals
+        index = new_admissions.index
+        new_admissions.index = index.set_levels(fd.format_days(index.levels[1]), level='jour')
     else:
         print("not a valid value. Use 'fr' or 'dep' instead.")
     cols = new_admissions.columns
@@ -552,9 +1016,10 @@ def get_new_admissions(geo='fr', url=hd.new_patients_url):
 
     return new_admissions
 
-def plot_rea_dc(kpi_fr_df, palette=hd.hosp_colormap):
+def plot_rea_dc(kpi_fr_df, palette=hd.hosp_colormap, new_ad=None):
     cols = ['rea', 'dc']
-    new_ad = get_new_admissions().dropna()
+    if new_ad is None:
+        new_ad = get_new_admissions().dropna()
     rea_dc_df = kpi_fr_df.join(new_ad, how='right')
 
     fig = rea_dc_df[cols].iplot(
@@ -565,32 +1030,188 @@ def plot_rea_dc(kpi_fr_df, palette=hd.hosp_colormap):
 
     return fig
 
-def to_html(fname, fig, auto_open=False):
-    filepath = "../covid_dataviz/{}".format(fname)
+output_path = "../covid_dataviz/"
+
+@ins.instrumented()
+def to_html(fname, fig, auto_open=False, verbose=True):
+    filepath = "{}{}".format(output_path, fname)
     pio.write_html(fig, filepath, auto_open=False, include_plotlyjs='cdn')
-    print("Map saved to {}".format(filepath))
+    if verbose:
+        print("Map saved to {}".format(filepath))
+    return filepath
+
+### Skip-if-unchanged output ###
+
+# fingerprint of every html file's inputs, kept next to the html files.
+# Only for figures rendered with render_figures (e.g. output_reg_kpi from a
+# notebook): the build itself runs as pipeline.py stages, see __main__
+manifest_fname = 'manifest.json'
+
+# any edit to these files invalidates every fingerprint: this file, the
+# modules the figures call into, and the prepared map geometry
+code_files = ['fetch_data.py', 'process_region_data.py', 'process_test_data.py',
+              'process_hosp_data.py', 'process_geo_data.py', 'process_kpi.py',
+              'dashboard.py', 'kpi_rules.py']
+
+code_path = Path(__file__).resolve().parent
+
+def get_inputs_version(files=code_files):
+    '''sha256 of the code files & of the prepared geojson read by the
+    maps (gd.prepared_path). Geometry not prepared yet counts as missing.'''
+
+    paths = [code_path.joinpath(fname) for fname in files]
+    paths += [gd.prepared_path(name) for name in gd.geo_sources]
+
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(str(path).encode())
+        if path.exists():
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+
+    return h.hexdigest()
+
+def load_manifest():
+    try:
+        with open(output_path + manifest_fname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(manifest):
+    with open(output_path + manifest_fname, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def fingerprint(fname, func, args, inputs_version=None):
+    '''sha256 of a figure's spec: file name, plotting function, args & the
+    version of the code & geometry (see get_inputs_version). dfs & series
+    are hashed by value (incl. index & column names).'''
+
+    if inputs_version is None:
+        inputs_version = get_inputs_version()
+
+    h = hashlib.sha256()
+    h.update(repr((fname, func.__name__, inputs_version)).encode())
+    for arg in args:
+        if isinstance(arg, (pd.DataFrame, pd.Series)):
+            h.update(pd.util.hash_pandas_object(arg).to_numpy().tobytes())
+            names = arg.columns if isinstance(arg, pd.DataFrame) else [arg.name]
+            h.update(repr((list(names), list(arg.index.names))).encode())
+        else:
+            h.update(repr(arg).encode())
+
+    return h.hexdigest()
+
+def build_and_save(fname, func, args):
+    '''Builds & saves one figure. Returns the html path, and the
+    instrumentation records of the build (sent back by worker processes).'''
+
+    mark = len(ins.records)
+    with ins.stage('figure', fname=fname):
+        with ins.stage('figure.build'):
+            fig = func(*args)
+        filepath = to_html(fname, fig, verbose=False)
+
+    return filepath, ins.collect_since(mark)
+
+### Parallel rendering ###
+
+def get_render_jobs():
+    '''Number of worker processes for render_figures: $RENDER_JOBS, or
+    None (one per CPU) if it's unset or not a positive int.'''
+
+    value = os.environ.get('RENDER_JOBS')
+    if value is None:
+        return None
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        print("Ignoring RENDER_JOBS={!r}: not a number of processes".format(value))
+        return None
+    return jobs
+
+def render_figures(specs, jobs=None, force=False):
+    '''Builds & saves figures in a process pool. Each spec is a
+    (fname, func, args) tuple, where func(*args) returns the figure.
+
+    Figures whose fingerprint matches the manifest (and whose file exists)
+    are skipped, unless force=True. Results & errors are reported in spec
+    order, whatever order the workers finish in. jobs=1 renders serially,
+    in this process.'''
+
+    jobs = get_render_jobs() if jobs is None else jobs
+
+    manifest = load_manifest()
+    inputs_version = get_inputs_version()
+    fingerprints = [fingerprint(*spec, inputs_version=inputs_version) for spec in specs]
+    todo = [(spec, fp) for spec, fp in zip(specs, fingerprints)
+            if force or manifest.get(spec[0]) != fp or not Path(output_path + spec[0]).exists()]
+
+    for spec, fp in zip(specs, fingerprints):
+        if (spec, fp) not in todo:
+            print("Unchanged, skipped {}{}".format(output_path, spec[0]))
+
+    if jobs == 1 or len(todo) < 2:
+        outcomes = []
+        for spec, fp in todo:
+            try:
+                filepath, stage_records = build_and_save(*spec)
+                ins.records.extend(stage_records)
+                outcomes.append((filepath, None))
+            except Exception as e:
+                outcomes.append((None, e))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(build_and_save, *spec) for spec, fp in todo]
+            outcomes = []
+            for future in futures:
+                try:
+                    filepath, stage_records = future.result()
+                    ins.records.extend(stage_records)
+                    outcomes.append((filepath, None))
+                except Exception as e:
+                    outcomes.append((None, e))
+
+    errors = []
+    for (spec, fp), (filepath, error) in zip(todo, outcomes):
+        fname, func, args = spec
+        if error is None:
+            manifest[fname] = fp
+            print("Map saved to {}".format(filepath))
+        else:
+            manifest.pop(fname, None)
+            errors.append("{} ({}{}): {!r}".format(fname, func.__name__, args[:1], error))
+    save_manifest(manifest)
+
+    if errors:
+        raise RuntimeError("{} figure(s) failed:\n{}".format(len(errors), "\n".join(errors)))
+
+    return [filepath for filepath, error in outcomes]
 
 ### KPI by region lineplots ###
 
-hline_dict = dict(incid_tous=[dict(y=50, color='red', dash='dash'),
-                               dict(y=150,color='darkred', dash='dash'),
-                               dict(y=250,color='maroon', dash='dash')],
-                    incid_70=[dict(y=50,color='red', dash='dash'),
-                                  dict(y=100,color='darkred', dash='dash')],
-                    rea=[dict(y=30,color='darkred', dash='dash'),
-                            dict(y=60,color='black', dash='dash')])
+# threshold lines (kr.thresholds), lowest first
+hline_colors = dict(incid_tous=['red', 'darkred', 'maroon'],
+                    incid_70=['red', 'darkred'],
+                    rea=['darkred', 'black'])
 
+hline_dict = {key: [dict(y=y, color=color, dash='dash') for y, color in zip(kr.thresholds[col], hline_colors[key])]
+              for key, col in [('incid_tous', 'incid_tous'), ('incid_70', 'incid_70+'), ('rea', 'rea%')]}
 
 
-def plot_reg_kpi(metric, df):
+
+def plot_reg_kpi(metric, cube):
 
     title="<b>{}</b><br>(Use legend to hide/show regions)".format(metric)
     icu_hlines = [dict(y=30, color='darkred', dash='dash'),
                   dict(y=60, color='black', dash='dash')]
 
-    #q = "dom_tom=='False'" # no icu numbers for DOM
-    plot_df = df.query(q).dropna().groupby(['libelle_reg', 'jour'])[metric].mean().unstack(0)
-    #plot_df = df.dropna().groupby(['libelle_reg', 'jour'])[metric].mean().unstack(0)
+    # region rollups from the cube. No icu numbers for DOM (region codes < 10)
+    reg_df = cube.loc['reg'].reset_index()
+    reg_df = reg_df.loc[reg_df['area'].astype('int') >= 10]
+    plot_df = reg_df.pivot(index='jour', columns='libelle', values=metric).rename_axis(columns='libelle_reg')
 
     if metric=='incid_70+': # workaround special char in col names
         hl_key = 'incid_70'
@@ -608,36 +1229,62 @@ def plot_reg_kpi(metric, df):
 
     return fig
 
-def output_reg_kpi(kpi_df):
+def output_reg_kpi(cube, jobs=None):
+    specs = []
     for metric in ['incid_tous', 'incid_70+', 'rea%']:
-
-        fig = plot_reg_kpi(metric, kpi_df)
         if metric=='rea%':
-            metric='rea'
+            fname_metric='rea'
         elif metric=='incid_70+':
-            metric='incid_70'
+            fname_metric='incid_70'
         else:
-            pass
-        fname = "kpi_{}_by_reg.html".format(metric)
-        to_html(fname, fig)
+            fname_metric=metric
+        fname = "kpi_{}_by_reg.html".format(fname_metric)
+        specs.append((fname, plot_reg_kpi, (metric, cube)))
+
+    render_figures(specs, jobs)
 
 ### KPI lineplot functions  - for regional breakdown pg of covid_dataviz###
 
-def make_kpi_long_df(kpi_df):
-    val_cols = ['incid_tous', 'incid_70+', 'rea%', 'rea%_dep']
+def make_kpi_long_df(kpi_df, val_cols=['incid_tous', 'incid_70+', 'rea%', 'rea%_dep']):
     index_cols = ['libelle_reg', 'reg', 'libelle_dep', 'jour']
     kpi_long = pd.DataFrame(kpi_df.set_index(index_cols)[val_cols].stack(dropna=False)).reset_index()
     kpi_long.columns = ['libelle_reg', 'reg', 'libelle_dep', 'jour','indicator', 'value']
 
     return kpi_long
 
-def plot_reg_dept_kpi(reg, df):
+def make_reg_plot_data(kpi_df, indicators=['incid_tous', 'incid_70+', 'rea%_dep'], regs=()):
+    '''Plotting data for plot_reg_dept_kpi, split by region in one pass.
+    Regions in `regs` without any value get an empty df, for an empty
+    plot (as plot_reg_dept_kpi gives when filtering the whole df).
+
+    Returns:
+        dict of reg -> (region name, long df of the region's non-null values)'''
+
+    kpi_long = make_kpi_long_df(kpi_df, indicators).dropna()
+    plot_data = {reg: (reg_df['libelle_reg'].iat[0], reg_df)
+                 for reg, reg_df in kpi_long.groupby('reg', sort=False)}
+
+    missing = [reg for reg in regs if reg not in plot_data]
+    if missing:
+        geo = rd.load_geo_index()
+        reg_names = geo.drop_duplicates('reg').set_index('reg')['libelle_reg']
+        plot_data.update({reg: (reg_names[reg], kpi_long.iloc[:0]) for reg in missing})
+
+    return plot_data
+
+def plot_reg_dept_kpi(reg, df, regname=None):
     '''Compares indicator lines by department & by indicator for a given region.
-    Used on regional breakdown page of covid_dataviz.'''
+    Used on regional breakdown page of covid_dataviz.
+
+    df is either the whole long kpi df, or - when regname is given -
+    the region's slice from make_reg_plot_data.'''
 
-    reg_ref_df = pd.read_pickle('data/reg_ref_df.pkl')
-    regname = reg_ref_df['libelle_reg'].loc[reg_ref_df['reg']==reg].unique()[0]
-    fig = px.line(df.query("reg==@reg & indicator !='rea%'").dropna(), x='jour', y='value',
+    if regname is None:
+        reg_ref_df = rd.load_reg_ref_df()
+        regname = reg_ref_df['libelle_reg'].loc[reg_ref_df['reg']==reg].unique()[0]
+        df = df.query("reg==@reg & indicator !='rea%'").dropna()
+
+    fig = px.line(df, x='jour', y='value',
                   color='libelle_dep',
                   title="Covid indicators - {}".format(regname),
                   hover_name='libelle_dep',
@@ -652,83 +1299,58 @@ def plot_reg_dept_kpi(reg, df):
     return fig
 
 
-def output_reg_dept_plots(reglist, df):
-    kpi_long_df = make_kpi_long_df(df)
+def make_threshold_traces(x_min, x_max):
+    '''Horizontal alert threshold lines, keyed by facet row.'''
 
-    # define the traces for threshold lines
-    #TODO: turn into for lookup
+    thresholds = {3: [(150, 'red'), (250, 'darkred')],   # incid_tous
+                  2: [(50, 'red'), (100, 'darkred')],    # incid_70+
+                  1: [(30, 'darkred'), (60, 'black')]}   # rea%_dep
 
-    x_min = kpi_long_df['jour'].min()
-    x_max = kpi_long_df['jour'].max()
+    traces = {row: [go.Scatter(x=[x_min, x_max],
+                               y=[y, y],
+                               mode='lines',
+                               line_color=color,
+                               line_dash='dot',
+                               showlegend=False) for y, color in lines]
+              for row, lines in thresholds.items()}
 
-    incid_tous_trace2 = go.Scatter(x=[x_min, x_max],
-                            y=[250, 250] ,
-                            mode='lines',
-                            line_color='darkred',
-                            line_dash='dot',
-                            showlegend=False)
+    return traces
 
-    incid_tous_trace = go.Scatter(x=[x_min, x_max],
-                            y=[150, 150],
-                            mode='lines',
-                            line_color='red',
-                            line_dash='dot',
-                            showlegend=False)
+def make_reg_dept_fig(reg, reg_df, regname, x_min, x_max):
+    '''Builds one region's dept plot, from the region's
+    slice of make_reg_plot_data.'''
 
-    incid_70_trace2 = go.Scatter(x=[x_min, x_max],
-                            y=[100,100],
-                            mode='lines',
-                            line_color='darkred',
-                            line_dash='dot',
-                            showlegend=False)
+    fig = plot_reg_dept_kpi(reg, reg_df, regname)
 
-    incid_70_trace = go.Scatter(x=[x_min, x_max],
-                            y=[50,50],
-                            mode='lines',
-                            line_color='red',
-                            line_dash='dot',
-                            showlegend=False)
+    # add alert threshold lines
+    for row, traces in make_threshold_traces(x_min, x_max).items():
+        for trace in traces:
+            fig.add_trace(trace, row=row, col=1)
 
-    rea_max_trace = go.Scatter(x=[x_min, x_max],
-                            y=[30,30],
-                            mode='lines',
-                            line_color='darkred',
-                            line_dash='dot',
-                            showlegend=False)
+    # make labels easier to read
+    fig.update_yaxes(matches=None)
+    fig.update_xaxes(title=None)
+    fig.update_yaxes(title=dict(text='cases per 100k pop.', font_size=12))
+    fig.update_yaxes(title='% occupied', row=1, col=1)
+    fig.for_each_annotation(lambda a: a.update(textangle=.5, x=.5, yshift=120,
+                                               text=(a.text.split("=")[-1]),
+                                                font_size=13))
 
-    rea_urg_trace = go.Scatter(x=[x_min, x_max],
-                            y=[60,60],
-                            mode='lines',
-                            line_color='black',
-                            line_dash='dot',
-                            showlegend=False)
-    # generate plots
-    for reg in reglist:
-        fig = plot_reg_dept_kpi(reg, kpi_long_df)
-
-        # add alert threshold lines
-        fig.add_trace(incid_tous_trace, row=3, col=1)
-        fig.add_trace(incid_tous_trace2, row=3, col=1)
-        fig.add_trace(incid_70_trace, row=2, col=1)
-        fig.add_trace(incid_70_trace2, row=2, col=1)
-        fig.add_trace(rea_max_trace, row=1, col=1)
-        fig.add_trace(rea_urg_trace, row=1, col=1)
-
-        # make labels easier to read
-        fig.update_yaxes(matches=None)
-        fig.update_xaxes(title=None)
-        fig.update_yaxes(title=dict(text='cases per 100k pop.', font_size=12))
-        fig.update_yaxes(title='% occupied', row=1, col=1)
-        fig.for_each_annotation(lambda a: a.update(textangle=.5, x=.5, yshift=120,
-                                                   text=(a.text.split("=")[-1]),
-                                                    font_size=13))
-
-        # save to html
-        fname = "kpi_{}.html".format(reg)
-        #path = "../covid_dataviz/{}".format(str.lower(fname))
-        to_html(fname, fig)
+    return fig
+
+def output_reg_dept_plots(reglist, df, jobs=None):
+    plot_data = make_reg_plot_data(df, regs=reglist)
+
+    x_min = df['jour'].min()
+    x_max = df['jour'].max()
+
+    # generate plots - each worker only gets its region's rows
+    specs = [("kpi_{}.html".format(reg), make_reg_dept_fig, (reg, plot_data[reg][1], plot_data[reg][0], x_min, x_max))
+             for reg in reglist]
+    render_figures(specs, jobs)
 
 def output_reg_iframes(reglist):
+    reg_ref_df = rd.load_reg_ref_df()
     for reg in reglist:
         regname = reg_ref_df['libelle_reg'].loc[reg_ref_df['reg']==reg].unique()[0]
         reg_heading = "# {}".format(regname)
@@ -744,74 +1366,27 @@ def output_reg_iframes(reglist):
 
 if __name__ == '__main__':
 
+    # the build runs as pipeline.py stages, so it shares their state: the
+    # kpi df, the cube & each figure are only rebuilt when stale.
+    # `python pipeline.py` can also build single stages
+    import pipeline
+
+    # `python process_kpi.py --profile` (or COVID_INSTRUMENT=1) records
+    # time & memory per stage, see instrument.report_path
+    if '--profile' in sys.argv:
+        ins.enable()
+
+    # every figure, and what they're built from
+    targets = [name for name in pipeline.get_stages() if name.endswith('.html')]
+
+    ## single-page dashboard: one data file shared by all figures
+    # `python process_kpi.py --dashboard`
+    if '--dashboard' in sys.argv:
+        targets.append('dashboard')
 
-    print("Creating KPI dataframe...")
-    kpi_df = create_kpi_df()
-    colormap = make_overview_colormap(kpi_df)
-    metric = 'niveau_global'
-    latest_df = get_latest(metric, kpi_df)
-    latest_date = latest_df.name
-
-    ## Alert choropleth
-    print("Generating FR map...")
-    q = "dom_tom=='False'"
-    fig = make_overview_map(metric, latest_date, latest_df.query(q))
-
-    # add cities to FR maps
-    #print("Adding cities...")
-    #cities_trace = add_cities()
-    #curfew_trace = add_curfew_cities(curfew_cities)
-    #fig.add_traces(curfew_trace)
-
-    #print("Saving to HTML...")
-    fname = 'alerts.html'
-    to_html(fname, fig, False)
-
-    ## Indicator trendline barplot
-    print("Generating FR indicator trends plot...")
-    kpi_fr_df = create_kpi_summary(kpi_df)
-    fig = plot_kpi_trends( kpi_fr_df)
-
-    print("Saving to HTML...")
-    fname="kpi_fr_trends.html"
-    to_html(fname, fig, auto_open=False)
-
-    ## ICU vs Deaths in hosp barplot
-    print("Generating FR ICU admisssions & deaths plot...")
-    fig = plot_rea_dc(kpi_fr_df)
-    fname='kpi_rea_dc_trends.html'
-    to_html(fname, fig, auto_open=False)
-
-    # add regions to kpi_df - REDUNDANT???
-    #reg_ref_df = pt.rd.create_region_df()
-    #new_kpi_df = reg_ref_df[['reg', 'libelle_reg', 'libelle_dep']].merge(kpi_df).sort_values(['reg', 'jour'])
-
-    ## Indicators by region line plots
-    print("Generating KPI by region plots...")
-    #output_reg_kpi(new_kpi_df)
-    output_reg_kpi(kpi_df)
-
-    ## for Compare dept page
-    print("Generating KPI by dept plots...")
-    reglist = [11, 24, 27, 28, 32, 44, 52, 53, 75, 76, 84, 93, 94]
-    #output_reg_dept_plots(reglist, new_kpi_df)
-    output_reg_dept_plots(reglist, kpi_df)
-
-    ## rea% choropleth maps for Overvew page
-    print("Generating region rea% maps...")
-    map_col = 'rea%'
-    latest_rea = get_latest(map_col, kpi_df)
-    latest_rea_date = latest_rea.name
-    rea_fig = map_rea(map_col, latest_rea_date, latest_rea)
-
-    fname = "rea_pct_region.html"
-    to_html(fname, rea_fig)
-
-    print("Generating dept rea% maps...")
-    map_col = 'rea%_dep'
-    dep_rea_fig = map_rea(map_col, latest_rea_date, latest_rea)
-
-    fname = "rea_pct_dept.html"
-    to_html(fname, dep_rea_fig)
+    # `python process_kpi.py --update` only computes the new days,
+    # `--force` rebuilds every figure even if up to date
+    pipeline.run(targets, force='--force' in sys.argv, update='--update' in sys.argv)
 
     print("****** DONE! ******\n")
+    ins.report()
@@ -1,7 +1,12 @@
+import json
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from pathlib import Path
 
+import fetch_data as fd
+import instrument as ins
+
 ## Data sources
 
 icu_source = 'https://drees.solidarites-sante.gouv.fr/etudes-et-statistiques/publications/article/nombre-de-lits-de-reanimation-de-soins-intensifs-et-de-soins-continus-en-france'
@@ -23,14 +28,21 @@ pop_age_xls = "https://www.insee.fr/fr/statistiques/fichier/1893198/estim-pop-de
 # Data output
 path = "data/"
 
+reg_ref_pkl = path + 'reg_ref_df.pkl'
+pop_age_pkl = path + 'pop_age_df.pkl'
+inputs_json = path + 'reg_ref_inputs.json' # versions of the inputs used for the pkls
+
+# every input of the pkls
+input_sources = [reg_url, dept_url, icu_xls, pop_csv, pop_age_xls]
+
 ## Helper functions
 
 def get_region_data(regions=reg_url, depts=dept_url):
     '''Gets names & codes for French regions & departments.
     Used to provide more meaningful plot titles.'''
 
-    reg_ref_df = pd.read_csv(regions, compression='zip', usecols=['reg', 'libelle'])
-    dept_df = pd.read_csv(depts, compression="zip", usecols=['dep', 'reg', 'libelle'])
+    reg_ref_df = fd.read_csv(regions, compression='zip', usecols=['reg', 'libelle'])
+    dept_df = fd.read_csv(depts, compression="zip", usecols=['dep', 'reg', 'libelle'])
     reg_only_df = reg_ref_df.merge(dept_df, on = 'reg', suffixes=('_reg', '_dep'))
 
     return reg_only_df
@@ -64,15 +76,13 @@ def add_mayotte_pop(df, mayotte_pop=256518):
     iloc = df.index[df['dep']=='976'][0]
     if pd.isnull(df.at[iloc, 'population']):
         df.at[iloc, 'population'] = mayotte_pop
-        return df
-    else:
-        pass
+    return df
 
 def get_pop_age_data(xls=pop_age_xls):
     """Gets population by 5-year age brackets. Used
     for calculating incidence rate."""
 
-    pop_age = pd.read_excel(xls, sheet_name="2020", skiprows=4, skipfooter=4, dtype={'Unnamed: 0':'str'})
+    pop_age = fd.read_excel(xls, sheet_name="2020", skiprows=4, skipfooter=4, dtype={'Unnamed: 0':'str'})
     pop_age = pop_age[pop_age.columns[:22]]\
         .rename(columns={'Unnamed: 0':'dep',
                         'Unnamed: 1':'libelle_dep'})\
@@ -140,12 +150,143 @@ def generate_region_pkl():
 
     return processed_file
 
-## Generate data
+## Build-if-stale entry point
+
+def get_input_version(src):
+    '''Version of an input, without reading it: a remote source is
+    revalidated through the download cache (one 304 if unchanged) and
+    identified by the sha256 its cached copy is stored under, a local
+    file by its size & mtime. None if the input can't be found.'''
+
+    try:
+        input_path = fd.fetch_path(src)
+    except OSError:  # not cached & unreachable
+        return None
+    if not input_path.exists():
+        return None
+    if fd.local_sources.get(src, src).startswith(('http://', 'https://')):
+        return input_path.name  # blobs are named by their sha256
+
+    stat = input_path.stat()
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+def get_input_fingerprints():
+    '''Version of every input to the lookup dfs, see get_input_version.'''
+
+    return {src: get_input_version(src) for src in input_sources}
+
+@ins.instrumented()
+def build_if_stale(force=False):
+    '''(Re)generates reg_ref_df.pkl & pop_age_df.pkl, but only
+    when one of their inputs has changed since the last build.
+    Existing pkls are kept as they are if an input is unavailable
+    (e.g. the local ICU beds xlsx), since they couldn't be rebuilt.
+
+    Raises:
+        FileNotFoundError if the pkls must be built but an input is missing
+
+    Returns:
+        True if the pkls were rebuilt'''
+
+    fingerprints = get_input_fingerprints()
+    missing = [src for src, version in fingerprints.items() if version is None]
+
+    outputs_exist = Path(reg_ref_pkl).exists() and Path(pop_age_pkl).exists()
+    if outputs_exist and not force:
+        if missing:
+            print("Keeping existing lookup pkls, inputs unavailable: {}".format(", ".join(missing)))
+            return False
+        if Path(inputs_json).exists():
+            with open(inputs_json) as f:
+                if json.load(f) == fingerprints:
+                    return False
+
+    if missing:
+        raise FileNotFoundError("Can't build the lookup pkls, inputs unavailable: {}".format(", ".join(missing)))
+
+    create_region_df().to_pickle(reg_ref_pkl)
+    create_pop_age_df().to_pickle(pop_age_pkl)
+    with open(inputs_json, 'w') as f:
+        json.dump(fingerprints, f, indent=1)
+
+    return True
 
-path_to_pkl = generate_region_pkl()
+@ins.instrumented()
+def load_reg_ref_df():
+    '''Region 'lookup' df: FR region codes & names, dept names,
+    ICU_beds & population. Built first if the pkl is missing.'''
 
+    if not Path(reg_ref_pkl).exists():
+        build_if_stale()
+    return pd.read_pickle(reg_ref_pkl)
+
+@ins.instrumented()
+def load_pop_age_df():
+    '''Dept population by 10-year age group. Built first if the pkl is missing.'''
+
+    if not Path(pop_age_pkl).exists():
+        build_if_stale()
+    return pd.read_pickle(pop_age_pkl)
+
+## Geography index
+
+# Depts & regions as dense integer ids, built once from reg_ref_df:
+# dep_id is a dept's row in the index, reg_id its region's rank by code.
+# Frames are joined on these ids by position, and names are only looked
+# up (attach_geo) when a df leaves the pipeline.
+
+_geo_index = {}
+
+def create_geo_index(reg_ref_df):
+    '''One row per dept: dep_id, reg_id, then reg_ref_df's columns & dom_tom.'''
+
+    geo = reg_ref_df.drop_duplicates('dep').reset_index(drop=True)
+    reg_ids, regs = pd.factorize(geo['reg'], sort=True)
+    geo.insert(0, 'dep_id', np.arange(len(geo), dtype='int16'))
+    geo.insert(1, 'reg_id', reg_ids.astype('int16'))
+    geo['dom_tom'] = geo['reg'] < 10
+
+    return geo
+
+def load_geo_index():
+    '''The geography index of the current reg_ref_df.pkl, built once per session
+    (and again if the pkl changes).'''
+
+    if not Path(reg_ref_pkl).exists():
+        build_if_stale()
+    key = (str(Path(reg_ref_pkl).resolve()), Path(reg_ref_pkl).stat().st_mtime)
+    if key not in _geo_index:
+        _geo_index.clear()
+        _geo_index[key] = create_geo_index(pd.read_pickle(reg_ref_pkl))
+    return _geo_index[key]
+
+def get_dep_ids(values, key='dep', geo=None):
+    '''dep_id of each dept code (or of each name, with key='libelle_dep'),
+    -1 if it isn't in the index. Categoricals are looked up once per category.'''
+
+    geo = load_geo_index() if geo is None else geo
+    index = pd.Index(geo[key])
+    values = pd.Series(values)
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        category_ids = np.append(index.get_indexer(values.cat.categories), -1)
+        return category_ids[values.cat.codes.to_numpy()]  # code -1 (NaN) -> last item, -1
+
+    return index.get_indexer(values)
+
+def attach_geo(df, cols=['reg', 'libelle_reg', 'libelle_dep'], id_col='dep_id', geo=None):
+    '''Adds geography columns (names, codes, population...) to a df
+    with dep_ids, by position in the index.'''
+
+    geo = load_geo_index() if geo is None else geo
+    ids = df[id_col].to_numpy()
+    return df.assign(**{col: geo[col].to_numpy()[ids] for col in cols})
 
 
 if __name__=='__main__':
-    print("A pkl of FR region codes & names, dept names, ICU_beds, & population has been generated here:/n")
-    print(path_to_pkl)
+    if build_if_stale():
+        print("Pkls of FR region codes & names, dept names, ICU_beds, & population have been generated here:\n")
+        print(reg_ref_pkl)
+        print(pop_age_pkl)
+    else:
+        print("Region lookup pkls are up to date.")
@@ -1,5 +1,10 @@
+import numpy as np
 import pandas as pd
-#import process_region_data as rd
+from numpy.lib.stride_tricks import sliding_window_view
+
+import fetch_data as fd
+import instrument as ins
+import process_region_data as rd
 
 
 ### Data sources ###
@@ -10,10 +15,57 @@ meta_url = "https://www.data.gouv.fr/fr/datasets/r/39aaad1c-9aac-4be8-96b2-6d001
 
 ## Data processing functions ###
 
+@ins.instrumented()
 def make_df(url=url):
-    df = pd.read_csv(url, sep=';', dtype={'dep':'str'})
+    df = fd.read_csv(url, sep=';', dtype={'dep':'str'})
     return df
 
+# rows parsed at a time by read_testing_csv
+chunksize = 500000
+
+# compact dtypes for the testing csv: counts fit in int32 (nullable, as a
+# count may be blank), age classes in int8. Dates are read as categories,
+# then parsed once per distinct day.
+testing_dtypes = {'jour': 'category',
+                  'P': 'Int32',
+                  'T': 'Int32',
+                  'cl_age90': 'int8'}
+
+@ins.instrumented()
+def read_testing_csv(url=url, chunksize=chunksize, start=None):
+    '''Streaming version of make_df: parses the testing csv chunk by chunk,
+    with compact dtypes, and splits each chunk into its 'all ages' rows
+    (cl_age90==0) & its per-age rows as it goes. Peak memory is the kept
+    rows plus one chunk, instead of the whole file with default dtypes.
+
+    dep is a categorical over the depts of the geography index: other
+    codes become NaN, and are dropped by create_testing_df anyway.
+    jour is parsed to datetime64. With a `start` date, earlier rows are
+    dropped from each chunk as it's read.
+
+    Returns:
+        (all_ages_df, age_df), with the csv's columns'''
+
+    deps = rd.load_geo_index()['dep']
+    dtypes = dict(testing_dtypes, dep=pd.CategoricalDtype(deps))
+
+    all_ages_chunks = []
+    age_chunks = []
+    with fd.open_source(url) as f:
+        for chunk in pd.read_csv(f, sep=';', usecols=['dep', 'jour', 'P', 'T', 'cl_age90'],
+                                 dtype=dtypes, chunksize=chunksize):
+            chunk['jour'] = fd.parse_days(chunk['jour'])
+            if start is not None:
+                chunk = chunk.loc[chunk['jour'].to_numpy() >= np.datetime64(start)]
+            is_all_ages = chunk['cl_age90'].to_numpy() == 0
+            all_ages_chunks.append(chunk.loc[is_all_ages])
+            age_chunks.append(chunk.loc[~is_all_ages])
+
+    all_ages_df = pd.concat(all_ages_chunks, ignore_index=True)
+    age_df = pd.concat(age_chunks, ignore_index=True)
+
+    return all_ages_df, age_df
+
 # make age_range col easier to understand
 
 def make_age_ranges(ages):
@@ -38,8 +90,18 @@ def fix_ages(age_col):
     return age_col
  
 
-def create_testing_df(all_ages=True):
-    df = make_df()
+@ins.instrumented()
+def create_testing_df(all_ages=True, raw_df=None, as_datetime=False):
+    '''Cleans the SI-DEP testing data, keeping either the 'all ages' rows
+    or the per-age rows. Pass raw_df (from make_df or read_testing_csv)
+    to reuse an already parsed file instead of downloading & parsing it again.
+    jour is a 'YYYY-MM-DD' str, as in the csv; as_datetime=True keeps the
+    datetime64 it's parsed to, for the kpi build.'''
+
+    if raw_df is None:
+        all_ages_df, age_df = read_testing_csv()
+        raw_df = all_ages_df if all_ages else age_df
+    df = raw_df.assign(jour=fd.parse_days(raw_df['jour']))
     # remove redundant age categories
     if all_ages==True:
         df = df.loc[df['cl_age90']==0]
@@ -55,18 +117,21 @@ def create_testing_df(all_ages=True):
     df['age_range'] = fix_ages(df['age_range'])
 
     # calc positivity rate - Pointless?? It all seems based on 7day rolling totals
-    df['pos_rate'] = df['pos'].divide(df['tests_total']).multiply(100).round(2)
-
-    # get region & dept names & codes, as well as dept population
-    #reg_ref_df = rd.create_region_df()
-    reg_ref_df = pd.read_pickle('data/reg_ref_df.pkl')
-    
-     # cleaning: sometimes deps are numeric
-    #df['dep'] = df['dep'].astype('str')
-    #reg_ref_df['dep'] = reg_ref_df['dep'].astype('str') 
-    
-    # merge region with testing data
-    df = reg_ref_df.drop(['ICU_beds'], axis=1).merge(df)
+    df['pos_rate'] = df['pos'].divide(df['tests_total']).multiply(100).round(2).astype('float64')
+
+    # get region & dept names & codes, as well as dept population,
+    # by position in the geography index. Rows with an unknown dept
+    # (or no date) are dropped.
+    geo = rd.load_geo_index()
+    dep_ids = rd.get_dep_ids(df['dep'], geo=geo)
+    known = (dep_ids >= 0) & df['jour'].notna().to_numpy()
+    df = df.drop(columns='dep').loc[known].reset_index(drop=True)
+    df.insert(0, 'dep_id', dep_ids[known].astype('int16'))
+
+    geo_cols = ['reg', 'libelle_reg', 'dep', 'libelle_dep', 'population']
+    value_cols = [col for col in df.columns if col != 'dep_id']
+    df = rd.attach_geo(df, geo_cols, geo=geo)
+    df = df[geo_cols + value_cols + ['dep_id']]
 
     # flag dom-tom - REDUNDANT??
     df['dom_tom'] = df['reg'] < 10
@@ -74,8 +139,27 @@ def create_testing_df(all_ages=True):
     
     #df['reg'] = df['reg'].astype('int')
 
+    if not as_datetime:
+        df['jour'] = fd.format_days(df['jour'])
+
     return df
 
+@ins.instrumented()
+def create_testing_dfs(start=None):
+    '''Single pass over the testing csv: parses it once, streamed, and
+    builds both the all-ages df and the per-age df from its two partitions.
+    For the kpi build: jour is left as datetime64, and only the rows
+    from `start` on are kept, if given.
+
+    Returns:
+        (all_ages_df, age_df)'''
+
+    all_ages_raw, age_raw = read_testing_csv(start=start)
+    all_ages_df = create_testing_df(True, all_ages_raw, as_datetime=True)
+    age_df = create_testing_df(False, age_raw, as_datetime=True)
+
+    return all_ages_df, age_df
+
 # make rolling variables
 
 
@@ -107,24 +191,67 @@ def to_100k_pop(metric_col, geo_col, df, dec_places=2):
     
     return col_100k_pop
     
-def create_rolling_cols(df):
-    rolling_pos = make_rolling_sum('pos', 'libelle_dep', df)
-    rolling_total = make_rolling_sum('tests_total', 'libelle_dep', df)
-    rolling_pos_rate = to_percent(rolling_pos, rolling_total)
-    rolling_pos_100k = to_100k_pop(rolling_pos, 'libelle_dep', df)
-    rolling_test_100k = to_100k_pop(rolling_total, 'libelle_dep', df)
-
-    df = df.merge(rolling_pos_100k.stack().reset_index()).rename(columns={0:'rolling_pos_100k'})
-    df = df.merge(rolling_pos_rate.stack().reset_index()).rename(columns={0:'rolling_pos_rate'})
-    df = df.merge(rolling_test_100k.stack().reset_index()).rename(columns={0:'rolling_test_100k'})
-    
+## Array kernels ##
+
+def to_grid(codes, values, shape):
+    '''Scatters long-format values into a dense array, e.g. a (date x dept)
+    grid from integer date & dept codes. Duplicate cells are summed, like
+    groupby().sum(); cells with no row are NaN, like unstack().'''
+
+    grid = np.zeros(shape)
+    np.add.at(grid, codes, np.nan_to_num(np.asarray(values, dtype='float64')))
+    present = np.zeros(shape, dtype='bool')
+    present[codes] = True
+    grid[~present] = np.nan
+
+    return grid
+
+def rolling_sum_grid(grid, n=7):
+    '''n-day rolling sum along the first (date) axis of a grid. As with
+    pandas rolling(n).sum(), a window with any missing day is NaN.'''
+
+    rolling = np.full(grid.shape, np.nan)
+    if len(grid) >= n:
+        rolling[n-1:] = sliding_window_view(grid, n, axis=0).sum(axis=-1)
+
+    return rolling
+
+def rolling_mean_grid(grid, n=7):
+    return rolling_sum_grid(grid, n) / n
+
+@ins.instrumented()
+def create_rolling_cols(df, n=7):
+    '''Adds 7-day rolling incidence, positivity & testing rates by dept.
+    Rolling sums are computed on (date x dept) arrays and read back by
+    position; as before, rows without a full window are dropped.'''
+
+    day_codes, days = pd.factorize(df['jour'], sort=True)
+    dep_codes = df['dep_id'].to_numpy()
+    codes = (day_codes, dep_codes)
+    # one column per dept of the geography index, as dep_id indexes it
+    shape = (len(days), len(rd.load_geo_index()))
+
+    rolling_pos = rolling_sum_grid(to_grid(codes, df['pos'], shape), n)
+    rolling_total = rolling_sum_grid(to_grid(codes, df['tests_total'], shape), n)
+
+    # dept population, as in get_pop()
+    pop = np.full(shape[1], np.nan)
+    np.fmax.at(pop, dep_codes, df['population'].to_numpy(dtype='float64'))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rolling_cols = {'rolling_pos_100k': (rolling_pos * 100000 / pop).round(2),
+                        'rolling_pos_rate': (rolling_pos * 100 / rolling_total).round(2),
+                        'rolling_test_100k': (rolling_total * 100000 / pop).round(2)}
+
+    df = df.assign(**{col: grid[codes] for col, grid in rolling_cols.items()})
+    df = df.dropna(subset=list(rolling_cols)).reset_index(drop=True)
+
     return df
 
 ### for dept-age df ###
 
 def create_pop_age_df():
-    #pop_age_df = rd.create_pop_age_df().reset_index('libelle_dep').set_index('libelle_dep')
-    pop_age_df = pd.read_pickle('data/pop_age_df.pkl').reset_index('libelle_dep').set_index('libelle_dep')
+    pop_age_df = rd.load_pop_age_df().reset_index('libelle_dep').set_index('libelle_dep')
     pop_age_df = pop_age_df.stack().reset_index().rename(columns={'level_1': 'age_range',
                                                                   0: 'age_range_pop'})
     # manually fix dept names
@@ -155,43 +282,138 @@ def merge_rolling_by_age(metric_list, dept_age_df, n):
         
     return dept_age_df.reset_index()
 
-def create_dept_age_df(metrics = ['pos_rate', 'pos_100k', 'test_100k'], n=7):
-    df = create_testing_df(False)
-    dept_age_df = df.set_index(['libelle_dep', 'jour', 'age_range'])[['pos', 'tests_total']]
-    dept_age_df['pos_rate'] = dept_age_df['pos'].multiply(100).divide(dept_age_df['tests_total']).round(2)
-    dept_age_df = dept_age_df.reset_index()
-    
-    pop_age_df = create_pop_age_df()
-    
-    # merge pop data with age-dept df
-    dept_age_df = dept_age_df.merge(pop_age_df, on=['libelle_dep', 'age_range'], how='left').sort_values(['libelle_dep', 'jour'])
-    
-    # calc incidence & test rates
-    dept_age_df['pos_100k'] = dept_age_df['pos'].multiply(100000).divide(dept_age_df['age_range_pop']).round(2)
-    dept_age_df['test_100k'] = dept_age_df['tests_total'].multiply(100000).divide(dept_age_df['age_range_pop']).round(2)
-    
-    # add rolling columsn
-    
-    dept_age_df = merge_rolling_by_age(metrics, dept_age_df, n)
+@ins.instrumented()
+def create_dept_age_grid(df=None, metrics=['pos_rate', 'pos_100k', 'test_100k'], n=7):
+    '''Holds the dept & age testing data as dense (day x dept x age) arrays,
+    and computes all rolling metrics over the day axis in one pass.
+
+    Returns:
+        dict with the 'days' (datetime64), 'deps' (names, by dep_id) & 'ages' labels, the
+        row 'codes' of the testing df, one array per metric (& '<metric>_rolling'),
+        the (dept x age) 'age_range_pop' and the 'kept' mask of rows with a full
+        rolling window.'''
+
+    if df is None:
+        df = create_testing_df(False, as_datetime=True)
+    df = df.sort_values(['dep_id', 'jour'])
+
+    geo = rd.load_geo_index()
+    day_codes, days = pd.factorize(fd.parse_days(df['jour']), sort=True)
+    dep_codes = df['dep_id'].to_numpy()
+    age_codes, ages = pd.factorize(df['age_range'], sort=True)
+    codes = (day_codes, dep_codes, age_codes)
+    shape = (len(days), len(geo), len(ages))
+
+    grid = dict(days=days, deps=geo['libelle_dep'].to_numpy(), ages=ages, codes=codes)
+    grid['pos'] = to_grid(codes, df['pos'], shape)
+    grid['tests_total'] = to_grid(codes, df['tests_total'], shape)
+
+    # population by dept & age range, looked up by dept code (NaN if missing)
+    pop_age_df = rd.load_pop_age_df()
+    pop_dep_ids = rd.get_dep_ids(pop_age_df.index.get_level_values('dep'), geo=geo)
+    known = pop_dep_ids >= 0
+    pop = np.full(shape[1:], np.nan)
+    pop[pop_dep_ids[known]] = pop_age_df.reindex(columns=ages).to_numpy(dtype='float64')[known]
+    grid['age_range_pop'] = pop
+
+    # calc positivity, incidence & test rates
+    with np.errstate(divide='ignore', invalid='ignore'):
+        grid['pos_rate'] = (grid['pos'] * 100 / grid['tests_total']).round(2)
+        grid['pos_100k'] = (grid['pos'] * 100000 / grid['age_range_pop']).round(2)
+        grid['test_100k'] = (grid['tests_total'] * 100000 / grid['age_range_pop']).round(2)
+
+    # add rolling metrics
+    for metric in metrics:
+        grid['{}_rolling'.format(metric)] = rolling_mean_grid(grid[metric], n).round(2)
+
+    # rows of the dept-age df: they need a full window for every metric
+    kept = np.zeros(shape, dtype='bool')
+    kept[codes] = True
+    for metric in metrics:
+        kept &= ~np.isnan(grid['{}_rolling'.format(metric)])
+    grid['kept'] = kept
+
+    return grid
+
+@ins.instrumented()
+def create_dept_age_df(metrics = ['pos_rate', 'pos_100k', 'test_100k'], n=7, df=None, grid=None):
+    '''Rolling testing metrics by dept & age range, as a long df. Built
+    from the dept-age grid; df is the per-age testing df, and if neither
+    is given it's (re)built from the testing csv. jour is a 'YYYY-MM-DD' str.'''
+
+    if grid is None:
+        grid = create_dept_age_grid(df, metrics, n)
+
+    codes = grid['codes']
+    codes = tuple(c[grid['kept'][codes]] for c in codes)
+    day_codes, dep_codes, age_codes = codes
+
+    cols = {'libelle_dep': grid['deps'][dep_codes],
+            'jour': fd.format_days(grid['days'])[day_codes],
+            'age_range': grid['ages'][age_codes],
+            'age_range_pop': grid['age_range_pop'][dep_codes, age_codes]}
+    for col in ['pos', 'tests_total']:
+        cols[col] = grid[col][codes].astype('int64')
+    for metric in metrics:
+        rolling_name = '{}_rolling'.format(metric)
+        cols[metric] = grid[metric][codes]
+        cols[rolling_name] = grid[rolling_name][codes]
+
+    # make column order more logical
+    dept_age_df = pd.DataFrame(cols)
+    neworder = ['libelle_dep', 'jour'] + sorted(dept_age_df.columns[2:])
+    dept_age_df = dept_age_df[neworder]
 
     return dept_age_df
 
+# saved dept-age df, served by kpi_service
+dept_age_path = 'data/latest_dept_age.parquet'
+
+@ins.instrumented()
+def save_dept_age_df(df, path=dept_age_path):
+    df.to_parquet(path, index=False, compression='zstd')
+    print('Saved to {}'.format(path))
+    return path
+
 # group into above & below 70
 
-def calc_older_incid():
+older_ages = ['70-79', '80-89', '90+']
+
+def calc_older_incid_grid(grid, n=7, older=older_ages):
+    '''7d-rolling incidence rate for under 70s vs 70+, as
+    (day x dep_id) arrays on the dept-age grid's axes.
+
+    Returns:
+        dict of 'Under 70' & '70+' arrays'''
+
+    is_older = np.isin(grid['ages'], older)
+    kept = grid['kept']
+    pos = np.where(kept, np.nan_to_num(grid['pos']), 0)
+    pop = np.where(kept, np.nan_to_num(grid['age_range_pop']), 0)
+
+    older_incid = {}
+    for label, age_mask in [('Under 70', ~is_older), ('70+', is_older)]:
+        # calculate incidence rate
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pos_100k = (pos[..., age_mask].sum(axis=-1) * 100000 / pop[..., age_mask].sum(axis=-1)).round(2)
+        pos_100k[~kept[..., age_mask].any(axis=-1)] = np.nan
+        # make rolling 7-day totals
+        older_incid[label] = rolling_sum_grid(pos_100k, n)
+
+    return older_incid
+
+@ins.instrumented()
+def calc_older_incid(grid=None, n=7):
     '''creates a dataframe that compares 7d-rolling 
     incidence rate for under 70s vs 70+. 
-    70+ column is also a kpi for overview map of alert levels.'''
+    70+ column is also a kpi for overview map of alert levels.
+    Computed straight from the dept-age grid.'''
     
-    older = ['70-79', '80-89', '90+']
-    dept_age_df = create_dept_age_df()
-    dept_age_df['older'] = dept_age_df['age_range'].isin(older)
-    older_df = dept_age_df.groupby(['libelle_dep', 'jour', 'older'])[['pos', 'age_range_pop']].sum()
-
-    # calculate incidence rate
-    older_df['pos_100k'] = older_df['pos'].multiply(100000).div(older_df['age_range_pop']).round(2)
-    # make rolling 7-day totals
-    older_incid = older_df['pos_100k'].unstack(0).unstack().rolling(7).sum().stack(0)
-    older_incid.columns = ['Under 70', '70+']
+    if grid is None:
+        grid = create_dept_age_grid()
+
+    older_incid = {label: values.ravel() for label, values in calc_older_incid_grid(grid, n).items()}
+    index = pd.MultiIndex.from_product([fd.format_days(grid['days']), grid['deps']], names=['jour', 'libelle_dep'])
+    older_incid = pd.DataFrame(older_incid, index=index).dropna(how='all')
     
     return older_incid
@@ -0,0 +1,185 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+import process_test_data as pt
+import process_hosp_data as hd
+
+## Synthetic inputs ##
+
+# Same schemas as the real sources, at any scale, so the pipeline can be
+# timed without downloading anything:
+#   testing.csv         SI-DEP testing csv (make_df)
+#   hosp.csv            hospital csv (get_hosp_data)
+#   new_admissions.csv  new hospital admissions csv (get_new_admissions)
+#   reg_ref_df.pkl      region lookup (rd.load_reg_ref_df)
+#   pop_age_df.pkl      population by age (rd.load_pop_age_df)
+
+# SI-DEP age classes (0 = all ages)
+age_classes = [9, 19, 29, 39, 49, 59, 69, 79, 89, 90]
+
+start_date = '2020-03-18'
+
+# dates the real hospital feed has in dd/mm/yyyy
+hosp_bad_dates = ['2020-06-27', '2020-06-28', '2020-06-29']
+
+
+def make_geography(n_depts=101, seed=0):
+    '''Region lookup with reg_ref_df's columns: one DOM-TOM region per
+    dept for the last depts (up to 5), metro depts in regions of 8.'''
+
+    rng = np.random.default_rng(seed)
+    n_dom = min(5, n_depts // 20)
+    n_metro = n_depts - n_dom
+
+    reg = np.r_[11 + np.arange(n_metro) // 8, 1 + np.arange(n_dom)]
+    dep = ['{:02d}'.format(i + 1) for i in range(n_metro)] + ['{}'.format(971 + i) for i in range(n_dom)]
+    # a Corsica code, so dep stays a str column when csvs are read without dtypes
+    dep[min(19, n_metro - 1)] = '2A'
+
+    reg_ref_df = pd.DataFrame({'reg': reg,
+                               'libelle_reg': ['Région {}'.format(r) for r in reg],
+                               'dep': dep,
+                               'libelle_dep': ['Département {}'.format(d) for d in dep],
+                               'ICU_beds': rng.integers(10, 300, n_depts).astype('float64'),
+                               'population': rng.integers(80000, 2500000, n_depts).astype('float64')})
+
+    return reg_ref_df
+
+
+def make_pop_age_df(reg_ref_df, seed=0):
+    '''Population by 10-year age group, shaped like rd.create_pop_age_df().'''
+
+    rng = np.random.default_rng(seed)
+    age_ranges = pt.make_age_ranges(age_classes)
+    shares = rng.dirichlet(np.full(len(age_ranges), 8.), len(reg_ref_df))
+    pop = np.round(shares * reg_ref_df[['population']].to_numpy())
+
+    index = pd.MultiIndex.from_frame(reg_ref_df[['dep', 'libelle_dep']])
+    return pd.DataFrame(pop, index=index, columns=age_ranges)
+
+
+def make_epidemic(n_days, n_series, seed=0, scale=1.):
+    '''Smooth random waves, one column per series: (n_days x n_series).'''
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_days)[:, None]
+    period = rng.uniform(120, 240, n_series)
+    phase = rng.uniform(0, 2 * np.pi, n_series)
+    return scale * (1.2 + np.sin(2 * np.pi * t / period + phase))
+
+
+def make_testing_df(reg_ref_df, pop_age_df, n_days=300, seed=0):
+    '''SI-DEP testing rows (dep;jour;P;T;cl_age90): one row per day, dept
+    & age class, plus the cl_age90=0 rows that sum all ages.'''
+
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start_date, periods=n_days).strftime('%Y-%m-%d')
+    n_depts, n_ages = pop_age_df.shape
+
+    pop = pop_age_df.to_numpy()                                        # dept x age
+    test_rate = make_epidemic(n_days, n_depts, seed, 0.0015)[..., None]   # day x dept x 1
+    tests = rng.poisson(test_rate * pop)                               # day x dept x age
+    pos_rate = make_epidemic(n_days, n_depts, seed + 1, 0.04)[..., None]
+    pos = rng.binomial(tests, np.clip(pos_rate, 0, 1))
+
+    tests = np.concatenate([tests, tests.sum(axis=-1, keepdims=True)], axis=-1)
+    pos = np.concatenate([pos, pos.sum(axis=-1, keepdims=True)], axis=-1)
+    ages = age_classes + [0]
+
+    day_idx, dep_idx, age_idx = np.indices(tests.shape).reshape(3, -1)
+    df = pd.DataFrame({'dep': reg_ref_df['dep'].to_numpy()[dep_idx],
+                       'jour': days.to_numpy()[day_idx],
+                       'P': pos.ravel(),
+                       'T': tests.ravel(),
+                       'cl_age90': np.array(ages)[age_idx]})
+
+    return df
+
+
+def make_hosp_df(reg_ref_df, n_days=300, seed=0):
+    '''Hospital rows (dep;sexe;jour;hosp;rea;rad;dc): sexe 1 & 2, plus the
+    sexe=0 rows that sum them. A few dates use dd/mm/yyyy, like the real feed.'''
+
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start_date, periods=n_days).strftime('%Y-%m-%d')
+    n_depts = len(reg_ref_df)
+
+    beds = reg_ref_df['ICU_beds'].to_numpy()
+    load = make_epidemic(n_days, n_depts, seed + 2, 0.25)[..., None] * beds[:, None]   # day x dept x 1
+    rea = rng.poisson(np.repeat(load / 2, 2, axis=-1))                                  # day x dept x sexe
+    hosp = rng.poisson(np.repeat(load * 2, 2, axis=-1))
+    rad = np.cumsum(rng.poisson(hosp / 10), axis=0)
+    dc = np.cumsum(rng.poisson(rea / 20), axis=0)
+
+    counts = {}
+    for col, values in [('hosp', hosp), ('rea', rea), ('rad', rad), ('dc', dc)]:
+        counts[col] = np.concatenate([values.sum(axis=-1, keepdims=True), values], axis=-1).ravel()
+
+    day_idx, dep_idx, sexe = np.indices((n_days, n_depts, 3)).reshape(3, -1)
+    jour = days.to_numpy()[day_idx]
+    for date in hosp_bad_dates:
+        jour[jour == date] = pd.to_datetime(date).strftime('%d/%m/%Y')
+
+    df = pd.DataFrame({'dep': reg_ref_df['dep'].to_numpy()[dep_idx],
+                       'sexe': sexe,
+                       'jour': jour,
+                       **counts})
+
+    return df
+
+
+def make_new_admissions_df(reg_ref_df, n_days=300, seed=0):
+    '''New admissions rows (dep;jour;incid_hosp;incid_rea;incid_dc;incid_rad).'''
+
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(start_date, periods=n_days).strftime('%Y-%m-%d')
+    n_depts = len(reg_ref_df)
+
+    rate = make_epidemic(n_days, n_depts, seed + 3, 0.02) * reg_ref_df['ICU_beds'].to_numpy()
+    cols = {'incid_hosp': rng.poisson(rate * 4),
+            'incid_rea': rng.poisson(rate),
+            'incid_dc': rng.poisson(rate / 3),
+            'incid_rad': rng.poisson(rate * 3)}
+
+    day_idx, dep_idx = np.indices((n_days, n_depts)).reshape(2, -1)
+    df = pd.DataFrame({'dep': reg_ref_df['dep'].to_numpy()[dep_idx],
+                       'jour': days.to_numpy()[day_idx],
+                       **{col: values.ravel() for col, values in cols.items()}})
+
+    return df
+
+
+def generate(path, n_depts=101, n_days=300, seed=0):
+    '''Writes every synthetic input under path/data/, with the file
+    names the pipeline expects when run from path.
+
+    Returns:
+        dict of source url -> local csv, for fetch_data.local_sources'''
+
+    data_path = Path(path).joinpath('data')
+    data_path.mkdir(parents=True, exist_ok=True)
+
+    reg_ref_df = make_geography(n_depts, seed)
+    pop_age_df = make_pop_age_df(reg_ref_df, seed)
+    reg_ref_df.to_pickle(data_path.joinpath('reg_ref_df.pkl'))
+    pop_age_df.to_pickle(data_path.joinpath('pop_age_df.pkl'))
+
+    csvs = {pt.url: ('testing.csv', make_testing_df(reg_ref_df, pop_age_df, n_days, seed)),
+            hd.hosp_url: ('hosp.csv', make_hosp_df(reg_ref_df, n_days, seed)),
+            hd.new_patients_url: ('new_admissions.csv', make_new_admissions_df(reg_ref_df, n_days, seed))}
+
+    local_sources = {}
+    for url, (fname, df) in csvs.items():
+        csv_path = data_path.joinpath(fname)
+        df.to_csv(csv_path, sep=';', index=False)
+        local_sources[url] = str(csv_path.resolve())
+
+    return local_sources
+
+
+if __name__=='__main__':
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else 'data/bench/'
+    for url, csv_path in generate(path).items():
+        print("{} <- {}".format(csv_path, url))
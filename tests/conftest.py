@@ -0,0 +1,119 @@
+import sys
+import time
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# the modules live at the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+class StubServer:
+    '''Local HTTP stand-in for the remote sources, on a free port.
+
+    routes: path -> dict of
+        body: bytes served with a 200
+        etag, last_modified: validators sent with the body. A request
+            carrying a matching one gets a 304 instead
+        errors: status codes answered, in order, before the body is served
+        delay: seconds to wait before answering
+
+    Every answer is recorded in `responses` as (path, status, request
+    headers), and `max_active` is the most requests handled at once.'''
+
+    def __init__(self):
+        self.routes = {}
+        self.responses = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.port, path)
+
+    def statuses(self, path):
+        return [status for p, status, headers in self.responses if p == path]
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def _make_handler(server):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._answer(self)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _answer(self, request):
+        route = self.routes.get(request.path)
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(route.get('delay', 0) if route else 0)
+
+        headers = {}
+        with self._lock:
+            self.active -= 1
+            if route is None:
+                status = 404
+            elif route.get('errors'):
+                status = route['errors'].pop(0)
+            elif ((route.get('etag') and request.headers.get('If-None-Match') == route['etag']) or
+                  (route.get('last_modified') and request.headers.get('If-Modified-Since') == route['last_modified'])):
+                status = 304
+            else:
+                status = 200
+                if route.get('etag'):
+                    headers['ETag'] = route['etag']
+                if route.get('last_modified'):
+                    headers['Last-Modified'] = route['last_modified']
+            self.responses.append((request.path, status, dict(request.headers)))
+
+        if status == 200:
+            request.send_response(200)
+            for name, value in headers.items():
+                request.send_header(name, value)
+            request.send_header('Content-Length', str(len(route['body'])))
+            request.end_headers()
+            request.wfile.write(route['body'])
+        elif status == 304:
+            request.send_response(304)
+            request.end_headers()
+        else:
+            request.send_error(status)
+
+
+@pytest.fixture
+def server():
+    stub = StubServer()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def synthetic(monkeypatch, tmp_path):
+    '''Runs a test against small synthetic inputs (benchmark.synthetic_inputs):
+    remote csvs are served from local files, and the working dir is a
+    bench dir under tmp_path. Yields that dir.'''
+
+    import fetch_data as fd
+    import benchmark as bm
+
+    monkeypatch.setattr(bm, 'bench_path', str(tmp_path))
+    fd.clear_prefetched()
+    with bm.synthetic_inputs(24, 60) as path:
+        yield path
+    fd.clear_prefetched()
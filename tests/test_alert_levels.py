@@ -0,0 +1,45 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import process_kpi as kpi
+
+# each indicator at, just above & just below every threshold the rules use,
+# plus missing values
+incid_values = [np.nan, 0., 49.99, 50., 50.01, 149.99, 150., 150.01, 249.99, 250., 250.01, 1000.]
+incid_70_values = [np.nan, 0., 50., 50.01, 99.99, 100., 100.01, 500.]
+rea_values = [np.nan, 0., 29.99, 30., 30.01, 59.99, 60., 60.01, 150.]
+
+
+@pytest.fixture
+def kpi_df():
+    rows = list(itertools.product(incid_values, incid_70_values, rea_values))
+    return pd.DataFrame(rows, columns=kpi.alert_cols)
+
+
+def rowwise_levels(df):
+    return pd.Categorical(df.apply(kpi.assign_overall_alert, axis=1),
+                          categories=kpi.alert_levels, ordered=True)
+
+
+def test_vectorized_levels_match_rowwise_rules(kpi_df):
+    expected = rowwise_levels(kpi_df)
+    alert = kpi.assign_alert_levels(kpi_df)
+
+    assert isinstance(alert, pd.Categorical) and alert.ordered
+    pd.testing.assert_series_equal(pd.Series(alert), pd.Series(expected))
+
+
+def test_fixture_reaches_every_rule(kpi_df):
+    levels = set(rowwise_levels(kpi_df).dropna())
+    assert levels == {level for level, conditions in kpi.alert_rules} | {kpi.default_alert}
+
+
+def test_any_missing_indicator_means_no_level(kpi_df):
+    alert = pd.Series(kpi.assign_alert_levels(kpi_df))
+    any_missing = kpi_df[kpi.alert_cols].isna().any(axis=1)
+
+    assert alert[any_missing].isna().all()
+    assert alert[~any_missing].notna().all()
@@ -0,0 +1,80 @@
+import base64
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dashboard as db
+
+
+@pytest.fixture(autouse=True)
+def no_geometry(monkeypatch):
+    monkeypatch.setattr(db.gd, 'get_fr_dept', lambda: {})
+    monkeypatch.setattr(db.gd, 'get_fr_region', lambda: {})
+
+
+def decode(b64, shape):
+    return np.frombuffer(base64.b64decode(b64), dtype='<f4').reshape(shape)
+
+
+@pytest.fixture
+def kpi_df():
+    # two depts of the same region, very different populations
+    return pd.DataFrame({'libelle_dep': ['Ain', 'Ain', 'Rhône', 'Rhône', 'Guadeloupe'],
+                         'reg': [84, 84, 84, 84, 1],
+                         'libelle_reg': ['Auvergne-Rhône-Alpes'] * 4 + ['Guadeloupe'],
+                         'dom_tom': ['False'] * 4 + ['True'],
+                         'jour': ['2020-11-01', '2020-11-02'] * 2 + ['2020-11-02'],
+                         'incid_tous': [10., 20., 100., 200., 50.],
+                         'incid_70+': [1., 2., 3., 4., 5.],
+                         'rea%': [40., 50., 40., 50., np.nan],
+                         'rea%_dep': [10., 20., 60., 70., np.nan],
+                         'niveau_global': ['OK', 'Alerte', 'Alerte', 'Alerte maximale', np.nan]})
+
+
+@pytest.fixture
+def cube():
+    # weighted rollups, as process_kpi.build_kpi_cube writes them
+    rows = [('fr', 'metro', '2020-11-01', 90., 2.5, 40.),
+            ('fr', 'metro', '2020-11-02', 180., 3.5, 50.),
+            ('reg', '1', '2020-11-02', 50., 5., np.nan),
+            ('reg', '84', '2020-11-01', 90., 2.5, 40.),
+            ('reg', '84', '2020-11-02', 180., 3.5, 50.)]
+    cube = pd.DataFrame(rows, columns=['level', 'area', 'jour', 'incid_tous', 'incid_70+', 'rea%'])
+    return cube.set_index(['level', 'area', 'jour']).sort_index()
+
+
+def test_metro_trends_come_from_the_cube(kpi_df, cube):
+    data = db.make_dashboard_data(kpi_df, cube)
+
+    metro = decode(data['rollups']['metro']['incid_tous'], (2, 1))
+    # the weighted rollup, not the mean of the two metro depts (60 & 110)
+    assert metro[:, 0].tolist() == [90., 180.]
+
+
+def test_region_rollups_follow_the_regions_order(kpi_df, cube):
+    data = db.make_dashboard_data(kpi_df, cube)
+
+    assert list(data['regions']) == ['1', '84']
+    incid = decode(data['rollups']['reg']['incid_tous'], (2, 2))
+    assert np.isnan(incid[0, 0]) and incid[1, 0] == 50.
+    assert incid[:, 1].tolist() == [90., 180.]
+    assert np.isnan(decode(data['rollups']['reg']['rea%'], (2, 2))[:, 0]).all()
+
+
+def test_page_title_describes_the_rollup(kpi_df, cube, tmp_path):
+    page_file, data_file = db.write_dashboard(kpi_df, cube, tmp_path)
+
+    page = page_file.read_text()
+    assert '(metropolitan France, all depts combined)' in page
+    assert 'daily avg' not in page
+    assert data_file.exists()
+
+
+def test_levels_colors_and_thresholds_are_the_kpi_rules(kpi_df, cube):
+    data = db.make_dashboard_data(kpi_df, cube)
+
+    assert data['levels'] == db.kr.levels
+    assert data['colors'][data['levels'].index('Alerte')] == db.kr.colors['Alerte']
+    assert data['thresholds'] == {'incid_tous': [50., 150., 250.], 'incid_70+': [50., 100.], 'rea%': [30., 60.]}
+    assert '[50, 150, 250]' not in db.dashboard_html
@@ -0,0 +1,238 @@
+import pytest
+
+import fetch_data as fd
+
+last_modified = 'Mon, 02 Nov 2020 10:00:00 GMT'
+
+
+@pytest.fixture(autouse=True)
+def session(monkeypatch, tmp_path):
+    '''No state shared with other tests: fresh session, no retry waits,
+    and default cache paths under tmp_path.'''
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(fd, 'retry_backoff', 0.)
+    monkeypatch.setattr(fd, 'local_sources', {})
+    fd.clear_prefetched()
+    yield
+    fd.clear_prefetched()
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path.joinpath('cache'))
+
+
+def blob_count(cache_dir):
+    return sum(p.is_file() for p in fd.Path(cache_dir).joinpath('blobs').rglob('*'))
+
+
+## fetch: validators ##
+
+def test_fetch_downloads_then_revalidates_with_etag(server, cache_dir):
+    server.routes['/tests.csv'] = dict(body=b'dep;jour;P\n01;2020-11-01;3\n', etag='"v1"',
+                                       last_modified=last_modified)
+    url = server.url('/tests.csv')
+
+    first = fd.fetch(url, cache_dir=cache_dir, offline=False)
+    second = fd.fetch(url, cache_dir=cache_dir, offline=False)
+
+    assert first == second == b'dep;jour;P\n01;2020-11-01;3\n'
+    assert server.statuses('/tests.csv') == [200, 304]
+    revalidation = server.responses[1][2]
+    assert revalidation['If-None-Match'] == '"v1"'
+    assert revalidation['If-Modified-Since'] == last_modified
+
+    entry = fd.load_index(cache_dir)[url]
+    assert entry['etag'] == '"v1"'
+    assert entry['last_modified'] == last_modified
+    assert entry['size'] == len(first)
+
+
+def test_fetch_revalidates_with_last_modified_only(server, cache_dir):
+    server.routes['/hosp.csv'] = dict(body=b'hosp', last_modified=last_modified)
+    url = server.url('/hosp.csv')
+
+    fd.fetch(url, cache_dir=cache_dir, offline=False)
+    assert fd.fetch(url, cache_dir=cache_dir, offline=False) == b'hosp'
+
+    assert server.statuses('/hosp.csv') == [200, 304]
+    assert 'If-None-Match' not in server.responses[1][2]
+
+
+def test_fetch_replaces_a_changed_source(server, cache_dir):
+    server.routes['/tests.csv'] = dict(body=b'old', etag='"v1"')
+    url = server.url('/tests.csv')
+    fd.fetch(url, cache_dir=cache_dir, offline=False)
+
+    server.routes['/tests.csv'] = dict(body=b'new', etag='"v2"')
+    assert fd.fetch(url, cache_dir=cache_dir, offline=False) == b'new'
+
+    assert server.statuses('/tests.csv') == [200, 200]
+    assert fd.load_index(cache_dir)[url]['etag'] == '"v2"'
+
+
+## fetch: offline & unreachable server ##
+
+def test_offline_serves_cached_bytes(server, cache_dir):
+    server.routes['/tests.csv'] = dict(body=b'cached', etag='"v1"')
+    url = server.url('/tests.csv')
+    fd.fetch(url, cache_dir=cache_dir, offline=False)
+
+    assert fd.fetch(url, cache_dir=cache_dir, offline=True) == b'cached'
+    assert len(server.responses) == 1
+
+
+def test_offline_uncached_url_raises(server, cache_dir):
+    server.routes['/tests.csv'] = dict(body=b'never fetched')
+
+    with pytest.raises(FileNotFoundError):
+        fd.fetch(server.url('/tests.csv'), cache_dir=cache_dir, offline=True)
+    assert server.responses == []
+
+
+def test_unreachable_server_falls_back_to_cached_copy(server, cache_dir):
+    server.routes['/tests.csv'] = dict(body=b'last good copy', etag='"v1"')
+    url = server.url('/tests.csv')
+    fd.fetch(url, cache_dir=cache_dir, offline=False)
+
+    server.stop()
+    assert fd.fetch(url, cache_dir=cache_dir, offline=False, timeout=5, retries=0) == b'last good copy'
+
+
+def test_unreachable_server_without_cached_copy_raises(server, cache_dir):
+    url = server.url('/tests.csv')
+    server.stop()
+
+    with pytest.raises(OSError):
+        fd.fetch(url, cache_dir=cache_dir, offline=False, timeout=5, retries=0)
+
+
+## eviction ##
+
+def test_identical_payloads_share_one_blob(server, cache_dir):
+    server.routes['/a.csv'] = dict(body=b'same bytes')
+    server.routes['/b.csv'] = dict(body=b'same bytes')
+
+    fd.fetch(server.url('/a.csv'), cache_dir=cache_dir, offline=False)
+    fd.fetch(server.url('/b.csv'), cache_dir=cache_dir, offline=False)
+
+    index = fd.load_index(cache_dir)
+    assert index[server.url('/a.csv')]['sha256'] == index[server.url('/b.csv')]['sha256']
+    assert blob_count(cache_dir) == 1
+
+
+def test_evict_drops_least_recently_used_and_keeps_shared_blobs(cache_dir):
+    shared = fd._write_blob(b'x' * 10, cache_dir)
+    other = fd._write_blob(b'y' * 10, cache_dir)
+    index = {'oldest': {'sha256': shared, 'size': 10, 'last_used': 1.},
+             'middle': {'sha256': other, 'size': 10, 'last_used': 2.},
+             'newest': {'sha256': shared, 'size': 10, 'last_used': 3.}}
+
+    # both blobs fit: nothing to do
+    assert set(fd.evict(dict(index), cache_dir, max_bytes=20)) == {'oldest', 'middle', 'newest'}
+
+    # 'oldest' goes first, but its blob is still used by 'newest'
+    index = fd.evict(index, cache_dir, max_bytes=10)
+
+    assert set(index) == {'newest'}
+    assert fd._blob_path(cache_dir, shared).exists()
+    assert not fd._blob_path(cache_dir, other).exists()
+
+
+def test_fetch_evicts_beyond_max_bytes(server, cache_dir):
+    server.routes['/a.csv'] = dict(body=b'a' * 10)
+    server.routes['/b.csv'] = dict(body=b'b' * 10)
+
+    fd.fetch(server.url('/a.csv'), cache_dir=cache_dir, offline=False, max_bytes=15)
+    fd.fetch(server.url('/b.csv'), cache_dir=cache_dir, offline=False, max_bytes=15)
+
+    assert set(fd.load_index(cache_dir)) == {server.url('/b.csv')}
+    assert blob_count(cache_dir) == 1
+
+
+## fetch_all ##
+
+def test_fetch_all_runs_at_most_max_workers_at_once(server, cache_dir):
+    for i in range(6):
+        server.routes['/src{}.csv'.format(i)] = dict(body='source {}'.format(i).encode(), delay=0.2)
+    urls = [server.url('/src{}.csv'.format(i)) for i in range(6)]
+
+    paths = fd.fetch_all(urls, max_workers=2, cache_dir=cache_dir)
+
+    assert server.max_active == 2
+    assert [paths[url].read_bytes() for url in urls] == ['source {}'.format(i).encode() for i in range(6)]
+
+
+def test_fetch_all_retries_server_errors(server, cache_dir):
+    server.routes['/tests.csv'] = dict(body=b'second time lucky', errors=[500])
+    url = server.url('/tests.csv')
+
+    paths = fd.fetch_all([url], cache_dir=cache_dir, retries=1)
+
+    assert server.statuses('/tests.csv') == [500, 200]
+    assert paths[url].read_bytes() == b'second time lucky'
+
+
+def test_fetch_all_reports_every_failure_together(server, cache_dir):
+    server.routes['/ok.csv'] = dict(body=b'ok')
+    server.routes['/down.csv'] = dict(body=b'never served', errors=[503, 503])
+    urls = [server.url(p) for p in ['/ok.csv', '/missing.csv', '/down.csv']]
+
+    with pytest.raises(RuntimeError) as excinfo:
+        fd.fetch_all(urls, cache_dir=cache_dir, retries=1)
+
+    message = str(excinfo.value)
+    assert message.startswith('2 source(s) could not be fetched')
+    assert server.url('/missing.csv') in message and '404' in message
+    assert server.url('/down.csv') in message and '503' in message
+    assert server.url('/ok.csv') not in message
+
+    # a 404 isn't retried, a 503 is
+    assert server.statuses('/missing.csv') == [404]
+    assert server.statuses('/down.csv') == [503, 503]
+    # the sources that could be fetched are still served
+    assert fd.fetch(server.url('/ok.csv')) == b'ok'
+    assert server.statuses('/ok.csv') == [200]
+
+
+def test_fetch_all_keeps_sources_on_disk_only(server, cache_dir):
+    server.routes['/tests.csv'] = dict(body=b'dep;jour;P\n' * 1000, etag='"v1"')
+    url = server.url('/tests.csv')
+
+    fd.fetch_all([url], cache_dir=cache_dir)
+
+    assert all(isinstance(path, fd.Path) for path in fd._prefetched.values())
+    # later reads use the cached file, without another request
+    with fd.open_source(url) as f:
+        assert fd.Path(f.name).is_relative_to(cache_dir)
+        assert f.read() == b'dep;jour;P\n' * 1000
+    assert fd.fetch(url) == b'dep;jour;P\n' * 1000
+    assert server.statuses('/tests.csv') == [200]
+
+    # until the session is cleared: then it's revalidated
+    fd.clear_prefetched()
+    fd.fetch(url, cache_dir=cache_dir, offline=False)
+    assert server.statuses('/tests.csv') == [200, 304]
+
+
+## dates ##
+
+def test_parse_days_reads_every_day_format():
+    days = fd.parse_days(['2020-06-26', '27/06/2020', '2020-06-26', None])
+
+    assert days.dtype == 'datetime64[ns]'
+    assert list(fd.format_days(days)[:3]) == ['2020-06-26', '2020-06-27', '2020-06-26']
+    assert fd.np.isnat(days[3])
+
+
+def test_format_days_gives_iso_strings_and_nan():
+    strings = fd.format_days(fd.parse_days(['2020-11-01', None]))
+
+    assert strings[0] == '2020-11-01' and isinstance(strings[0], str)
+    assert fd.pd.isna(strings[1])
+
+
+def test_parse_days_rejects_unknown_formats():
+    with pytest.raises(ValueError):
+        fd.parse_days(['2020-11-01', '11.01.2020'])
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import process_kpi as kpi
+
+
+@pytest.fixture
+def kpi_df():
+    # rea% lags a day behind incidence; day formats as in the sources
+    return pd.DataFrame({'libelle_dep': ['Ain', 'Aisne'] * 3,
+                         'jour': ['2020-10-31', '2020-10-31', '01/11/2020', '01/11/2020', '2020-11-02', '2020-11-02'],
+                         'incid_tous': [1., 2., 3., 4., 5., np.nan],
+                         'rea%': [10., 20., 30., np.nan, np.nan, np.nan],
+                         'x': np.nan})
+
+
+def test_latest_day_with_a_value(kpi_df):
+    latest = kpi.get_latest('incid_tous', kpi_df)
+
+    assert latest.name == '2020-11-02'
+    assert latest['libelle_dep'].tolist() == ['Ain', 'Aisne']
+    assert 'jour' not in latest.columns
+
+
+def test_days_are_compared_as_dates(kpi_df):
+    # '01/11/2020' sorts before '2020-10-31' as a string
+    assert kpi.get_latest('rea%', kpi_df).name == '01/11/2020'
+
+
+def test_column_without_values_gives_empty_frame(kpi_df):
+    latest = kpi.get_latest('x', kpi_df)
+
+    assert latest.empty
+    assert np.isnan(latest.name)
+    assert list(latest.columns) == ['libelle_dep', 'incid_tous', 'rea%', 'x']
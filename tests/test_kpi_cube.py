@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import process_kpi as kpi
+
+days = ['2020-11-01', '2020-11-02']
+
+
+@pytest.fixture
+def geo():
+    # a small and a big dept, a dept without ICU beds & a DOM-TOM dept
+    reg_ref_df = pd.DataFrame({'reg': [84, 84, 84, 1],
+                               'libelle_reg': ['Auvergne-Rhône-Alpes'] * 3 + ['Guadeloupe'],
+                               'dep': ['01', '69', '15', '971'],
+                               'libelle_dep': ['Ain', 'Rhône', 'Cantal', 'Guadeloupe'],
+                               'ICU_beds': [10., 90., 0., 20.],
+                               'population': [100000., 900000., 100000., 400000.]})
+    return kpi.rd.create_geo_index(reg_ref_df)
+
+
+@pytest.fixture
+def rea_df():
+    # ICU patients as reported: Ain's 2nd day is missing
+    index = pd.MultiIndex.from_tuples([(0, days[0]), (1, days[0]), (1, days[1]), (2, days[0]),
+                                       (2, days[1]), (3, days[0]), (3, days[1])], names=['dep_id', 'jour'])
+    return pd.DataFrame({'rea': [3, 45, 54, 7, 7, 4, 6]},
+                        index=index.set_levels(pd.to_datetime(index.levels[1]), level='jour'))
+
+
+@pytest.fixture(autouse=True)
+def stub_inputs(monkeypatch, geo, rea_df):
+    monkeypatch.setattr(kpi.rd, 'load_geo_index', lambda: geo)
+    monkeypatch.setattr(kpi, 'get_cube_weights', lambda geo=None: {
+        'population': geo['population'].to_numpy(),
+        'population_70+': geo['population'].to_numpy() / 10,
+        'ICU_beds': geo['ICU_beds'].to_numpy()})
+    monkeypatch.setattr(kpi.hd, 'create_rea_df', lambda level, start=None: rea_df)
+
+
+@pytest.fixture
+def kpi_df():
+    return pd.DataFrame({'libelle_dep': ['Ain', 'Ain', 'Rhône', 'Rhône', 'Cantal', 'Cantal', 'Guadeloupe', 'Guadeloupe'],
+                         'jour': days * 4,
+                         'incid_tous': [50., 60., 150., 160., 500., 500., 80., 90.],
+                         'incid_70+': [10., 20., 30., 40., np.nan, np.nan, 50., 60.],
+                         # Ain's 2nd day ffilled, as in the kpi df
+                         'rea%_dep': [30., 30., 50., 60., np.nan, np.nan, 20., 30.]})
+
+
+@pytest.fixture
+def cube(kpi_df):
+    return kpi.index_kpi_cube(kpi.build_kpi_cube(kpi_df))
+
+
+def test_region_incidence_is_pooled_positives_per_pooled_population(cube):
+    reg = cube.loc[('reg', '84', days[0])]
+
+    # Ain, Rhône & Cantal: 50 + 1350 + 500 positives per 1.1M people
+    assert reg['incid_tous'] == pytest.approx((50 + 1350 + 500) * 100000 / 1100000, abs=0.01)
+    assert reg['incid_tous'] != pytest.approx((50 + 150 + 500) / 3, abs=0.01)
+    assert reg['pos_7d'] == 1900
+
+
+def test_depts_without_denominator_are_left_out(cube):
+    reg = cube.loc[('reg', '84', days[0])]
+
+    # Cantal has neither ICU beds nor an incid_70+
+    assert reg['rea%'] == pytest.approx((3 + 45) * 100 / 100, abs=0.01)
+    assert reg['incid_70+'] == pytest.approx((1 + 27) * 100000 / 100000, abs=0.01)
+    assert reg['rea'] == 48
+    # but is still a row of its own
+    assert cube.loc[('dep', '15', days[0]), 'incid_tous'] == 500
+
+
+def test_metro_and_dom_tom_split(cube):
+    metro = cube.loc[('fr', 'metro')]
+    dom_tom = cube.loc[('fr', 'dom_tom')]
+    fr = cube.loc[('fr', 'fr')]
+
+    assert dom_tom['incid_tous'].tolist() == [80., 90.]
+    assert metro.loc[days[0], 'incid_tous'] == pytest.approx(1900 * 100000 / 1100000, abs=0.01)
+    assert fr.loc[days[0], 'pos_7d'] == metro.loc[days[0], 'pos_7d'] + dom_tom.loc[days[0], 'pos_7d']
+    assert cube.loc['reg'].index.get_level_values('area').unique().tolist() == ['1', '84']
+
+
+def test_icu_patients_are_the_reported_counts(cube):
+    # not rebuilt from the rounded rea%_dep x ICU beds
+    assert cube.loc[('dep', '69', days[1]), 'rea'] == 54
+    # Ain reported nothing, Cantal has no ICU beds
+    assert cube.loc[('fr', 'metro', days[1]), 'rea'] == 54
+    assert cube.loc[('fr', 'fr', days[1]), 'rea'] == 54 + 6
+    # no count reported: no ICU patients, though rea% was filled forward
+    assert np.isnan(cube.loc[('dep', '01', days[1]), 'rea'])
+    assert cube.loc[('dep', '01', days[1]), 'rea%'] == 30.
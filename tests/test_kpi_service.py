@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+import kpi_service as ks
+import process_kpi as kpi
+
+
+def make_kpi_df(rea):
+    df = pd.DataFrame({'reg': [11, 11, 84],
+                       'libelle_reg': ['Île-de-France', 'Île-de-France', 'Auvergne-Rhône-Alpes'],
+                       'libelle_dep': ['Paris', 'Paris', 'Rhône'],
+                       'jour': ['2020-11-01', '2020-11-02', '2020-11-01'],
+                       'dom_tom': ['False'] * 3,
+                       'incid_tous': [300., 280., 500.],
+                       'incid_70+': [200., 190., 400.],
+                       'rea%': rea,
+                       'rea%_dep': rea,
+                       'niveau_global': ['Alerte maximale'] * 3})
+    return df
+
+
+@pytest.fixture
+def kpi_paths(tmp_path):
+    '''Two saved kpi dfs, partitioned like save_df's.'''
+
+    paths = {}
+    for name, rea in [('latest', [61., 62., 90.]), ('other', [31., 32., 40.])]:
+        path = tmp_path.joinpath('{}_kpi.parquet'.format(name))
+        make_kpi_df(rea).to_parquet(path, partition_cols=['reg'])
+        paths[name] = str(path)
+    return paths
+
+
+def test_store_reads_its_own_dataset_path(kpi_paths):
+    store = ks.KpiStore(datasets={'kpi': kpi_paths['other']})
+
+    rows = store.query('kpi', dep='Paris', cols=['rea%'])
+
+    assert rows['rea%'].tolist() == [31., 32.]
+    assert store.status()['kpi']['path'] == kpi_paths['other']
+
+
+def test_read_kpi_restores_dtypes(kpi_paths):
+    df = kpi.read_kpi(path=kpi_paths['latest'])
+
+    assert list(df.columns) == kpi.kpi_cols
+    assert df['reg'].dtype == 'int'
+    assert df['niveau_global'].dtype == pd.CategoricalDtype(kpi.alert_levels, ordered=True)
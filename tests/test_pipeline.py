@@ -0,0 +1,170 @@
+import json
+from pathlib import Path
+
+import pytest
+
+import pipeline
+
+# paths each stage function was called with, in this process
+calls = []
+
+
+def write(path, text):
+    calls.append(path)
+    Path(path).write_text(text)
+
+
+def write_mode(path, update=False):
+    write(path, 'kpis')
+    calls.append(('update', update))
+
+
+def rewrite(path, text):
+    write(path, text)
+
+
+def fail(path):
+    calls.append(path)
+    raise ValueError("no data")
+
+
+def do_nothing(path):
+    calls.append(path)
+
+
+@pytest.fixture
+def stages(monkeypatch, tmp_path):
+    '''A small graph: a -> b -> c, plus d on its own. Each writes <name>.txt.
+    The stages in play are in `stages`, and can be swapped by a test.'''
+
+    monkeypatch.chdir(tmp_path)
+    calls.clear()
+    graph = {'a': pipeline.Stage('a', write, ('a.txt', 'A'), [], [], ['a.txt'], False),
+             'b': pipeline.Stage('b', write, ('b.txt', 'B'), ['a'], [], ['b.txt'], False),
+             'c': pipeline.Stage('c', write, ('c.txt', 'C'), ['b'], [], ['c.txt'], False),
+             'd': pipeline.Stage('d', write, ('d.txt', 'D'), [], [], ['d.txt'], False)}
+    monkeypatch.setattr(pipeline, 'get_stages', lambda update=False: graph)
+    return graph
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path.joinpath('state.json'))
+
+
+def run(state_path, targets=None, **kwargs):
+    calls.clear()
+    return pipeline.run(targets, jobs=1, state_path=state_path, **kwargs)
+
+
+def test_builds_every_stage_then_nothing(stages, state_path):
+    assert set(run(state_path).values()) == {'built'}
+    assert calls == ['a.txt', 'b.txt', 'c.txt', 'd.txt']
+    assert set(json.load(open(state_path))) == {'a', 'b', 'c', 'd'}
+
+    assert set(run(state_path).values()) == {'up to date'}
+    assert calls == []
+
+
+def test_targets_build_their_dependencies_only(stages, state_path):
+    assert run(state_path, ['b']) == {'a': 'built', 'b': 'built'}
+
+
+def test_changed_stage_rebuilds_its_dependents(stages, state_path):
+    run(state_path)
+    stages['a'] = stages['a']._replace(args=('a.txt', 'A2'))
+
+    status = run(state_path)
+
+    # b's output doesn't change, so c is still up to date
+    assert status == {'a': 'built', 'b': 'built', 'c': 'up to date', 'd': 'up to date'}
+
+
+def test_identical_output_stops_the_rebuild(stages, state_path):
+    run(state_path)
+    # a is rebuilt (its key changed), but writes the same bytes
+    stages['a'] = stages['a']._replace(func=rewrite)
+
+    status = run(state_path)
+
+    assert status == {'a': 'built', 'b': 'up to date', 'c': 'up to date', 'd': 'up to date'}
+
+
+def test_edited_output_is_stale(stages, state_path):
+    run(state_path)
+    Path('c.txt').write_text('edited by hand')
+
+    assert run(state_path)['c'] == 'built'
+    assert Path('c.txt').read_text() == 'C'
+
+
+def test_changed_source_is_stale(stages, state_path, tmp_path):
+    source = tmp_path.joinpath('source.csv')
+    source.write_text('v1')
+    stages['d'] = stages['d']._replace(sources=[str(source)])
+    run(state_path)
+
+    source.write_text('v2')
+
+    assert run(state_path)['d'] == 'built'
+
+
+def test_failure_skips_dependents_only(stages, state_path):
+    run(state_path, ['d'])
+    stages['a'] = stages['a']._replace(func=fail, args=('a.txt',))
+
+    with pytest.raises(RuntimeError) as excinfo:
+        run(state_path)
+
+    assert str(excinfo.value).startswith('1 stage(s) failed, skipped b, c')
+    assert "a: ValueError('no data')" in str(excinfo.value)
+    assert calls == ['a.txt']
+    assert set(json.load(open(state_path))) == {'d'}
+
+
+def test_stage_not_writing_its_outputs_fails(stages, state_path):
+    stages['d'] = stages['d']._replace(func=do_nothing, args=('d.txt',))
+
+    with pytest.raises(RuntimeError, match='not written: d.txt'):
+        run(state_path, ['d'])
+    assert 'd' not in json.load(open(state_path))
+
+
+def test_force_rebuilds_targets_not_dependencies(stages, state_path):
+    run(state_path)
+
+    status = run(state_path, ['c'], force=True)
+
+    assert status == {'a': 'up to date', 'b': 'up to date', 'c': 'built'}
+
+
+def test_kwargs_are_not_part_of_the_key(stages, state_path):
+    stages['a'] = stages['a']._replace(func=write_mode, args=('a.txt',), kwargs={'update': False})
+    run(state_path, ['a'])
+
+    stages['a'] = stages['a']._replace(kwargs={'update': True})
+
+    assert run(state_path, ['a']) == {'a': 'up to date'}
+    # but are passed when it's built
+    assert run(state_path, ['a'], force=True) == {'a': 'built'}
+    assert calls == ['a.txt', ('update', True)]
+
+
+def test_update_mode_keeps_the_kpi_df_key():
+    plain = pipeline.get_stages()['kpi_df']
+    update = pipeline.get_stages(update=True)['kpi_df']
+
+    assert update.kwargs == {'update': True}
+    assert pipeline.describe(plain.func) == pipeline.describe(update.func)
+    assert plain.args == update.args
+
+
+def test_pool_stages_run_in_workers(stages, state_path):
+    for name in ['c', 'd']:
+        stages[name] = stages[name]._replace(in_pool=True)
+
+    status = pipeline.run(None, jobs=2, state_path=state_path)
+
+    assert set(status.values()) == {'built'}
+    assert Path('c.txt').read_text() == 'C' and Path('d.txt').read_text() == 'D'
+    assert run(state_path) == {name: 'up to date' for name in 'abcd'}
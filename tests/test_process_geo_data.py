@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+import fetch_data as fd
+import process_geo_data as gd
+
+
+def square(x, y, n=50):
+    '''Closed ring around a unit square, with n points per side.'''
+
+    side = [i / n for i in range(n)]
+    ring = ([[x + t, y] for t in side] + [[x + 1, y + t] for t in side] +
+            [[x + 1 - t, y + 1] for t in side] + [[x, y + 1 - t] for t in side])
+    return ring + [ring[0]]
+
+
+@pytest.fixture
+def geo_sources(monkeypatch, tmp_path):
+    '''Both map sources served from local geojson files, compact copies under tmp_path.'''
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(gd, '_geojson', {})
+    local_sources = {}
+    for i, (name, url) in enumerate(gd.geo_sources.items()):
+        feature = {'type': 'Feature', 'properties': {'nom': name, 'code': str(i), 'extra': 1},
+                   'geometry': {'type': 'Polygon', 'coordinates': [square(i, 0)]}}
+        source = tmp_path.joinpath('{}.geojson'.format(name))
+        source.write_text(json.dumps({'type': 'FeatureCollection', 'features': [feature]}))
+        local_sources[url] = str(source)
+    monkeypatch.setattr(fd, 'local_sources', local_sources)
+
+    return local_sources
+
+
+def test_default_tolerance_files_are_reused(geo_sources):
+    geojson = gd.get_fr_dept()
+
+    assert geojson['prepared_with']['tolerance'] == gd.simplify_tolerance
+    assert gd.read_prepared('fr_dept') == geojson
+
+
+def test_custom_tolerance_survives_the_session(geo_sources, monkeypatch):
+    gd.prepare_geometry(tolerance=0.02)
+    prepared = gd.read_prepared('fr_dept')
+    assert prepared['prepared_with']['tolerance'] == 0.02
+
+    # next session, with the sources gone: the saved files are used as is
+    monkeypatch.setattr(gd, '_geojson', {})
+    monkeypatch.setattr(fd, 'local_sources', {url: 'missing.geojson' for url in geo_sources})
+    assert gd.get_fr_dept() == prepared
+    assert gd.get_fr_region()['prepared_with']['tolerance'] == 0.02
+
+
+def test_files_from_other_settings_are_stale(geo_sources):
+    gd.prepare_geometry(tolerance=0.02)
+
+    assert gd.read_prepared('fr_dept', tolerance=0.02) is not None
+    assert gd.read_prepared('fr_dept', tolerance=gd.simplify_tolerance) is None
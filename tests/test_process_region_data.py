@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import fetch_data as fd
+import process_region_data as rd
+
+
+def test_add_mayotte_pop_fills_missing_population():
+    df = pd.DataFrame({'dep': ['975', '976'], 'population': [6000., np.nan]})
+
+    assert rd.add_mayotte_pop(df, mayotte_pop=256518).at[1, 'population'] == 256518
+
+
+def test_add_mayotte_pop_keeps_known_population():
+    df = pd.DataFrame({'dep': ['975', '976'], 'population': [6000., 279471.]})
+
+    result = rd.add_mayotte_pop(df)
+
+    assert result is not None
+    assert result.at[1, 'population'] == 279471.
+
+
+@pytest.fixture
+def lookup_paths(monkeypatch, tmp_path):
+    '''Lookup pkls & their local inputs under tmp_path.'''
+
+    inputs = [tmp_path.joinpath('Departements.csv'), tmp_path.joinpath('lits.xlsx')]
+    for p in inputs:
+        p.write_text('input')
+    monkeypatch.setattr(rd, 'input_sources', [str(p) for p in inputs])
+    monkeypatch.setattr(rd, 'reg_ref_pkl', str(tmp_path.joinpath('reg_ref_df.pkl')))
+    monkeypatch.setattr(rd, 'pop_age_pkl', str(tmp_path.joinpath('pop_age_df.pkl')))
+    monkeypatch.setattr(rd, 'inputs_json', str(tmp_path.joinpath('reg_ref_inputs.json')))
+    monkeypatch.setattr(fd, 'local_sources', {})
+
+    builds = []
+    monkeypatch.setattr(rd, 'create_region_df', lambda: builds.append('reg_ref') or pd.DataFrame({'dep': ['01']}))
+    monkeypatch.setattr(rd, 'create_pop_age_df', lambda: pd.DataFrame({'0-9': [1]}))
+
+    return inputs, builds
+
+
+def test_build_if_stale_only_rebuilds_on_changed_inputs(lookup_paths):
+    inputs, builds = lookup_paths
+
+    assert rd.build_if_stale()
+    assert not rd.build_if_stale()
+
+    inputs[0].write_text('new population csv')
+    assert rd.build_if_stale()
+    assert builds == ['reg_ref', 'reg_ref']
+
+
+def test_build_if_stale_keeps_pkls_when_an_input_is_missing(lookup_paths):
+    inputs, builds = lookup_paths
+    rd.build_if_stale()
+
+    inputs[1].unlink()
+
+    assert not rd.build_if_stale()
+    assert builds == ['reg_ref']
+    with pytest.raises(FileNotFoundError):
+        rd.build_if_stale(force=True)
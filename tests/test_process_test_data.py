@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+import process_test_data as pt
+
+geo_cols = ['reg', 'libelle_reg', 'dep', 'libelle_dep', 'population']
+
+
+def test_testing_df_columns(synthetic):
+    all_ages_raw, age_raw = pt.read_testing_csv()
+    df = pt.create_testing_df(True, all_ages_raw)
+
+    assert list(df.columns) == geo_cols + ['jour', 'pos', 'tests_total', 'age_range', 'pos_rate',
+                                           'dep_id', 'dom_tom']
+    assert isinstance(df['jour'].iloc[0], str)
+
+
+def test_rolling_cols_by_dept(synthetic):
+    all_ages_df, age_df = pt.create_testing_dfs()
+    df = pt.create_rolling_cols(all_ages_df)
+
+    # 7-day sums: the first 6 days of each dept are dropped
+    assert len(df) == len(all_ages_df) - 6 * all_ages_df['dep_id'].nunique()
+    dept = all_ages_df.loc[all_ages_df['dep_id'] == 3].sort_values('jour')
+    expected = (dept['pos'].rolling(7).sum() * 100000 / dept['population']).round(2).dropna()
+    got = df.loc[df['dep_id'] == 3].sort_values('jour')['rolling_pos_100k']
+    assert np.allclose(got.to_numpy(), expected.to_numpy())
+
+
+def test_rolling_cols_without_rows(synthetic):
+    all_ages_raw, age_raw = pt.read_testing_csv(start='2099-01-01')
+    df = pt.create_rolling_cols(pt.create_testing_df(True, all_ages_raw, as_datetime=True))
+
+    assert df.empty
+    assert {'rolling_pos_100k', 'rolling_pos_rate', 'rolling_test_100k'} <= set(df.columns)
+
+
+
+def test_blank_counts_are_read_as_missing(synthetic):
+    path = pt.fd.local_sources[pt.url]
+    lines = open(path).read().splitlines()
+    header = lines[0].split(';')
+    # blank the positives of one all-ages row & the tests of one per-age row
+    for i, col in [(1, 'P'), (2, 'T')]:
+        fields = lines[i].split(';')
+        fields[header.index(col)] = ''
+        lines[i] = ';'.join(fields)
+    open(path, 'w').write('\n'.join(lines) + '\n')
+
+    all_ages_df, age_df = pt.create_testing_dfs()
+
+    assert all_ages_df['pos'].isna().sum() + age_df['pos'].isna().sum() == 1
+    assert all_ages_df['tests_total'].isna().sum() + age_df['tests_total'].isna().sum() == 1
+    assert all_ages_df['pos_rate'].dtype == 'float64'
+    assert not pt.create_rolling_cols(all_ages_df).empty
+    assert not pt.create_dept_age_df(df=age_df).empty
@@ -0,0 +1,91 @@
+import shutil
+
+import pandas as pd
+import plotly.graph_objects as go
+import pytest
+
+import process_geo_data as gd
+import process_kpi as kpi
+
+
+def make_bar(df):
+    return go.Figure(go.Bar(x=df['jour'], y=df['rea%']))
+
+
+@pytest.fixture
+def figure_paths(monkeypatch, tmp_path):
+    '''html & manifest, prepared geometry and a copy of the code, under tmp_path.'''
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(kpi, 'output_path', str(tmp_path.joinpath('html')) + '/')
+    tmp_path.joinpath('html').mkdir()
+
+    code_dir = tmp_path.joinpath('code')
+    code_dir.mkdir()
+    for fname in kpi.code_files:
+        shutil.copy(kpi.code_path.joinpath(fname), code_dir)
+    monkeypatch.setattr(kpi, 'code_path', code_dir)
+
+    return tmp_path
+
+
+@pytest.fixture
+def spec():
+    df = pd.DataFrame({'jour': ['2020-11-01', '2020-11-02'], 'rea%': [61.5, 63.2]})
+    return ('rea.html', make_bar, (df,))
+
+
+def rendered(capsys):
+    out = capsys.readouterr().out
+    return 'Map saved to' in out and 'Unchanged, skipped' not in out
+
+
+def test_unchanged_figure_is_skipped(figure_paths, spec, capsys):
+    kpi.render_figures([spec], jobs=1)
+    assert rendered(capsys)
+
+    kpi.render_figures([spec], jobs=1)
+    assert not rendered(capsys)
+
+
+def test_changed_args_rerender(figure_paths, spec, capsys):
+    kpi.render_figures([spec], jobs=1)
+    capsys.readouterr()
+
+    fname, func, (df,) = spec
+    kpi.render_figures([(fname, func, (df.assign(**{'rea%': [61.5, 70.]}),))], jobs=1)
+    assert rendered(capsys)
+
+
+def test_prepared_geometry_changes_rerender(figure_paths, spec, capsys):
+    geo_file = gd.prepared_path('fr_dept')
+    geo_file.parent.mkdir(parents=True)
+    geo_file.write_text('{"type": "FeatureCollection", "features": []}')
+    kpi.render_figures([spec], jobs=1)
+    capsys.readouterr()
+
+    geo_file.write_text('{"type": "FeatureCollection", "features": [], "prepared_with": {}}')
+    kpi.render_figures([spec], jobs=1)
+    assert rendered(capsys)
+
+
+@pytest.mark.parametrize('fname', ['process_geo_data.py', 'dashboard.py'])
+def test_helper_module_changes_rerender(figure_paths, spec, capsys, fname):
+    kpi.render_figures([spec], jobs=1)
+    capsys.readouterr()
+
+    with open(kpi.code_path.joinpath(fname), 'a') as f:
+        f.write('\n# edited\n')
+    kpi.render_figures([spec], jobs=1)
+    assert rendered(capsys)
+
+
+@pytest.mark.parametrize('value, jobs', [(None, None), ('4', 4), ('four', None), ('0', None)])
+def test_render_jobs_from_environment(monkeypatch, capsys, value, jobs):
+    if value is None:
+        monkeypatch.delenv('RENDER_JOBS', raising=False)
+    else:
+        monkeypatch.setenv('RENDER_JOBS', value)
+
+    assert kpi.get_render_jobs() == jobs
+    assert ('Ignoring RENDER_JOBS' in capsys.readouterr().out) == (value in ('four', '0'))
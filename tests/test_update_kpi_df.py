@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+
+import process_hosp_data as hd
+import process_kpi as kpi
+
+
+def drop_icu_days(first, last, reg):
+    '''Removes every hospital row of one region from `first` to `last`: a
+    gap in its rea%, filled forward from the day before.'''
+
+    path = kpi.fd.local_sources[hd.hosp_url]
+    hosp = pd.read_csv(path, sep=';', dtype='str')
+    geo = kpi.rd.load_geo_index()
+    deps = geo.loc[geo['reg'] == reg, 'dep']
+    days = kpi.fd.parse_days(hosp['jour'])
+    gap = hosp['dep'].isin(deps) & (days >= pd.Timestamp(first)) & (days <= pd.Timestamp(last))
+    hosp.loc[~gap].to_csv(path, sep=';', index=False)
+
+
+def incremental_build(full_df, cutoff):
+    '''update_kpi_df on top of the rows of a full build up to `cutoff`. The
+    full build's sources stay in hd's store: the update reads its own rows.'''
+
+    kpi.save_df(full_df.loc[full_df['jour'] <= cutoff], 'parquet')
+    update_df = kpi.update_kpi_df()
+    assert update_df['jour'].max() > cutoff
+    return update_df
+
+
+def assert_same_kpis(update_df, full_df):
+    cols = ['libelle_dep', 'jour'] + kpi.alert_cols + ['rea%_dep', 'niveau_global']
+    update_df = update_df[cols].sort_values(['libelle_dep', 'jour']).reset_index(drop=True)
+    full_df = full_df[cols].sort_values(['libelle_dep', 'jour']).reset_index(drop=True)
+    update_df['niveau_global'] = update_df['niveau_global'].astype('str')
+    full_df['niveau_global'] = full_df['niveau_global'].astype('str')
+
+    pd.testing.assert_frame_equal(update_df, full_df, check_dtype=False)
+
+
+@pytest.mark.parametrize('cutoff', ['2020-04-10', '2020-04-25', '2020-05-15'])
+def test_update_matches_full_build(synthetic, cutoff):
+    full_df = kpi.create_kpi_df()
+    assert cutoff < full_df['jour'].max()
+
+    assert_same_kpis(incremental_build(full_df, cutoff), full_df)
+
+
+def test_update_fills_an_icu_gap_spanning_since(synthetic):
+    # no ICU numbers for region 11 from 20 days before the cutoff to 10 days after.
+    # The sources read from lookback_start on are all in the gap, so only the
+    # seed from the previous df can fill it
+    cutoff = '2020-04-25'
+    drop_icu_days('2020-04-05', '2020-05-05', 11)
+    assert kpi.lookback_start('2020-04-26') > pd.Timestamp('2020-04-05')
+    full_df = kpi.create_kpi_df()
+    gap_rows = full_df.loc[(full_df['reg'] == 11) & (full_df['jour'] > cutoff) & (full_df['jour'] <= '2020-05-05')]
+    assert len(gap_rows) and gap_rows['rea%'].notna().all()
+
+    update_df = incremental_build(full_df, cutoff)
+
+    assert_same_kpis(update_df, full_df)